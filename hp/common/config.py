@@ -32,6 +32,11 @@ HP_DRIVER_OPTS = [
                 default=False,
                 help=_('Does synchronized configuration forcibly overwrite '
                        'the physical devices configurations?')),
+    cfg.BoolOpt('sync_differential',
+                default=True,
+                help=_('Read the VLANs and trunk ports of the devices '
+                       'when synchronizing, and push only what differs '
+                       'from the desired configuration.')),
     cfg.StrOpt('oem',
                default='hp',
                help=_('Specify the OEM for all physical devices.'
@@ -53,7 +58,71 @@ HP_DRIVER_OPTS = [
     cfg.StrOpt('rpc_backend',
                default='netconf',
                help=_('Specify a method for assigning configuration.'
-                      ' Supported backends are NETCONF and RESTful.'))
+                      ' Supported backends are NETCONF and RESTful.')),
+    cfg.IntOpt('topology_check_interval',
+               default=30,
+               help=_('Interval in seconds for checking whether the '
+                      'configuration files are changed and reloading the '
+                      'leaf and spine topology. 0 disables the check, '
+                      'the topology is still reloaded on SIGHUP.')),
+    cfg.IntOpt('connection_pool_size',
+               default=2,
+               help=_('Maximum number of persistent NETCONF or RESTful '
+                      'connections to each device.')),
+    cfg.IntOpt('connection_idle_timeout',
+               default=60,
+               help=_('Close a persistent NETCONF or RESTful connection '
+                      'after it is idle for this many seconds.')),
+    cfg.IntOpt('rest_compress_threshold',
+               default=0,
+               help=_('Send RESTful request bodies of at least this many '
+                      'bytes gzip compressed. 0 never compresses.')),
+    cfg.IntOpt('session_lease_time',
+               default=60,
+               help=_('Trust a NETCONF session for this many seconds after '
+                      'it was last known to be valid, instead of verifying '
+                      'it before every request. 0 verifies every time.')),
+    cfg.IntOpt('device_workers',
+               default=8,
+               help=_('Maximum number of devices configured at the same '
+                      'time.')),
+    cfg.IntOpt('device_workers_per_device',
+               default=1,
+               help=_('Maximum number of concurrent configuration tasks '
+                      'for one device.')),
+    cfg.IntOpt('device_op_retries',
+               default=3,
+               help=_('Number of attempts to apply a queued device '
+                      'operation before it is marked failed and left to '
+                      'the next synchronization.')),
+    cfg.IntOpt('device_op_retry_interval',
+               default=5,
+               help=_('Interval in seconds between the attempts to apply '
+                      'a queued device operation.')),
+    cfg.IntOpt('coalesce_window',
+               default=100,
+               help=_('Time in milliseconds to collect the queued '
+                      'operations of a device before they are merged and '
+                      'pushed together. 0 pushes at once.')),
+    cfg.IntOpt('port_batch_window',
+               default=20,
+               help=_('Time in milliseconds to collect the created or '
+                      'deleted ports of a network on a host before they '
+                      'are stored and configured together. 0 handles '
+                      'each port at once.')),
+    cfg.IntOpt('device_op_lease',
+               default=300,
+               help=_('Seconds for which a queue worker claims the '
+                      'operations of a device while pushing them. Other '
+                      'workers take them over when the claim expires.')),
+    cfg.IntOpt('breaker_failure_threshold',
+               default=3,
+               help=_('Number of consecutive connection failures after '
+                      'which requests to a device fail at once.')),
+    cfg.IntOpt('breaker_reset_timeout',
+               default=30,
+               help=_('Seconds to fail the requests to an unreachable '
+                      'device at once before probing it again.'))
 ]
 
 cfg.CONF.register_opts(HP_DRIVER_OPTS, "ml2_hp")
@@ -104,9 +173,18 @@ class HPML2Config(object):
     """
     leaf_topology = []
     spine_topology = []
+    topology = None
 
     def __init__(self):
+        # Parse into new lists, so that a reload never changes the
+        # topology which is in use.
+        self.leaf_topology = []
+        self.spine_topology = []
         self._create_hp_config()
+        HPML2Config.leaf_topology = self.leaf_topology
+        HPML2Config.spine_topology = self.spine_topology
+        HPML2Config.topology = Topology(self.leaf_topology,
+                                        self.spine_topology)
 
     def _create_leaf_config(self, leaf_ip, items):
         leaf_in_use = None
@@ -180,3 +258,111 @@ class HPML2Config(object):
                     self._create_leaf_config(ip, key_items)
                 elif config_key == 'ml2_hp_spine':
                     self._create_spine_config(ip, key_items)
+
+
+class Topology(object):
+    """ Lookup maps compiled once from leaf and spine topology.
+        host -> ((leaf_ip, ports), ...)
+        leaf_ip -> ((host, ports), ...)
+        leaf_ip -> ((spine_ip, spine_ports, leaf_ports), ...)
+        spine_ip -> (leaf_ip, ...)
+        All the values are tuples, and none of the maps is changed after
+        the construction, so it can be shared between threads.
+    """
+    def __init__(self, leaf_topology, spine_topology):
+        host_leaves = {}
+        leaf_hosts = {}
+        leaf_uplinks = {}
+        spine_leaves = {}
+        self._oem = {}
+        for leaf in leaf_topology:
+            self._oem[leaf['ip']] = leaf['oem']
+            leaf_hosts.setdefault(leaf['ip'], [])
+            for conn in leaf['connections']:
+                ports = tuple(conn['ports'])
+                host_leaves.setdefault(conn['host'], []).\
+                    append((leaf['ip'], ports))
+                leaf_hosts[leaf['ip']].append((conn['host'], ports))
+        for spine in spine_topology:
+            self._oem[spine['ip']] = spine['oem']
+            spine_leaves.setdefault(spine['ip'], [])
+            for conn in spine['connections']:
+                leaf_uplinks.setdefault(conn['leaf_ip'], []).\
+                    append((spine['ip'], tuple(conn['spine_ports']),
+                            tuple(conn['leaf_ports'])))
+                spine_leaves[spine['ip']].append(conn['leaf_ip'])
+        self._host_leaves = self._freeze(host_leaves)
+        self._leaf_hosts = self._freeze(leaf_hosts)
+        self._leaf_uplinks = self._freeze(leaf_uplinks)
+        self._spine_leaves = self._freeze(spine_leaves)
+
+    @staticmethod
+    def _freeze(lookup):
+        return dict((key, tuple(value)) for key, value in lookup.items())
+
+    @property
+    def leaves(self):
+        return self._leaf_hosts.keys()
+
+    @property
+    def spines(self):
+        return self._spine_leaves.keys()
+
+    @property
+    def devices(self):
+        return self.leaves + self.spines
+
+    def get_host_leaves(self, host):
+        """ Return ((leaf_ip, ports), ...) of leaves connecting to host. """
+        return self._host_leaves.get(host, ())
+
+    def get_leaf_hosts(self, leaf_ip):
+        """ Return ((host, ports), ...) of hosts connecting to leaf. """
+        return self._leaf_hosts.get(leaf_ip, ())
+
+    def get_leaf_uplinks(self, leaf_ip):
+        """ Return ((spine_ip, spine_ports, leaf_ports), ...) of spines
+            connecting to leaf.
+        """
+        return self._leaf_uplinks.get(leaf_ip, ())
+
+    def get_spine_leaves(self, spine_ip):
+        """ Return (leaf_ip, ...) of leaves connecting to spine. """
+        return self._spine_leaves.get(spine_ip, ())
+
+    def get_oem(self, dev_ip):
+        return self._oem.get(dev_ip)
+
+    def _get_links(self, dev_ip):
+        """ Return what a device connects to, for comparing topologies. """
+        spine_links = frozenset(
+            (leaf_ip, spine_ports, leaf_ports)
+            for leaf_ip in self.get_spine_leaves(dev_ip)
+            for spine_ip, spine_ports, leaf_ports in
+            self.get_leaf_uplinks(leaf_ip) if spine_ip == dev_ip)
+        return (self._oem.get(dev_ip),
+                frozenset(self.get_leaf_hosts(dev_ip)),
+                frozenset(self.get_leaf_uplinks(dev_ip)),
+                spine_links)
+
+    def diff(self, other):
+        """ Return the devices whose connections differ between
+            this topology and the other one, added and removed devices
+            included.
+        """
+        changed = set()
+        for dev_ip in set(self._oem) | set(other._oem):
+            if self._get_links(dev_ip) != other._get_links(dev_ip):
+                changed.add(dev_ip)
+        return changed
+
+    def get_host_devices(self, hosts):
+        """ Return the leaves connecting to hosts and their spines. """
+        devices = set()
+        for host in hosts:
+            for leaf_ip, ports in self.get_host_leaves(host):
+                devices.add(leaf_ip)
+                for spine_ip, spine_ports, leaf_ports in \
+                        self.get_leaf_uplinks(leaf_ip):
+                    devices.add(spine_ip)
+        return devices
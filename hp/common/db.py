@@ -15,7 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import json
+import threading
+
 import sqlalchemy as sa
+from sqlalchemy import event
+from oslo_db import exception as db_exc
+from oslo_utils import timeutils
 
 from neutron import context as nctx
 import neutron.db.api as db
@@ -31,6 +38,77 @@ VLAN_SEGMENTATION = 'vlan'
 UUID_LEN = 36
 STR_LEN = 255
 SEGTYPE_LEN = 12
+ACTION_LEN = 12
+STATE_LEN = 12
+
+VLAN_ADD = 'add'
+VLAN_REMOVE = 'remove'
+
+OP_PENDING = 'pending'
+OP_DONE = 'done'
+OP_FAILED = 'failed'
+
+_query_local = threading.local()
+_query_lock = threading.Lock()
+_query_listening = False
+# name -> [times, queries]
+_query_stats = {}
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = getattr(_query_local, 'counter', None)
+    if counter is not None:
+        counter.queries += 1
+
+
+class QueryCounter(object):
+    """ Count SQL statements issued by the current thread in a block.
+        with QueryCounter('create_port_postcommit') as counter:
+            ...
+        counter.queries is the number of statements of this block, and
+        get_query_stats() reports the totals of every name.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.parent = None
+
+    def __enter__(self):
+        global _query_listening
+        if not _query_listening:
+            with _query_lock:
+                if not _query_listening:
+                    event.listen(db.get_engine(), 'before_cursor_execute',
+                                 _count_query)
+                    _query_listening = True
+        self.queries = 0
+        self.parent = getattr(_query_local, 'counter', None)
+        _query_local.counter = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _query_local.counter = self.parent
+        if self.parent is not None:
+            self.parent.queries += self.queries
+        with _query_lock:
+            stats = _query_stats.setdefault(self.name, [0, 0])
+            stats[0] += 1
+            stats[1] += self.queries
+        LOG.debug(_("%s issued %d queries."), self.name, self.queries)
+
+
+def get_query_stats():
+    """ Return {name: (times, queries)} of all the QueryCounter blocks. """
+    with _query_lock:
+        return dict((name, tuple(stats))
+                    for name, stats in _query_stats.items())
+
+
+def get_session():
+    """ Return a new session, to run several calls of this module in
+        one transaction through their session argument.
+    """
+    return db.get_session()
 
 
 class HPRelatedNetworks(model_base.BASEV2,
@@ -40,6 +118,10 @@ class HPRelatedNetworks(model_base.BASEV2,
         A network id corresponding a segmentation ID.
     """
     __tablename__ = 'hp_related_nets'
+    __table_args__ = (
+        sa.Index('ix_hp_related_nets_network_id_segmentation_type',
+                 'network_id', 'segmentation_type'),
+    )
 
     network_id = sa.Column(sa.String(UUID_LEN))
     segmentation_id = sa.Column(sa.Integer)
@@ -56,6 +138,13 @@ class HPRelatedVms(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
         This table stores all the VM informations.
     """
     __tablename__ = 'hp_related_vms'
+    __table_args__ = (
+        sa.UniqueConstraint('device_id', 'port_id', 'network_id', 'host_id',
+                            name='uniq_hp_related_vms0device_id0port_id0'
+                                 'network_id0host_id'),
+        sa.Index('ix_hp_related_vms_network_id_host_id',
+                 'network_id', 'host_id'),
+    )
 
     device_id = sa.Column(sa.String(STR_LEN))
     host_id = sa.Column(sa.String(STR_LEN))
@@ -75,18 +164,174 @@ class HPRelatedVms(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
                 u'network_id': self.network_id}
 
 
-def get_network_count():
-    session = db.get_session()
-    with session.begin():
+class HPRelatedHostRefs(model_base.BASEV2):
+    """ Representation for table hp_related_host_refs
+        The number of VMs of a network on a host.
+    """
+    __tablename__ = 'hp_related_host_refs'
+
+    network_id = sa.Column(sa.String(UUID_LEN), primary_key=True)
+    host_id = sa.Column(sa.String(STR_LEN), primary_key=True)
+    ref_count = sa.Column(sa.Integer, nullable=False, default=0)
+
+
+class HPVlanJournal(model_base.BASEV2):
+    """ Representation for table hp_vlan_journal
+        Every time a VLAN appears on or disappears from a host,
+        a row is appended with an increasing sequence number.
+    """
+    __tablename__ = 'hp_vlan_journal'
+
+    seq = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    network_id = sa.Column(sa.String(UUID_LEN))
+    host_id = sa.Column(sa.String(STR_LEN))
+    segmentation_id = sa.Column(sa.Integer)
+    action = sa.Column(sa.String(ACTION_LEN))
+    created_at = sa.Column(sa.DateTime, default=timeutils.utcnow)
+
+
+class HPDeviceOp(model_base.BASEV2):
+    """ Representation for table hp_device_ops
+        Configuration waiting to be pushed to a device, as the JSON
+        form of a DeviceChangeSet. The operations of one device are
+        applied in the order of seq. The queue worker pushing them
+        claims them by setting owner, until lease_until.
+    """
+    __tablename__ = 'hp_device_ops'
+    __table_args__ = (
+        sa.Index('ix_hp_device_ops_device_ip_state', 'device_ip', 'state'),
+    )
+
+    seq = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    device_ip = sa.Column(sa.String(STR_LEN), nullable=False)
+    changes = sa.Column(sa.Text, nullable=False)
+    state = sa.Column(sa.String(STATE_LEN), nullable=False,
+                      default=OP_PENDING)
+    attempts = sa.Column(sa.Integer, nullable=False, default=0)
+    last_error = sa.Column(sa.String(STR_LEN))
+    owner = sa.Column(sa.String(STR_LEN))
+    lease_until = sa.Column(sa.DateTime)
+    created_at = sa.Column(sa.DateTime, default=timeutils.utcnow)
+    updated_at = sa.Column(sa.DateTime, default=timeutils.utcnow,
+                           onupdate=timeutils.utcnow)
+
+    def get_changes(self):
+        return json.loads(self.changes)
+
+
+def _journal_vlan_change(session, network_id, host_id, action):
+    seg_id = get_segment_id_by_net_id(network_id, VLAN_SEGMENTATION,
+                                      session=session)
+    if seg_id is None:
+        return
+    session.add(HPVlanJournal(network_id=network_id, host_id=host_id,
+                              segmentation_id=seg_id, action=action))
+
+
+def _update_host_ref(session, network_id, host_id, delta):
+    """ Add delta to the VM counter of a network on a host.
+        It must be called inside the transaction which inserts or
+        deletes the VMs. Return the new value of the counter.
+        The journal gets a row when the counter leaves or reaches 0.
+    """
+    model = HPRelatedHostRefs
+    qry = session.query(model).filter_by(network_id=network_id,
+                                         host_id=host_id)
+    while True:
+        updated = qry.update({'ref_count': model.ref_count + delta},
+                             synchronize_session=False)
+        if updated > 0:
+            break
+        if delta <= 0:
+            return 0
+        try:
+            # Another server may insert the counter first, a savepoint
+            # keeps the transaction usable to update it instead.
+            with session.begin_nested():
+                session.add(model(network_id=network_id, host_id=host_id,
+                                  ref_count=delta))
+        except db_exc.DBDuplicateEntry:
+            continue
+        _journal_vlan_change(session, network_id, host_id, VLAN_ADD)
+        return delta
+    ref_count = (session.query(model.ref_count).
+                 filter_by(network_id=network_id, host_id=host_id).scalar())
+    if ref_count <= 0:
+        qry.delete(synchronize_session=False)
+        _journal_vlan_change(session, network_id, host_id, VLAN_REMOVE)
+        return 0
+    return ref_count
+
+
+def get_last_journal_seq(session=None):
+    """ Return the sequence number of the newest journal entry, or 0. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        seq = session.query(sa.func.max(HPVlanJournal.seq)).scalar()
+        return seq or 0
+
+
+def get_journal_entries(after_seq, up_to_seq=None, session=None):
+    """ Return the journal entries whose sequence number is greater than
+        after_seq, and not greater than up_to_seq if it is given.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        qry = (session.query(HPVlanJournal).
+               filter(HPVlanJournal.seq > after_seq))
+        if up_to_seq is not None:
+            qry = qry.filter(HPVlanJournal.seq <= up_to_seq)
+        return qry.order_by(HPVlanJournal.seq).all()
+
+
+def get_journal_entries_by_seq(seqs, session=None):
+    """ Return the journal entries of the given sequence numbers. """
+    if len(seqs) == 0:
+        return []
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        return (session.query(HPVlanJournal).
+                filter(HPVlanJournal.seq.in_(seqs)).
+                order_by(HPVlanJournal.seq).all())
+
+
+def get_recent_journal_seqs(max_age, up_to_seq, session=None):
+    """ Return the sorted sequence numbers, not greater than up_to_seq,
+        of the journal entries created in the last max_age seconds.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        since = timeutils.utcnow() - datetime.timedelta(seconds=max_age)
+        qry = (session.query(HPVlanJournal.seq).
+               filter(HPVlanJournal.created_at >= since,
+                      HPVlanJournal.seq <= up_to_seq).
+               order_by(HPVlanJournal.seq))
+        return [row[0] for row in qry]
+
+
+def purge_journal(max_age, session=None):
+    """ Delete the journal entries older than max_age seconds. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        expire = timeutils.utcnow() - datetime.timedelta(seconds=max_age)
+        return (session.query(HPVlanJournal).
+                filter(HPVlanJournal.created_at < expire).
+                delete(synchronize_session=False))
+
+
+def get_network_count(session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         q = session.query(HPRelatedNetworks)
         nets_cnt = int(q.count())
         return nets_cnt
 
 
-def create_network(tenant_id, network_id, segmentation_id, segment_type):
+def create_network(tenant_id, network_id, segmentation_id, segment_type,
+                   session=None):
     """ Store a network relationship in db. """
-    session = db.get_session()
-    with session.begin():
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         network = HPRelatedNetworks(tenant_id=tenant_id,
                                     network_id=network_id,
                                     segmentation_id=segmentation_id,
@@ -94,42 +339,158 @@ def create_network(tenant_id, network_id, segmentation_id, segment_type):
         session.add(network)
 
 
-def delete_network(tenant_id, network_id):
+def delete_network(tenant_id, network_id, session=None):
     """ Remove a network relationship from comware db. """
-    session = db.get_session()
-    with session.begin():
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         (session.query(HPRelatedNetworks).
          filter_by(network_id=network_id).delete())
 
 
-def create_vm(device_id, host_id, port_id, network_id, tenant_id):
-    """ Relate a vm with comware. """
-    session = db.get_session()
-    with session.begin():
-        vm = HPRelatedVms(device_id=device_id,
-                          host_id=host_id,
-                          port_id=port_id,
-                          network_id=network_id,
-                          tenant_id=tenant_id)
-        session.add(vm)
+def create_vm(device_id, host_id, port_id, network_id, tenant_id,
+              session=None):
+    """ Relate a vm with comware.
+        Return 0 if the vm is already known. Otherwise return the number
+        of VMs in the network on the host, this one included.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        try:
+            # A savepoint keeps the caller's transaction usable
+            # when the vm is duplicated.
+            with session.begin_nested():
+                vm = HPRelatedVms(device_id=device_id,
+                                  host_id=host_id,
+                                  port_id=port_id,
+                                  network_id=network_id,
+                                  tenant_id=tenant_id)
+                session.add(vm)
+        except db_exc.DBDuplicateEntry:
+            return 0
+        return _update_host_ref(session, network_id, host_id, 1)
 
 
-def delete_vm(device_id, host_id, port_id, network_id, tenant_id):
+def delete_vm(device_id, host_id, port_id, network_id, tenant_id,
+              session=None):
     """Removes all relevant information about a VM from repository.
+       Return None if the vm is unknown. Otherwise return the number of
+       VMs left in the network on the host.
     """
     LOG.info(_("break vm begin"))
-    session = db.get_session()
-    with session.begin():
-        (session.query(HPRelatedVms).
-         filter_by(device_id=device_id, host_id=host_id,
-                   port_id=port_id, tenant_id=tenant_id,
-                   network_id=network_id).delete())
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        deleted = (session.query(HPRelatedVms).
+                   filter_by(device_id=device_id, host_id=host_id,
+                             port_id=port_id, tenant_id=tenant_id,
+                             network_id=network_id).delete())
+        if deleted == 0:
+            return None
         LOG.info(_("Break vm end"))
+        return _update_host_ref(session, network_id, host_id, -deleted)
+
 
+def _vm_key(vm):
+    return (vm['device_id'], vm['port_id'], vm['network_id'], vm['host_id'])
 
-def get_segmentation_id(tenant_id, network_id):
-    session = db.get_session()
-    with session.begin():
+
+def create_vms_bulk(vms, session=None):
+    """ Relate a batch of vms with comware in one transaction.
+    :param vms. A list of dicts with device_id, host_id, port_id,
+                network_id and tenant_id.
+    :return {(network_id, host_id): (vm count before, vm count after)}
+            for every network and host which gets new VMs.
+    """
+    if len(vms) == 0:
+        return {}
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        port_ids = set(vm['port_id'] for vm in vms)
+        known = set(_vm_key(vm) for vm in
+                    session.query(HPRelatedVms).
+                    filter(HPRelatedVms.port_id.in_(port_ids)))
+        new_vms = []
+        for vm in vms:
+            key = _vm_key(vm)
+            if key not in known:
+                known.add(key)
+                new_vms.append(vm)
+        try:
+            with session.begin_nested():
+                session.add_all([HPRelatedVms(device_id=vm['device_id'],
+                                              host_id=vm['host_id'],
+                                              port_id=vm['port_id'],
+                                              network_id=vm['network_id'],
+                                              tenant_id=vm['tenant_id'])
+                                 for vm in new_vms])
+        except db_exc.DBDuplicateEntry:
+            # Someone else inserted some of them meanwhile,
+            # fall back to insert them one by one.
+            return _create_vms_one_by_one(session, new_vms)
+
+        deltas = {}
+        for vm in new_vms:
+            key = (vm['network_id'], vm['host_id'])
+            deltas[key] = deltas.get(key, 0) + 1
+        refs = {}
+        for (network_id, host_id), delta in deltas.items():
+            after = _update_host_ref(session, network_id, host_id, delta)
+            refs[(network_id, host_id)] = (after - delta, after)
+        return refs
+
+
+def _create_vms_one_by_one(session, vms):
+    """ Insert vms with create_vm, as create_vms_bulk returns them.
+        The counter returned by each insert is taken, since the counter
+        read afterwards may include VMs inserted by others meanwhile.
+    """
+    refs = {}
+    for vm in vms:
+        after = create_vm(vm['device_id'], vm['host_id'], vm['port_id'],
+                          vm['network_id'], vm['tenant_id'],
+                          session=session)
+        if after > 0:
+            key = (vm['network_id'], vm['host_id'])
+            before = refs[key][0] if key in refs else after - 1
+            refs[key] = (before, after)
+    return refs
+
+
+def delete_vms_bulk(vms, session=None):
+    """ Remove a batch of vms from repository in one transaction.
+    :param vms. A list of dicts with device_id, host_id, port_id,
+                network_id and tenant_id.
+    :return {(network_id, host_id): (vm count before, vm count after)}
+            for every network and host which loses VMs.
+    """
+    if len(vms) == 0:
+        return {}
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        wanted = set((vm['tenant_id'],) + _vm_key(vm) for vm in vms)
+        port_ids = set(vm['port_id'] for vm in vms)
+        deltas = {}
+        vm_ids = []
+        for vm in (session.query(HPRelatedVms).
+                   filter(HPRelatedVms.port_id.in_(port_ids))):
+            if (vm.tenant_id,) + _vm_key(vm) in wanted:
+                vm_ids.append(vm.id)
+                key = (vm.network_id, vm.host_id)
+                deltas[key] = deltas.get(key, 0) + 1
+        if len(vm_ids) == 0:
+            return {}
+        (session.query(HPRelatedVms).
+         filter(HPRelatedVms.id.in_(vm_ids)).
+         delete(synchronize_session=False))
+        refs = {}
+        for (network_id, host_id), delta in deltas.items():
+            after = _update_host_ref(session, network_id, host_id, -delta)
+            refs[(network_id, host_id)] = (after + delta, after)
+        return refs
+
+
+def get_segmentation_id(tenant_id, network_id, session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         net = (session.query(HPRelatedNetworks).
                filter_by(tenant_id=tenant_id,
                          network_id=network_id).first())
@@ -137,11 +498,11 @@ def get_segmentation_id(tenant_id, network_id):
 
 
 def is_vm_created(device_id, host_id, port_id,
-                  network_id, tenant_id):
+                  network_id, tenant_id, session=None):
     """Checks if a VM is already known to comware. """
-    session = db.get_session()
+    session = session or db.get_session()
     num_vm = 0
-    with session.begin():
+    with session.begin(subtransactions=True):
         num_vm = (session.query(HPRelatedVms).
                   filter_by(tenant_id=tenant_id,
                             device_id=device_id,
@@ -151,18 +512,18 @@ def is_vm_created(device_id, host_id, port_id,
     return num_vm > 0
 
 
-def get_distinct_vms():
-    session = db.get_session()
-    with session.begin():
+def get_distinct_vms(session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         vms = (session.query(HPRelatedVms.host_id,
                              HPRelatedVms.network_id).distinct())
         return vms
     return None
 
 
-def get_segment_id_by_net_id(net_id, net_type):
-    session = db.get_session()
-    with session.begin():
+def get_segment_id_by_net_id(net_id, net_type, session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         net = session.query(HPRelatedNetworks).\
             filter_by(network_id=net_id, segmentation_type=net_type).first()
         if net is not None:
@@ -171,10 +532,10 @@ def get_segment_id_by_net_id(net_id, net_type):
             return None
 
 
-def is_network_created(tenant_id, network_id, seg_id=None):
+def is_network_created(tenant_id, network_id, seg_id=None, session=None):
     """Checks if a networks is already known to COMWARE."""
-    session = db.get_session()
-    with session.begin():
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         if not seg_id:
             num_nets = (session.query(HPRelatedNetworks).
                         filter_by(tenant_id=tenant_id,
@@ -188,25 +549,25 @@ def is_network_created(tenant_id, network_id, seg_id=None):
         return num_nets > 0
 
 
-def created_nets_count(tenant_id):
+def created_nets_count(tenant_id, session=None):
     """Returns number of networks for a given tenant. """
-    session = db.get_session()
-    with session.begin():
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         return (session.query(HPRelatedNetworks).
                 filter_by(tenant_id=tenant_id).count())
 
 
-def get_vm_count(network_id, host_id):
+def get_vm_count(network_id, host_id, session=None):
     """ Return the number vm in the same network. """
-    session = db.get_session()
-    with session.begin():
-        return (session.query(HPRelatedVms).
-                filter_by(network_id=network_id, host_id=host_id).count())
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        ref = session.query(HPRelatedHostRefs).get((network_id, host_id))
+        return ref and ref.ref_count or 0
 
 
-def get_networks():
-    session = db.get_session()
-    with session.begin():
+def get_networks(session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         model = HPRelatedNetworks
         all_nets = session.query(model)
         res = dict(
@@ -217,9 +578,9 @@ def get_networks():
         return res
 
 
-def get_vms(tenant_id):
-    session = db.get_session()
-    with session.begin():
+def get_vms(tenant_id, session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         model = HPRelatedVms
         none = None
         all_vms = (session.query(model).
@@ -236,9 +597,9 @@ def get_vms(tenant_id):
 
 
 def get_vm_host(device_id, port_id,
-                network_id, tenant_id):
-    session = db.get_session()
-    with session.begin():
+                network_id, tenant_id, session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         qry = (session.query(HPRelatedVms).
                filter_by(tenant_id=tenant_id,
                          device_id=device_id,
@@ -250,10 +611,10 @@ def get_vm_host(device_id, port_id,
     return None
 
 
-def get_host_list(network_id):
+def get_host_list(network_id, session=None):
     host_list = []
-    session = db.get_session()
-    with session.begin():
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         qry = (session.query(HPRelatedVms).
                filter_by(network_id=network_id))
         for one in qry:
@@ -261,9 +622,9 @@ def get_host_list(network_id):
     return host_list
 
 
-def get_ports(tenant_id):
-    session = db.get_session()
-    with session.begin():
+def get_ports(tenant_id, session=None):
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
         model = HPRelatedVms
         none = None
         all_ports = (session.query(model).
@@ -279,26 +640,208 @@ def get_ports(tenant_id):
         return res
 
 
-def get_host_vlan():
-    vms = get_distinct_vms()
+def get_host_vlan(session=None):
+    """ Return the VLANs used on each host, as {host_id: [vlan_id, ...]}.
+        The map is built with a single join over the vm and network tables.
+    """
+    session = session or db.get_session()
     host_vlan = {}
-    for vm in vms:
-        seg_id = get_segment_id_by_net_id(vm.network_id, 'vlan')
-        if seg_id is None:
-            continue
-        host_id = vm.host_id
-        LOG.info(_("host %s seg_id %s"), host_id, str(seg_id))
-        if host_id in host_vlan:
-            if seg_id not in host_vlan[host_id]:
-                host_vlan[host_id].append(seg_id)
-        else:
-            host_vlan[host_id] = [seg_id]
-        LOG.info(_("Host vlan: %s"), str(host_vlan))
-
+    with session.begin(subtransactions=True):
+        qry = (session.query(HPRelatedVms.host_id,
+                             HPRelatedNetworks.segmentation_id).
+               join(HPRelatedNetworks,
+                    HPRelatedNetworks.network_id == HPRelatedVms.network_id).
+               filter(HPRelatedNetworks.segmentation_type ==
+                      VLAN_SEGMENTATION,
+                      HPRelatedNetworks.segmentation_id != None).  # noqa
+               distinct())
+        for host_id, seg_id in qry:
+            host_vlan.setdefault(host_id, []).append(seg_id)
+    LOG.debug(_("Host vlan: %s"), host_vlan)
     return host_vlan
 
 
-def get_vlanlist_byhost(host_id):
-    host_vlan = get_host_vlan()
+def get_network_host_counts(session=None):
+    """ Return (network_id, host_id, vlan_id, port_count) for every
+        network and host pair. vlan_id is None for non-VLAN networks.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        qry = (session.query(HPRelatedVms.network_id,
+                             HPRelatedVms.host_id,
+                             HPRelatedNetworks.segmentation_id,
+                             sa.func.count(HPRelatedVms.id)).
+               outerjoin(HPRelatedNetworks,
+                         sa.and_(HPRelatedNetworks.network_id ==
+                                 HPRelatedVms.network_id,
+                                 HPRelatedNetworks.segmentation_type ==
+                                 VLAN_SEGMENTATION)).
+               group_by(HPRelatedVms.network_id,
+                        HPRelatedVms.host_id,
+                        HPRelatedNetworks.segmentation_id))
+        return [tuple(row) for row in qry]
+
+
+def get_vlanlist_byhost(host_id, session=None):
+    host_vlan = get_host_vlan(session=session)
     vlanlist = host_vlan.get(host_id, None)
     return vlanlist or []
+
+
+def enqueue_device_ops(device_changes, session=None):
+    """ Persist pending device operations.
+    :param device_changes. A list of (device_ip, dict) where the dict
+                           is the result of DeviceChangeSet.to_dict().
+    :return The sequence numbers of the new operations.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        ops = [HPDeviceOp(device_ip=device_ip, changes=json.dumps(changes),
+                          state=OP_PENDING, attempts=0)
+               for device_ip, changes in device_changes]
+        session.add_all(ops)
+        session.flush()
+        return [op.seq for op in ops]
+
+
+def get_pending_device_ops(device_ip, session=None):
+    """ Return the pending operations of a device, oldest first. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        return (session.query(HPDeviceOp).
+                filter_by(device_ip=device_ip, state=OP_PENDING).
+                order_by(HPDeviceOp.seq).all())
+
+
+def get_pending_devices(session=None):
+    """ Return the set of devices which have pending operations. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        qry = (session.query(HPDeviceOp.device_ip).
+               filter_by(state=OP_PENDING).distinct())
+        return set(row[0] for row in qry)
+
+
+class _ClaimConflict(Exception):
+    pass
+
+
+def claim_device_ops(device_ip, owner, lease, session=None):
+    """ Claim the pending operations of a device for owner.
+        The queue workers of all the neutron servers share this table,
+        only the owner of an unexpired claim pushes the operations of a
+        device, so they are pushed once and in order.
+    :param owner. The identity of the claiming queue worker.
+    :param lease. Seconds after which a claim not released expires.
+    :return The claimed operations, oldest first. None if another owner
+            holds an unexpired claim on operations of the device.
+    """
+    session = session or db.get_session()
+    now = timeutils.utcnow()
+    try:
+        with session.begin(subtransactions=True):
+            ops = (session.query(HPDeviceOp).
+                   filter_by(device_ip=device_ip, state=OP_PENDING).
+                   order_by(HPDeviceOp.seq).with_for_update().all())
+            for op in ops:
+                if (op.owner not in (None, owner) and
+                        op.lease_until is not None and
+                        op.lease_until > now):
+                    return None
+            if len(ops) == 0:
+                return ops
+            seqs = [op.seq for op in ops]
+            claimed = (session.query(HPDeviceOp).
+                       filter(HPDeviceOp.seq.in_(seqs),
+                              HPDeviceOp.state == OP_PENDING,
+                              sa.or_(HPDeviceOp.owner.is_(None),
+                                     HPDeviceOp.owner == owner,
+                                     HPDeviceOp.lease_until <= now)).
+                       update({'owner': owner,
+                               'lease_until': now + datetime.timedelta(
+                                   seconds=lease)},
+                              synchronize_session=False))
+            if claimed != len(seqs):
+                # Another owner claimed some of them meanwhile.
+                raise _ClaimConflict()
+            return ops
+    except _ClaimConflict:
+        return None
+
+
+def update_device_ops(seqs, state, attempts, last_error=None, owner=None,
+                      session=None):
+    """ Set the state of operations and release their claim.
+    :param owner. If not None, only the operations still claimed by
+                  owner are updated.
+    :return The number of operations updated.
+    """
+    if len(seqs) == 0:
+        return 0
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        qry = session.query(HPDeviceOp).filter(HPDeviceOp.seq.in_(seqs))
+        if owner is not None:
+            qry = qry.filter_by(owner=owner)
+        return qry.update({'state': state, 'attempts': attempts,
+                           'last_error': last_error,
+                           'owner': None, 'lease_until': None,
+                           'updated_at': timeutils.utcnow()},
+                          synchronize_session=False)
+
+
+def release_device_ops(seqs, owner, session=None):
+    """ Release the claim of owner on operations left pending. """
+    if len(seqs) == 0:
+        return 0
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        return (session.query(HPDeviceOp).
+                filter(HPDeviceOp.seq.in_(seqs)).
+                filter_by(owner=owner, state=OP_PENDING).
+                update({'owner': None, 'lease_until': None},
+                       synchronize_session=False))
+
+
+def get_last_device_op_seq(session=None):
+    """ Return the sequence number of the newest operation, or 0. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        seq = session.query(sa.func.max(HPDeviceOp.seq)).scalar()
+        return seq or 0
+
+
+def count_device_ops_pushed_after(device_ip, after_seq, session=None):
+    """ Return the number of operations of a device newer than after_seq
+        which are no longer pending, i.e. have been pushed.
+    """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        return (session.query(HPDeviceOp).
+                filter(HPDeviceOp.device_ip == device_ip,
+                       HPDeviceOp.seq > after_seq,
+                       HPDeviceOp.state != OP_PENDING).count())
+
+
+def get_device_op_stats(session=None):
+    """ Return {device_ip: {state: number of operations}}. """
+    session = session or db.get_session()
+    stats = {}
+    with session.begin(subtransactions=True):
+        qry = (session.query(HPDeviceOp.device_ip, HPDeviceOp.state,
+                             sa.func.count(HPDeviceOp.seq)).
+               group_by(HPDeviceOp.device_ip, HPDeviceOp.state))
+        for device_ip, state, count in qry:
+            stats.setdefault(device_ip, {})[state] = count
+    return stats
+
+
+def purge_device_ops(max_age, session=None):
+    """ Delete the finished operations older than max_age seconds. """
+    session = session or db.get_session()
+    with session.begin(subtransactions=True):
+        expire = timeutils.utcnow() - datetime.timedelta(seconds=max_age)
+        return (session.query(HPDeviceOp).
+                filter(HPDeviceOp.state != OP_PENDING,
+                       HPDeviceOp.updated_at < expire).
+                delete(synchronize_session=False))
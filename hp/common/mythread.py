@@ -15,6 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import Queue
 import threading
 import time
 from oslo_log import log as logging
@@ -88,3 +90,180 @@ class GreenThread(threading.Thread):
 
     def get_lock(self):
         return self.lock
+
+
+class _Batch(object):
+    """ Results of the tasks submitted by one WorkerPool.run() call. """
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.remaining = count
+        self.results = {}
+
+    def finish(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+
+class WorkerPool(object):
+    """ A fixed number of worker threads running tasks for devices.
+        At most size tasks run at the same time, and at most per_device
+        of them for the same device, so that a slow device does not hold
+        back the others while no device is flooded. Workers are started
+        on first use. Tasks run in the caller's thread, by run() with a
+        single task or by call(), count against the same limits.
+    """
+    def __init__(self, size, per_device=1):
+        self.size = max(1, int(size))
+        self.per_device = max(1, int(per_device))
+        self.queue = Queue.Queue()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.device_slots = {}
+        self.workers = []
+
+    def _get_slot(self, device):
+        with self.lock:
+            slot = self.device_slots.get(device)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_device)
+                self.device_slots[device] = slot
+            return slot
+
+    def _start_workers(self):
+        with self.lock:
+            while len(self.workers) < self.size:
+                worker = GreenThread(self._work)
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+
+    def call(self, device, func, *args):
+        """ Run func(*args) for device in the calling thread.
+        :return The return value of func, None if it raised an exception.
+        """
+        with self._get_slot(device):
+            with self.slots:
+                try:
+                    return func(*args)
+                except Exception:
+                    LOG.exception(_("Task for device %s failed."), device)
+                    return None
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            batch, device, func, args = task
+            batch.finish(device, self.call(device, func, *args))
+
+    def run(self, tasks):
+        """ Run the tasks of the devices in parallel and wait for them.
+        :param tasks. A dict of device -> (func, args).
+        :return A dict of device -> return value of func(*args), None if
+                it raised an exception.
+        """
+        if len(tasks) <= 1 or self.size == 1:
+            return dict((device, self.call(device, func, *args))
+                        for device, (func, args) in tasks.items())
+        self._start_workers()
+        batch = _Batch(len(tasks))
+        for device, (func, args) in tasks.items():
+            self.queue.put((batch, device, func, args))
+        batch.done.wait()
+        return batch.results
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers:
+                self.queue.put(None)
+            self.workers = []
+
+
+class KeyedLock(object):
+    """ A lock for each key, e.g. ('device', '10.0.0.1').
+        acquire() takes the locks of several keys in sorted order, so
+        two callers can never wait for each other in a cycle. A key's
+        lock is dropped when nobody holds or waits for it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [lock, number of holders and waiters]
+        self.locks = {}
+
+    def acquire(self, keys):
+        """ Acquire the locks of keys and return them sorted. """
+        keys = sorted(set(keys))
+        with self.lock:
+            for key in keys:
+                self.locks.setdefault(key, [threading.Lock(), 0])[1] += 1
+        for key in keys:
+            self.locks[key][0].acquire()
+        return keys
+
+    def release(self, keys):
+        with self.lock:
+            for key in reversed(sorted(set(keys))):
+                entry = self.locks[key]
+                entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        keys = self.acquire(keys)
+        try:
+            yield keys
+        finally:
+            self.release(keys)
+
+
+class _PendingItems(object):
+    """ Items submitted to one batch of a Batcher. """
+    def __init__(self):
+        self.items = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class Batcher(object):
+    """ Gathers the items submitted with the same key for window seconds
+        and hands them to flush(items) in one call. The first caller of
+        a batch waits the window and runs flush in its own thread, the
+        others wait for it. Every caller returns once its item is
+        flushed, and raises the exception flush raised, if any.
+    """
+    def __init__(self, window, flush):
+        self.window = window
+        self.flush = flush
+        self.lock = threading.Lock()
+        # key -> _PendingItems still collecting items
+        self.pending = {}
+
+    def submit(self, key, item):
+        with self.lock:
+            batch = self.pending.get(key)
+            is_first = batch is None
+            if is_first:
+                batch = self.pending[key] = _PendingItems()
+            batch.items.append(item)
+        if not is_first:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+        time.sleep(self.window)
+        with self.lock:
+            del self.pending[key]
+        try:
+            self.flush(batch.items)
+        except Exception, e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
@@ -15,9 +15,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 from oslo_log import log as logging
 
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+
 
 LOG = logging.getLogger(__name__)
 
@@ -36,13 +37,32 @@ def get_vlan_commastr(vlan_list):
     return vlans
 
 
-def topology_generator(dev_topology):
-    """ Generate one topology every time.
-    :param spine or leaf topology. Format as following:
+def get_vlan_rangestr(vlan_list):
+    """ Encode VLANs as sorted ranges, e.g. [10, 11, 12, 1000] is
+        "10-12,1000". The order and duplicates of vlan_list do not
+        matter. It is the PermitVlanList format of Comware.
+    """
+    if vlan_list is None:
+        return ""
+    if not isinstance(vlan_list, vlan_bitmap.VlanBitmap):
+        vlan_list = vlan_bitmap.VlanBitmap(vlan_list)
+    return ",".join([str(start) if start == end
+                     else "%d-%d" % (start, end)
+                     for start, end in vlan_list.ranges()])
+
+
+def parse_vlan_str(vlan_str):
+    """ Decode a VLAN string returned by device, like "1,10-12",
+        into a VlanBitmap. Both comma separated ids and ranges are
+        accepted.
     """
-    for dev in dev_topology:
-        for topology in dev['connections']:
-            new_topology = copy.deepcopy(topology)
-            LOG.info(_("Topology owner ip is %s, content is %s."),
-                     dev['ip'], new_topology)
-            yield dev['ip'], new_topology
+    ranges = []
+    if vlan_str is not None:
+        for unit in vlan_str.split(','):
+            if '-' in unit:
+                start, end = unit.split('-', 1)
+                ranges.append((int(start), int(end)))
+            elif unit.strip() != '':
+                vlan_id = int(unit)
+                ranges.append((vlan_id, vlan_id))
+    return vlan_bitmap.VlanBitmap.from_ranges(ranges)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+VLAN_BITS = 4096
+
+# Above this many VLANs, setting characters of a binary string and
+# parsing it once is cheaper than OR-ing a growing integer per VLAN.
+_BULK_THRESHOLD = 64
+_ZEROS = bytearray('0' * VLAN_BITS)
+_ONE = ord('1')
+
+
+def _bits_from_vlans(vlans):
+    vlans = map(int, vlans)
+    if len(vlans) == 0:
+        return 0
+    if min(vlans) < 0 or max(vlans) >= VLAN_BITS:
+        raise ValueError("VLAN id is out of range in %s." % vlans)
+    if len(vlans) <= _BULK_THRESHOLD:
+        bits = 0
+        for vlan_id in vlans:
+            bits |= 1 << vlan_id
+        return bits
+    digits = bytearray(_ZEROS)
+    for vlan_id in vlans:
+        digits[-1 - vlan_id] = _ONE
+    return int(str(digits), 2)
+
+
+class VlanBitmap(object):
+    """ A set of VLAN ids kept as the bits of one integer.
+        Bit n is set when VLAN n is a member. Union, intersection and
+        difference are single integer operations, and iteration yields
+        the VLAN ids in ascending order, so a bitmap can be passed
+        wherever a VLAN list is expected.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, vlans=None, bits=0):
+        self.bits = bits
+        if isinstance(vlans, VlanBitmap):
+            self.bits |= vlans.bits
+        elif vlans is not None:
+            self.bits |= _bits_from_vlans(vlans)
+
+    @staticmethod
+    def _check(vlan_id):
+        vlan_id = int(vlan_id)
+        if vlan_id < 0 or vlan_id >= VLAN_BITS:
+            raise ValueError("VLAN id %d is out of range." % vlan_id)
+        return vlan_id
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """ Return the bitmap of [(start, end), ...], ends included. """
+        digits = bytearray(_ZEROS)
+        for start, end in ranges:
+            if start < 0 or end >= VLAN_BITS:
+                raise ValueError("VLAN range %s-%s is out of range." %
+                                 (start, end))
+            if start == end:
+                digits[start] = _ONE
+            elif start < end:
+                digits[start:end + 1] = '1' * (end - start + 1)
+        return cls(bits=int(str(digits[::-1]), 2))
+
+    @classmethod
+    def from_range(cls, start, end):
+        """ Return the bitmap of VLANs start..end, both included. """
+        start = cls._check(start)
+        end = cls._check(end)
+        if end < start:
+            return cls()
+        return cls(bits=((1 << (end - start + 1)) - 1) << start)
+
+    def add(self, vlan_id):
+        self.bits |= 1 << self._check(vlan_id)
+
+    def discard(self, vlan_id):
+        self.bits &= ~(1 << self._check(vlan_id))
+
+    def copy(self):
+        return VlanBitmap(bits=self.bits)
+
+    def __contains__(self, vlan_id):
+        vlan_id = int(vlan_id)
+        return vlan_id >= 0 and (self.bits >> vlan_id) & 1 == 1
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def __eq__(self, other):
+        return isinstance(other, VlanBitmap) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __or__(self, other):
+        return VlanBitmap(bits=self.bits | other.bits)
+
+    def __and__(self, other):
+        return VlanBitmap(bits=self.bits & other.bits)
+
+    def __sub__(self, other):
+        return VlanBitmap(bits=self.bits & ~other.bits)
+
+    def __xor__(self, other):
+        return VlanBitmap(bits=self.bits ^ other.bits)
+
+    def __ior__(self, other):
+        self.bits |= other.bits
+        return self
+
+    def __iand__(self, other):
+        self.bits &= other.bits
+        return self
+
+    def __isub__(self, other):
+        self.bits &= ~other.bits
+        return self
+
+    def ranges(self):
+        """ Return [(start, end), ...] of the consecutive VLAN runs. """
+        # Least significant bit first, so that VLAN n is digits[n].
+        digits = bin(self.bits)[:1:-1]
+        size = len(digits)
+        result = []
+        start = digits.find('1')
+        while start >= 0:
+            end = digits.find('0', start)
+            if end < 0:
+                end = size
+            result.append((start, end - 1))
+            start = digits.find('1', end)
+        return result
+
+    def to_list(self):
+        return list(self)
+
+    def __repr__(self):
+        return "VlanBitmap(%s)" % ','.join(
+            str(start) if start == end else "%d-%d" % (start, end)
+            for start, end in self.ranges())
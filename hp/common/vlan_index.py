@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from oslo_log import log as logging
+
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+
+LOG = logging.getLogger(__name__)
+
+
+class VlanIndex(object):
+    """ Process local view of which VLANs are used on which hosts.
+        It keeps three maps up to date:
+            host_id -> set of network ids used on it,
+            network_id -> set of hosts using it,
+            (network_id, host_id) -> number of ports.
+        The VLAN of each network is remembered so that the VLAN list of
+        a host can be answered without touching the database. The VLAN
+        bitmap of a host is cached until the networks on it change.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._port_count = {}
+        self._net_hosts = {}
+        self._host_nets = {}
+        self._net_vlan = {}
+        self._host_bitmap = {}
+
+    def load(self, rows):
+        """ Rebuild the index.
+        :param rows. Iterable of (network_id, host_id, vlan_id, port_count)
+                     as returned by db.get_network_host_counts().
+        """
+        with self.lock:
+            self._port_count = {}
+            self._net_hosts = {}
+            self._host_nets = {}
+            self._net_vlan = {}
+            self._host_bitmap = {}
+            for network_id, host_id, vlan_id, count in rows:
+                if count <= 0:
+                    continue
+                self._port_count[(network_id, host_id)] = int(count)
+                self._net_hosts.setdefault(network_id, set()).add(host_id)
+                self._host_nets.setdefault(host_id, set()).add(network_id)
+                if vlan_id is not None:
+                    self._net_vlan[network_id] = int(vlan_id)
+            LOG.info(_("VLAN index loaded with %d (network, host) pairs."),
+                     len(self._port_count))
+
+    def add_port(self, network_id, host_id, vlan_id=None, count=1):
+        """ Account count more ports and return the new port count. """
+        with self.lock:
+            key = (network_id, host_id)
+            count = self._port_count.get(key, 0) + count
+            self._port_count[key] = count
+            self._net_hosts.setdefault(network_id, set()).add(host_id)
+            self._host_nets.setdefault(host_id, set()).add(network_id)
+            if vlan_id is not None:
+                self._net_vlan[network_id] = int(vlan_id)
+            self._host_bitmap.pop(host_id, None)
+            return count
+
+    def remove_port(self, network_id, host_id, count=1):
+        """ Account count ports less and return the remaining port count. """
+        with self.lock:
+            key = (network_id, host_id)
+            count = self._port_count.get(key, 0) - count
+            if count > 0:
+                self._port_count[key] = count
+                return count
+            self._port_count.pop(key, None)
+            self._host_bitmap.pop(host_id, None)
+            hosts = self._net_hosts.get(network_id)
+            if hosts is not None:
+                hosts.discard(host_id)
+                if not hosts:
+                    del self._net_hosts[network_id]
+                    self._net_vlan.pop(network_id, None)
+            nets = self._host_nets.get(host_id)
+            if nets is not None:
+                nets.discard(network_id)
+                if not nets:
+                    del self._host_nets[host_id]
+            return 0
+
+    def get_port_count(self, network_id, host_id):
+        with self.lock:
+            return self._port_count.get((network_id, host_id), 0)
+
+    def get_host_list(self, network_id):
+        with self.lock:
+            return list(self._net_hosts.get(network_id, ()))
+
+    def get_vlan_bitmap_byhost(self, host_id):
+        """ Return the VlanBitmap of host_id. It is shared with the
+            index, callers must not modify it in place.
+        """
+        with self.lock:
+            bitmap = self._host_bitmap.get(host_id)
+            if bitmap is None:
+                bitmap = vlan_bitmap.VlanBitmap()
+                for network_id in self._host_nets.get(host_id, ()):
+                    vlan_id = self._net_vlan.get(network_id)
+                    if vlan_id is not None:
+                        bitmap.add(vlan_id)
+                if host_id in self._host_nets:
+                    self._host_bitmap[host_id] = bitmap
+            return bitmap
+
+    def get_vlanlist_byhost(self, host_id):
+        return self.get_vlan_bitmap_byhost(host_id).to_list()
+
+    def get_host_bitmaps(self):
+        """ Like get_host_vlan(), but the values are the cached
+            VlanBitmaps, which must not be modified in place.
+        """
+        with self.lock:
+            host_bitmaps = {}
+            for host_id in self._host_nets:
+                bitmap = self.get_vlan_bitmap_byhost(host_id)
+                if bitmap:
+                    host_bitmaps[host_id] = bitmap
+            return host_bitmaps
+
+    def get_host_vlan(self):
+        """ Same format as db.get_host_vlan(). """
+        with self.lock:
+            host_vlan = {}
+            for host_id in self._host_nets:
+                vlan_list = self.get_vlanlist_byhost(host_id)
+                if len(vlan_list) > 0:
+                    host_vlan[host_id] = vlan_list
+            return host_vlan
+
+    def diff(self, host_vlan):
+        """ Compare the index with the host VLAN map read from database.
+        :param host_vlan. The result of db.get_host_vlan().
+        :return A dict of host_id -> (vlans only in index,
+                                      vlans only in database).
+                It is empty when the index is consistent.
+        """
+        mine = self.get_host_bitmaps()
+        diffs = {}
+        for host_id in set(mine) | set(host_vlan):
+            in_index = mine.get(host_id, vlan_bitmap.VlanBitmap())
+            in_db = vlan_bitmap.VlanBitmap(host_vlan.get(host_id, []))
+            if in_index != in_db:
+                diffs[host_id] = ((in_index - in_db).to_list(),
+                                  (in_db - in_index).to_list())
+        return diffs
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import socket
+import threading
+import time
+
+from oslo_log import log as logging
+from neutron.plugins.ml2.drivers.hp.common import db
+from neutron.plugins.ml2.drivers.hp.common import mythread
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+from neutron.plugins.ml2.drivers.hp.rpc import circuit_breaker
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_INTERVAL = 5
+DEFAULT_COALESCE_WINDOW = 100
+DEFAULT_LEASE = 300
+
+
+class DeviceQueue(object):
+    """ Durable queue of device configuration.
+        Change sets are stored in table hp_device_ops and the caller
+        returns at once. Each device has a worker thread. A woken worker
+        waits coalesce_window milliseconds for more operations to arrive,
+        then merges all the pending operations of its device in order
+        into one change set and pushes it once, so a burst of port
+        events costs one push per device instead of one per event.
+        A failed push is retried every retry_interval seconds, together
+        with the operations queued meanwhile. After retries attempts the
+        operations are marked failed and on_failure(device_ip) is called,
+        so that a synchronization can repair the device. While the
+        circuit breaker of a device is open, its operations wait without
+        using up attempts. Pending operations left by a previous run are
+        resumed by start().
+        Before a push the worker claims the operations for lease
+        seconds, so that the workers of other neutron servers, or of
+        other processes of this one, leave them alone. The operations
+        of a device claimed by another worker are retried later, in
+        case its claim expires. A synchronization pushes through
+        run_exclusive(), so it does not overwrite newer operations.
+    """
+    def __init__(self, rpc_clients, workers, retries=DEFAULT_RETRIES,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, on_failure=None,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW,
+                 lease=DEFAULT_LEASE):
+        self.rpc_clients = rpc_clients
+        self.workers = workers
+        self.retries = max(1, int(retries))
+        self.retry_interval = retry_interval
+        self.on_failure = on_failure
+        self.coalesce_window = max(0, coalesce_window) / 1000.0
+        self.lease = max(1, int(lease))
+        # Held while the operations of a device are claimed and pushed.
+        self.push_locks = mythread.KeyedLock()
+        self.lock = threading.Lock()
+        # device_ip -> (worker thread, wake up event)
+        self.device_workers = {}
+        self.is_running = False
+        self.stats_lock = threading.Lock()
+        self.stats = {'pushes': 0,
+                      'events': 0,
+                      'max_events_per_push': 0}
+
+    def start(self):
+        self.is_running = True
+        pending = db.get_pending_devices()
+        if len(pending) > 0:
+            LOG.info(_("Resume pending operations of devices %s."),
+                     pending)
+        for device_ip in pending:
+            self._wake(device_ip)
+
+    def stop(self):
+        self.is_running = False
+        with self.lock:
+            for worker, event in self.device_workers.values():
+                event.set()
+            self.device_workers = {}
+
+    def enqueue(self, device_changes):
+        """ Persist the change sets and wake up the device workers.
+        :param device_changes. A dict of device_ip -> DeviceChangeSet.
+        :return The sequence numbers of the queued operations.
+        """
+        ops = [(device_ip, changes.to_dict())
+               for device_ip, changes in sorted(device_changes.items())
+               if not changes.is_empty()]
+        if len(ops) == 0:
+            return []
+        seqs = db.enqueue_device_ops(ops)
+        LOG.info(_("Queued operations %s for devices %s."),
+                 seqs, [device_ip for device_ip, changes in ops])
+        for device_ip, changes in ops:
+            self._wake(device_ip)
+        return seqs
+
+    def get_status(self):
+        """ Return {device_ip: {state: number of operations}}. """
+        return db.get_device_op_stats()
+
+    def get_stats(self):
+        """ Return the number of pushes and of operations merged into
+            them.
+        """
+        with self.stats_lock:
+            stats = dict(self.stats)
+        if stats['pushes'] > 0:
+            stats['events_per_push'] = (float(stats['events']) /
+                                        stats['pushes'])
+        return stats
+
+    def _count_push(self, events):
+        with self.stats_lock:
+            self.stats['pushes'] += 1
+            self.stats['events'] += events
+            if events > self.stats['max_events_per_push']:
+                self.stats['max_events_per_push'] = events
+
+    def _wake(self, device_ip):
+        if not self.is_running:
+            return
+        with self.lock:
+            worker, event = self.device_workers.get(device_ip,
+                                                    (None, None))
+            if worker is None:
+                event = threading.Event()
+                worker = mythread.GreenThread(self._work, device_ip, event)
+                worker.setDaemon(True)
+                self.device_workers[device_ip] = (worker, event)
+                worker.start()
+            event.set()
+
+    def _work(self, device_ip, event):
+        while self.is_running:
+            # Clear before reading, an enqueue after the read wakes us.
+            event.clear()
+            if self.coalesce_window > 0:
+                time.sleep(self.coalesce_window)
+            try:
+                is_drained = self._drain(device_ip)
+            except Exception:
+                LOG.exception(_("Failed to process operations of %s."),
+                              device_ip)
+                is_drained = False
+            if is_drained:
+                event.wait()
+            else:
+                event.wait(self.retry_interval)
+
+    def _get_owner(self):
+        # The process id is read on each claim, as neutron-server may
+        # fork its workers after the driver is initialized.
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def _drain(self, device_ip):
+        """ Apply the pending operations of a device as one push.
+        :return False if the operations are left for a retry.
+        """
+        if not self.is_running:
+            return True
+        if circuit_breaker.is_open(device_ip):
+            count = len(db.get_pending_device_ops(device_ip))
+            if count == 0:
+                return True
+            LOG.debug(_("Device %s is unreachable, %d operations wait."),
+                      device_ip, count)
+            if self.on_failure is not None:
+                self.on_failure(device_ip)
+            return False
+        # The push lock is taken inside the slot of the device, in the
+        # same order as run_exclusive() called by a synchronization.
+        return self.workers.call(device_ip, self._drain_claimed,
+                                 device_ip) is True
+
+    def _drain_claimed(self, device_ip):
+        with self.push_locks.hold([device_ip]):
+            owner = self._get_owner()
+            ops = db.claim_device_ops(device_ip, owner, self.lease)
+            if ops is None:
+                LOG.debug(_("Operations of %s are claimed by another "
+                            "worker."), device_ip)
+                return False
+            if len(ops) == 0:
+                return True
+            return self._process(device_ip, ops, owner)
+
+    def run_exclusive(self, device_ip, after_seq, func, *args):
+        """ Run func(*args), which pushes configuration computed when
+            after_seq was the newest operation, while no operation of
+            the device is pushed by any queue worker. It must be called
+            in the worker slot of the device.
+        :return The return value of func. False without calling it if
+                an operation newer than after_seq has been pushed, as
+                func would overwrite it with older configuration, or if
+                another worker is pushing to the device.
+        """
+        with self.push_locks.hold([device_ip]):
+            owner = self._get_owner()
+            ops = db.claim_device_ops(device_ip, owner, self.lease)
+            if ops is None:
+                LOG.info(_("Operations of %s are pushed by another worker, "
+                           "skip its synchronization."), device_ip)
+                return False
+            try:
+                pushed = db.count_device_ops_pushed_after(device_ip,
+                                                          after_seq)
+                if pushed > 0:
+                    LOG.info(_("%d operations pushed to %s are newer than "
+                               "its synchronization, skip it."),
+                             pushed, device_ip)
+                    return False
+                return func(*args)
+            finally:
+                # The operations left pending are pushed after func.
+                db.release_device_ops([op.seq for op in ops], owner)
+
+    def _update_ops(self, ops, owner, state, attempts, last_error=None):
+        seqs = [op.seq for op in ops]
+        updated = db.update_device_ops(seqs, state, attempts, last_error,
+                                       owner)
+        if updated != len(seqs):
+            LOG.warn(_("Claim of operations %s by %s expired during the "
+                       "push."), seqs, owner)
+
+    def _process(self, device_ip, ops, owner):
+        """ Merge the operations in order and apply them.
+        :return False if they should be retried later.
+        """
+        seqs = [op.seq for op in ops]
+        attempts = max(op.attempts for op in ops) + 1
+        rpc_client = self.rpc_clients.get(device_ip)
+        if rpc_client is None:
+            LOG.warn(_("Drop operations %s, device %s is not in the "
+                       "topology."), seqs, device_ip)
+            self._update_ops(ops, owner, db.OP_FAILED, attempts,
+                             'Device is not in the topology.')
+            return True
+        changes = changeset.DeviceChangeSet()
+        for op in ops:
+            changes.merge(changeset.DeviceChangeSet.from_dict(
+                op.get_changes()))
+        self._count_push(len(ops))
+        try:
+            is_applied = rpc_client.apply(changes) is True
+        except Exception:
+            LOG.exception(_("Failed to apply operations %s to %s."),
+                          seqs, device_ip)
+            is_applied = False
+        if is_applied:
+            LOG.info(_("Operations %s are applied to %s."), seqs, device_ip)
+            self._update_ops(ops, owner, db.OP_DONE, attempts)
+            return True
+        if attempts < self.retries:
+            LOG.warn(_("Operations %s failed on %s, attempt %d of %d."),
+                     seqs, device_ip, attempts, self.retries)
+            self._update_ops(ops, owner, db.OP_PENDING, attempts,
+                             'Failed to apply.')
+            return False
+        LOG.error(_("Operations %s failed on %s after %d attempts."),
+                  seqs, device_ip, attempts)
+        self._update_ops(ops, owner, db.OP_FAILED, attempts,
+                         'Failed to apply.')
+        if self.on_failure is not None:
+            self.on_failure(device_ip)
+        return True
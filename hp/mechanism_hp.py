@@ -15,16 +15,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import os
+import signal
+import threading
+
 from oslo.config import cfg
 from neutron.plugins.ml2 import driver_api
 from oslo_log import log as logging
 from neutron.common import constants as n_const
 
-from neutron.plugins.ml2.drivers.hp.common import tools
 from neutron.plugins.ml2.drivers.hp.common import config
 from neutron.plugins.ml2.drivers.hp.common import db
+from neutron.plugins.ml2.drivers.hp.common import mythread
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+from neutron.plugins.ml2.drivers.hp.common import vlan_index
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+from neutron.plugins.ml2.drivers.hp.rpc import circuit_breaker
+from neutron.plugins.ml2.drivers.hp.rpc import connection_pool
 from neutron.plugins.ml2.drivers.hp.rpc import netconf as netconf_cfg
 from neutron.plugins.ml2.drivers.hp.rpc import restful as restful_cfg
+from neutron.plugins.ml2.drivers.hp import device_queue
 from neutron.plugins.ml2.drivers.hp import sync_helper
 
 
@@ -40,8 +51,11 @@ class HPDriver(driver_api.MechanismDriver):
         config.HPML2Config()
         self.leaf_topology = config.HPML2Config.leaf_topology
         self.spine_topology = config.HPML2Config.spine_topology
+        self.topology = config.HPML2Config.topology
         self.sync_overlap = cfg.CONF.ml2_hp.sync_overlap
-        self.sync_lock = None
+        self.sync_differential = cfg.CONF.ml2_hp.sync_differential
+        # Locks of ('network', id), ('host', id) and ('device', ip).
+        self.locks = mythread.KeyedLock()
         self.sync_timeout = int(cfg.CONF.ml2_hp.sync_time)
         self.username = cfg.CONF.ml2_hp.username
         self.password = cfg.CONF.ml2_hp.password
@@ -50,62 +64,220 @@ class HPDriver(driver_api.MechanismDriver):
         self.rpc_backend = cfg.CONF.ml2_hp.rpc_backend.lower()
         self.sync_helper = None
         self.rpc_clients = {}
+        self.vlan_index = vlan_index.VlanIndex()
+        self.topology_check_interval = \
+            cfg.CONF.ml2_hp.topology_check_interval
+        self.topology_lock = threading.Lock()
+        self.topology_timer = None
+        self.config_mtimes = {}
+        self.prev_sighup_handler = None
+        self.pool_size = cfg.CONF.ml2_hp.connection_pool_size
+        self.idle_timeout = cfg.CONF.ml2_hp.connection_idle_timeout
+        self.session_lease = cfg.CONF.ml2_hp.session_lease_time
+        self.compress_threshold = \
+            cfg.CONF.ml2_hp.rest_compress_threshold
+        self.device_workers = mythread.WorkerPool(
+            cfg.CONF.ml2_hp.device_workers,
+            cfg.CONF.ml2_hp.device_workers_per_device)
+        self.device_queue = None
+        # Ports created or deleted in a network on a host within the
+        # window are handled together by the *_ports_postcommit methods.
+        self.port_batch_window = \
+            max(0, cfg.CONF.ml2_hp.port_batch_window) / 1000.0
+        self.create_batcher = mythread.Batcher(self.port_batch_window,
+                                               self.create_ports_postcommit)
+        self.delete_batcher = mythread.Batcher(self.port_batch_window,
+                                               self.delete_ports_postcommit)
+        circuit_breaker.configure(cfg.CONF.ml2_hp.breaker_failure_threshold,
+                                  cfg.CONF.ml2_hp.breaker_reset_timeout)
 
     def initialize(self):
         """ MechanismDriver will call it after __init__. """
-        if self.rpc_backend == 'netconf':
-            self._create_nc_clients()
-        elif self.rpc_backend == 'restful':
-            self._create_rest_clients()
+        self._create_clients()
         LOG.info(_("leaf %s, spine %s, user %s, pass %s, url schema %s,"
                    "timeout %d, rpc backend %s"),
                  self.leaf_topology, self.spine_topology,
                  self.username, self.password, self.url_schema,
                  self.sync_timeout, self.rpc_backend)
+        self.vlan_index.load(db.get_network_host_counts())
         # Create a thread.for sync configuration to physical device.
-        self.sync_helper = sync_helper.SyncHelper(self.leaf_topology,
-                                                  self.spine_topology,
+        self.sync_helper = sync_helper.SyncHelper(self.topology,
                                                   self.rpc_clients,
                                                   self.sync_timeout,
-                                                  self.sync_overlap)
-        self.sync_lock = self.sync_helper.get_lock()
+                                                  self.sync_overlap,
+                                                  self.vlan_index,
+                                                  self.device_workers,
+                                                  self.locks,
+                                                  self.sync_differential)
+        self.device_queue = device_queue.DeviceQueue(
+            self.rpc_clients, self.device_workers,
+            cfg.CONF.ml2_hp.device_op_retries,
+            cfg.CONF.ml2_hp.device_op_retry_interval,
+            self.sync_helper.mark_failed,
+            cfg.CONF.ml2_hp.coalesce_window,
+            cfg.CONF.ml2_hp.device_op_lease)
+        self.sync_helper.device_queue = self.device_queue
+        self.device_queue.start()
         self.sync_helper.start()
+        self._watch_topology()
+
+    def _get_config_mtimes(self):
+        mtimes = {}
+        for config_file in cfg.CONF.config_file:
+            try:
+                mtimes[config_file] = os.path.getmtime(config_file)
+            except OSError:
+                mtimes[config_file] = None
+        return mtimes
+
+    def _watch_topology(self):
+        """ Reload the topology when SIGHUP is received or the
+            configuration files are modified.
+        """
+        self.config_mtimes = self._get_config_mtimes()
+        if self.topology_check_interval > 0:
+            self.topology_timer = mythread.Timer(self.topology_check_interval)
+            self.topology_timer.start(self.check_topology)
+        try:
+            self.prev_sighup_handler = signal.signal(signal.SIGHUP,
+                                                     self._on_sighup)
+        except ValueError:
+            LOG.warn(_("SIGHUP can only be watched in the main thread, "
+                       "topology is reloaded on file changes only."))
+
+    def _on_sighup(self, signum, frame):
+        reload_thread = mythread.GreenThread(self.reload_topology)
+        reload_thread.setDaemon(True)
+        reload_thread.start()
+        if callable(self.prev_sighup_handler):
+            self.prev_sighup_handler(signum, frame)
+
+    def check_topology(self):
+        """ Reload the topology if the configuration files are changed. """
+        if self._get_config_mtimes() != self.config_mtimes:
+            LOG.info(_("Configuration files are changed."))
+            self.reload_topology()
+
+    def reload_topology(self):
+        """ Parse the leaf and spine topology again. Clients of changed
+            devices are recreated, clients of removed devices are retired,
+            and only the changed devices are synchronized.
+        """
+        with self.topology_lock:
+            self.config_mtimes = self._get_config_mtimes()
+            try:
+                config.HPML2Config()
+            except cfg.Error as err:
+                LOG.error(_("Failed to reload topology: %s"), err)
+                return
+            new_topology = config.HPML2Config.topology
+            changed = self.topology.diff(new_topology)
+            if len(changed) == 0:
+                LOG.info(_("Topology is not changed."))
+                return
+            LOG.info(_("Topology of devices %s is changed."), changed)
+            devices = set(self.topology.devices) | set(new_topology.devices)
+            with self.locks.hold(('device', dev_ip) for dev_ip in devices):
+                self.leaf_topology = config.HPML2Config.leaf_topology
+                self.spine_topology = config.HPML2Config.spine_topology
+                self.topology = new_topology
+                self.sync_helper.topology = new_topology
+                self._retire_clients(changed)
+                self._create_clients(changed)
+            # Uplinks of a changed leaf carry the VLANs of its hosts.
+            sync_devices = set(changed)
+            for leaf_ip in changed:
+                for spine_ip, spine_ports, leaf_ports in \
+                        new_topology.get_leaf_uplinks(leaf_ip):
+                    sync_devices.add(spine_ip)
+            sync_devices &= set(self.rpc_clients)
+            self.sync_helper.sync_devices(sync_devices)
+
+    def check_vlan_index(self, repair=True):
+        """ Compare the in-memory VLAN index with the database.
+        :param repair. Reload the index from database if they differ.
+        :return The differences, see VlanIndex.diff().
+        """
+        diffs = self.vlan_index.diff(db.get_host_vlan())
+        if len(diffs) > 0:
+            LOG.warn(_("VLAN index is inconsistent with database: %s"),
+                     diffs)
+            if repair is True:
+                self.vlan_index.load(db.get_network_host_counts())
+        return diffs
+
+    def _get_lock_keys(self, host_ids):
+        keys = set(('host', host_id) for host_id in host_ids)
+        keys.update(('device', dev_ip) for dev_ip in
+                    self.topology.get_host_devices(host_ids))
+        return keys
+
+    @contextlib.contextmanager
+    def _lock_hosts(self, host_ids):
+        """ Hold the locks of the hosts and the devices connecting to
+            them. Port events of unrelated racks do not wait for each
+            other, even in the same network, while events sharing a
+            device are serialized, since each of them computes the whole
+            permit list of the device ports it touches.
+        """
+        keys = self._get_lock_keys(host_ids)
+        while True:
+            keys = self.locks.acquire(keys)
+            # The topology may have been reloaded while waiting.
+            current = self._get_lock_keys(host_ids)
+            if current.issubset(keys):
+                break
+            self.locks.release(keys)
+            keys = current | set(keys)
+        try:
+            yield
+        finally:
+            self.locks.release(keys)
+
+    def _create_clients(self, devices=None):
+        """ Create RPC clients for the devices, all if devices is None."""
+        if self.rpc_backend == 'netconf':
+            self._create_nc_clients(devices)
+        elif self.rpc_backend == 'restful':
+            self._create_rest_clients(devices)
 
-    def _create_rest_clients(self):
-        """ Create restful instances foreach leaf and spine device."""
-        for leaf in self.leaf_topology:
-            rest_client = restful_cfg.RestfulCfg(leaf['ip'],
-                                                 self.username,
-                                                 self.password)
-            self.rpc_clients.setdefault(leaf['ip'], rest_client)
+    def _retire_clients(self, devices):
+        for dev_ip in devices:
+            rpc_client = self.rpc_clients.pop(dev_ip, None)
+            if hasattr(rpc_client, 'close_session'):
+                rpc_client.close_session()
+            if hasattr(rpc_client, 'close'):
+                rpc_client.close()
 
-        for spine in self.spine_topology:
-            rest_client = restful_cfg.RestfulCfg(spine['ip'],
+    def _create_rest_clients(self, devices=None):
+        """ Create restful instances foreach leaf and spine device."""
+        for dev in self.leaf_topology + self.spine_topology:
+            if devices is not None and dev['ip'] not in devices:
+                continue
+            rest_client = restful_cfg.RestfulCfg(dev['ip'],
                                                  self.username,
-                                                 self.password)
-            self.rpc_clients.setdefault(spine['ip'], rest_client)
+                                                 self.password,
+                                                 self.pool_size,
+                                                 self.idle_timeout,
+                                                 self.compress_threshold)
+            self.rpc_clients.setdefault(dev['ip'], rest_client)
 
-    def _create_nc_clients(self):
+    def _create_nc_clients(self, devices=None):
         """ Create NETCONF instances for each leaf and spine device."""
-        for leaf in self.leaf_topology:
-            if leaf['oem'] == '':
-                leaf['oem'] = self.default_oem
-            nc_client = netconf_cfg.NetConfigClient(leaf['oem'],
-                                                    leaf['ip'],
+        for dev in self.leaf_topology + self.spine_topology:
+            if devices is not None and dev['ip'] not in devices:
+                continue
+            if dev['oem'] == '':
+                dev['oem'] = self.default_oem
+            nc_client = netconf_cfg.NetConfigClient(dev['oem'],
+                                                    dev['ip'],
                                                     self.url_schema,
                                                     self.username,
-                                                    self.password)
-            self.rpc_clients.setdefault(leaf['ip'], nc_client)
-
-        for spine in self.spine_topology:
-            if spine['oem'] == '':
-                spine['oem'] = self.default_oem
-            nc_client = netconf_cfg.NetConfigClient(spine['oem'],
-                                                    spine['ip'],
-                                                    self.url_schema,
-                                                    self.username,
-                                                    self.password)
-            self.rpc_clients.setdefault(spine['ip'], nc_client)
+                                                    self.password,
+                                                    self.pool_size,
+                                                    self.idle_timeout,
+                                                    self.session_lease)
+            self.rpc_clients.setdefault(dev['ip'], nc_client)
 
     def _get_client(self, device_ip):
         """ Return a RPC client instance specified by device IP. """
@@ -132,13 +304,19 @@ class HPDriver(driver_api.MechanismDriver):
         network_id = network['id']
         tenant_id = network['tenant_id']
         segments = context.network_segments
-        if not db.is_network_created(tenant_id, network_id):
-            LOG.info(_("Create network with id %s."), network_id)
-            # [{'segmentation_id': id, 'physical_network': value,
-            # 'id': id, 'network_type': gre | vlan | vxlan }]
-            segment_type = segments[0]['network_type']
-            segment_id = segments[0]['segmentation_id']
-            db.create_network(tenant_id, network_id, segment_id, segment_type)
+        with self.locks.hold([('network', network_id)]), \
+                db.QueryCounter('create_network_postcommit'):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                if not db.is_network_created(tenant_id, network_id,
+                                             session=session):
+                    LOG.info(_("Create network with id %s."), network_id)
+                    # [{'segmentation_id': id, 'physical_network': value,
+                    # 'id': id, 'network_type': gre | vlan | vxlan }]
+                    segment_type = segments[0]['network_type']
+                    segment_id = segments[0]['segmentation_id']
+                    db.create_network(tenant_id, network_id, segment_id,
+                                      segment_type, session=session)
         LOG.info(_("Create network postcommit end."))
 
     def update_network_precommit(self, context):
@@ -156,54 +334,63 @@ class HPDriver(driver_api.MechanismDriver):
         network = context.current
         network_id = network['id']
         tenant_id = network['tenant_id']
-        if db.is_network_created(tenant_id, network_id):
-            LOG.info(_("Delete network %s from database."), network_id)
-            db.delete_network(tenant_id, network_id)
+        with self.locks.hold([('network', network_id)]), \
+                db.QueryCounter('delete_network_postcommit'):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                if db.is_network_created(tenant_id, network_id,
+                                         session=session):
+                    LOG.info(_("Delete network %s from database."),
+                             network_id)
+                    db.delete_network(tenant_id, network_id,
+                                      session=session)
         LOG.info(_("Delete network end."))
 
+    def _collect_leaf_vlans(self, leaf_ip, host_list):
+        """ Return the VlanBitmap of the hosts in host_list connecting
+            to leaf.
+        """
+        leaf_vlans = vlan_bitmap.VlanBitmap()
+        for leaf_host, ports in self.topology.get_leaf_hosts(leaf_ip):
+            if leaf_host in host_list:
+                leaf_vlans |= self.vlan_index.get_vlan_bitmap_byhost(leaf_host)
+        return leaf_vlans
+
     def collect_create_config(self, network_id, host_id, vlan_id):
         device_config_dict = {}
-        vlan_list = db.get_vlanlist_byhost(host_id)
-        if vlan_id not in vlan_list:
-            vlan_list.append(vlan_id)
+        vlan_list = self.vlan_index.get_vlan_bitmap_byhost(host_id).copy()
+        vlan_list.add(vlan_id)
 
-        host_list = db.get_host_list(network_id)
+        host_list = set(self.vlan_index.get_host_list(network_id))
         # Find which leaf device connects to the host_id.
         leaf_need_configure = []
-        leaf_generator = tools.topology_generator(self.leaf_topology)
         leaf_ip_ref = {}
-        for leaf_ip, topology in leaf_generator:
-            leaf_host = topology['host']
-            if leaf_host in host_list:
-                leaf_ip_ref.setdefault(leaf_ip, set([]))
-                leaf_ip_ref[leaf_ip] |= set(db.get_vlanlist_byhost(leaf_host))
-            if leaf_host == host_id:
-                leaf_ip_ref[leaf_ip] |= set([vlan_id])
-                device_config_dict.setdefault(leaf_ip, {})
-                device_config_dict[leaf_ip].setdefault('port_vlan', [])
-                device_config_dict[leaf_ip]['vlan_create'] = vlan_list
-                device_config_dict[leaf_ip]['port_vlan'].\
-                    append((topology['ports'], vlan_list))
-                leaf_need_configure.append(leaf_ip)
+        for leaf_ip, ports in self.topology.get_host_leaves(host_id):
+            leaf_ip_ref[leaf_ip] = self._collect_leaf_vlans(leaf_ip,
+                                                            host_list)
+            leaf_ip_ref[leaf_ip].add(vlan_id)
+            device_config_dict.setdefault(leaf_ip, {})
+            device_config_dict[leaf_ip].setdefault('port_vlan', [])
+            device_config_dict[leaf_ip]['vlan_create'] = vlan_list
+            device_config_dict[leaf_ip]['port_vlan'].\
+                append((ports, vlan_list))
+            leaf_need_configure.append(leaf_ip)
 
         LOG.info(_("Starting collecting spine's configs with leaf %s."),
                  str(leaf_need_configure))
         # Find which spine device connects to the leaf device
         # which is configured above.
-        spine_generator = tools.topology_generator(self.spine_topology)
-        for spine_ip, topology in spine_generator:
-            leaf_ip = topology['leaf_ip']
-            if leaf_ip in leaf_need_configure:
-                spine_vlan_list = list(leaf_ip_ref[leaf_ip])
-                if spine_ip not in device_config_dict:
-                    device_config_dict.setdefault(spine_ip, {})
-                    device_config_dict[spine_ip].setdefault('port_vlan', [])
-                    device_config_dict[spine_ip]['vlan_create'] = vlan_list
-                    device_config_dict[spine_ip]['port_vlan'].\
-                        append((topology['spine_ports'], spine_vlan_list))
-                if leaf_ip in device_config_dict:
-                    device_config_dict[leaf_ip]['port_vlan'].\
-                        append((topology['leaf_ports'], spine_vlan_list))
+        for leaf_ip in leaf_need_configure:
+            spine_vlan_list = leaf_ip_ref[leaf_ip]
+            for spine_ip, spine_ports, leaf_ports in \
+                    self.topology.get_leaf_uplinks(leaf_ip):
+                device_config_dict.setdefault(spine_ip, {})
+                device_config_dict[spine_ip].setdefault('port_vlan', [])
+                device_config_dict[spine_ip]['vlan_create'] = vlan_list
+                device_config_dict[spine_ip]['port_vlan'].\
+                    append((spine_ports, spine_vlan_list))
+                device_config_dict[leaf_ip]['port_vlan'].\
+                    append((leaf_ports, spine_vlan_list))
 
         LOG.info(_("Collect device configuration: %s"), device_config_dict)
 
@@ -212,8 +399,22 @@ class HPDriver(driver_api.MechanismDriver):
     def create_port_precommit(self, context):
         pass
 
+    def _enqueue_config(self, device_config):
+        """ Queue the configuration of each device, the device workers
+            push it in the background.
+        :param device_config. The result of collect_*_config().
+        :return The sequence numbers of the queued operations.
+        """
+        device_changes = {}
+        for dev_ip in device_config:
+            if self._get_client(dev_ip) is not None:
+                device_changes[dev_ip] = \
+                    changeset.DeviceChangeSet.from_config(
+                        device_config[dev_ip])
+        return self.device_queue.enqueue(device_changes)
+
     def _create_vlan_network(self, network_id, host_id, vlan_id):
-        """Do real configuration in our physical devices.
+        """Queue the configuration of the physical devices.
         :param network_id. The uuid of network.
         :param host_id. The host where the port created.
         :param vlan_id. Segmentation ID
@@ -221,24 +422,11 @@ class HPDriver(driver_api.MechanismDriver):
         device_config_list = self.collect_create_config(network_id,
                                                         host_id,
                                                         vlan_id)
-        # Execute configuration in physical devices.
-        for dev_ip in device_config_list:
-            vlan_list = device_config_list[dev_ip]['vlan_create']
-            port_vlan_tuple_list = device_config_list[dev_ip]['port_vlan']
-            rpc_client = self._get_client(dev_ip)
-            if rpc_client is not None:
-                LOG.info(_("Begin create vlan network: device %s, "
-                           "create vlan %s, port trunk list %s"),
-                         dev_ip, vlan_list, port_vlan_tuple_list)
-                result = rpc_client.create_vlan_bulk(vlan_list)
-                if result is True:
-                    result = rpc_client.port_trunk_bulk(port_vlan_tuple_list)
-                    if result is True:
-                        LOG.info(_("Create vlan config successful for"
-                                   " %s."), dev_ip)
-                    LOG.info(_("End create vlan network"))
-                else:
-                    LOG.warn(_("Failed to create vlan network"))
+        # VLANs and trunk permits of a device are sent together.
+        seqs = self._enqueue_config(device_config_list)
+        LOG.info(_("Create vlan network %s queued as operations %s."),
+                 network_id, seqs)
+        return seqs
 
     def create_port_postcommit(self, context):
         """Create network and port on physical device."""
@@ -253,39 +441,51 @@ class HPDriver(driver_api.MechanismDriver):
                      device_owner)
             return
 
-        device_id = port['device_id']
         host_id = context.host
-        port_id = port['id']
-        tenant_id = port['tenant_id']
-        network_id = port['network_id']
+        if self.port_batch_window > 0:
+            self.create_batcher.submit((port['network_id'], host_id),
+                                       context)
+            LOG.info(_("Create port end."))
+            return
+        segments = context.network.network_segments
+        with self._lock_hosts([host_id]), \
+                db.QueryCounter('create_port_postcommit'):
+            LOG.info(_("Insert port %s's information into database."),
+                     str(port['id']))
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                port_count = db.create_vm(port['device_id'], host_id,
+                                          port['id'], port['network_id'],
+                                          port['tenant_id'], session=session)
+            self._port_created(port_count, host_id, port, segments)
+        LOG.info(_("Create port end."))
 
-        with self.sync_lock:
-            if db.is_vm_created(device_id, host_id,
-                                port_id, network_id, tenant_id):
-                LOG.info(_("The port %s of virtual machine %s has "
-                           "already inserted into the network %s."),
-                         str(port_id), str(device_id), str(network_id))
-                return
+    def _port_created(self, port_count, host_id, port, segments):
+        """Update the VLAN index and devices after a port is inserted.
+        :param port_count. The result of db.create_vm().
+        """
+        network_id = port['network_id']
+        if port_count == 0:
+            LOG.info(_("The port %s of virtual machine %s has "
+                       "already inserted into the network %s."),
+                     str(port['id']), str(port['device_id']),
+                     str(network_id))
+            return
 
-            LOG.info(_("Insert port %s's information into database."),
-                     str(port_id))
-
-            db.create_vm(device_id, host_id, port_id, network_id, tenant_id)
-            # Get the count of port that created in the same network and host.
-            port_count = db.get_vm_count(network_id, host_id)
-            if port_count == 1:
-                segments = context.network.network_segments
-                segment_type = segments[0]['network_type']
-                if segment_type == 'vlan':
-                    vlan_id = int(segments[0]['segmentation_id'])
-                    self._create_vlan_network(network_id, host_id, vlan_id)
-                else:
-                    LOG.info(_("Not supported network type %s"), segment_type)
+        segment_type = segments[0]['network_type']
+        vlan_id = None
+        if segment_type == 'vlan':
+            vlan_id = int(segments[0]['segmentation_id'])
+        self.vlan_index.add_port(network_id, host_id, vlan_id)
+        if port_count == 1:
+            if vlan_id is not None:
+                self._create_vlan_network(network_id, host_id, vlan_id)
             else:
-                LOG.info(_("Physical switch has already configured. "
-                           "There are %d VMs in network %s."),
-                         port_count, network_id)
-        LOG.info(_("Create port end."))
+                LOG.info(_("Not supported network type %s"), segment_type)
+        else:
+            LOG.info(_("Physical switch has already configured. "
+                       "There are %d VMs in network %s."),
+                     port_count, network_id)
 
     def update_port_precommit(self, context):
         pass
@@ -305,84 +505,103 @@ class HPDriver(driver_api.MechanismDriver):
         port_id = port['id']
         tenant_id = port['tenant_id']
         network_id = port['network_id']
-        old_host_id = db.get_vm_host(device_id, port_id,
-                                     network_id, tenant_id)
-        if old_host_id is None or old_host_id == context.host:
+        host_id = context.host
+        segments = context.network.network_segments
+        old_host_id = db.get_vm_host(device_id, port_id, network_id,
+                                     tenant_id)
+        if old_host_id is None or old_host_id == host_id:
             LOG.info(_("update port postcommit: No changed."))
             return
-
-        # Migration is happen.
-        LOG.info(_("Migration is begin."))
-        segments = context.network.network_segments
-        self.delete_port(old_host_id, port, segments)
-        self.create_port_postcommit(context)
+        while not self._migrate_port(port, old_host_id, host_id, segments):
+            old_host_id = db.get_vm_host(device_id, port_id, network_id,
+                                         tenant_id)
         LOG.info(_("Migration is end."))
 
+    def _migrate_port(self, port, locked_host_id, host_id, segments):
+        """ Move the port from locked_host_id to host_id.
+        :return False if the port is found on another host meanwhile,
+                the caller should try again with it.
+        """
+        device_id = port['device_id']
+        port_id = port['id']
+        tenant_id = port['tenant_id']
+        network_id = port['network_id']
+        with self._lock_hosts([locked_host_id, host_id]), \
+                db.QueryCounter('update_port_postcommit'):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                old_host_id = db.get_vm_host(device_id, port_id,
+                                             network_id, tenant_id,
+                                             session=session)
+                if old_host_id is None or old_host_id == host_id:
+                    LOG.info(_("update port postcommit: No changed."))
+                    return True
+                if old_host_id != locked_host_id:
+                    return False
+                vm_count = db.delete_vm(device_id, old_host_id, port_id,
+                                        network_id, tenant_id,
+                                        session=session)
+                port_count = db.create_vm(device_id, host_id, port_id,
+                                          network_id, tenant_id,
+                                          session=session)
+
+            # Migration is happen.
+            LOG.info(_("Migration is begin."))
+            self._port_deleted(vm_count, old_host_id, port, segments)
+            self._port_created(port_count, host_id, port, segments)
+        return True
+
+    def _leaf_keeps_vlan(self, leaf_ip, host_id, vlan_id):
+        """ Does any host except host_id on the leaf still use vlan_id? """
+        for leaf_host, ports in self.topology.get_leaf_hosts(leaf_ip):
+            if leaf_host != host_id and vlan_id in \
+                    self.vlan_index.get_vlan_bitmap_byhost(leaf_host):
+                return True
+        return False
+
     def collect_delete_config(self, network_id, host_id, vlan_id):
-        vlan_list = db.get_vlanlist_byhost(host_id)
-        if vlan_id in vlan_list:
-            vlan_list.remove(vlan_id)
-        leaf_generator = tools.topology_generator(self.leaf_topology)
-        host_list = db.get_host_list(network_id)
+        vlan_list = self.vlan_index.get_vlan_bitmap_byhost(host_id).copy()
+        vlan_list.discard(vlan_id)
+        host_list = set(self.vlan_index.get_host_list(network_id))
         LOG.info(_("Delete vlan host list %s"), host_list)
-        # It is the counter of host that connects to the same
-        # device specified by ip address.
         leaf_ref_vlans = {}
-        leaf_ref_host = {}
         delete_config = {}
-        for leaf_ip, topology in leaf_generator:
-            leaf_ref_vlans.setdefault(leaf_ip, set([]))
-            leaf_ref_host.setdefault(leaf_ip, False)
-            host = topology['host']
-            host_vlan = db.get_vlanlist_byhost(host)
-            if host in host_list:
-                leaf_ref_vlans[leaf_ip] |= set(host_vlan)
-            if host == host_id:
-                delete_config.setdefault(leaf_ip, {})
-                delete_config[leaf_ip].setdefault('port_vlan', [])
-                delete_config[leaf_ip]['port_vlan'].\
-                    append((topology['ports'], vlan_list))
-                delete_config[leaf_ip]['vlan_del'] = []
-                if host in host_list:
-                    host_list.remove(host)
-            else:
-                if len(set([vlan_id]) & set(host_vlan)) > 0:
-                    leaf_ref_host[leaf_ip] = True
-
-        # If there is no host connects to leaf in the same network,
-        # we will remove the configuration in the spine device.
-        # And remove the vlan configuration in the leaf device.
-        for leaf_ip in leaf_ref_vlans:
-            if leaf_ref_host[leaf_ip] is False and leaf_ip in delete_config:
-                leaf_ref_vlans[leaf_ip] -= set([vlan_id])
+        for leaf_ip, ports in self.topology.get_host_leaves(host_id):
+            leaf_ref_vlans[leaf_ip] = self._collect_leaf_vlans(leaf_ip,
+                                                               host_list)
+            delete_config.setdefault(leaf_ip, {})
+            delete_config[leaf_ip].setdefault('port_vlan', [])
+            delete_config[leaf_ip]['port_vlan'].append((ports, vlan_list))
+            delete_config[leaf_ip]['vlan_del'] = []
+            # If there is no host connects to leaf in the same network,
+            # we will remove the configuration in the spine device.
+            # And remove the vlan configuration in the leaf device.
+            if not self._leaf_keeps_vlan(leaf_ip, host_id, vlan_id):
+                leaf_ref_vlans[leaf_ip].discard(vlan_id)
                 delete_config[leaf_ip]['vlan_del'] = [vlan_id]
 
         # Check which spine device connects to above leafs.
         # We need remove this spine's configuration.
-        spine_generator = tools.topology_generator(self.spine_topology)
-        # This dict is used to count the host number in same network
-        # with leafs connected to spine.
-        spine_delete_score = {}
-        for spine_ip, topology in spine_generator:
-            leaf_ip = topology['leaf_ip']
-            if leaf_ip in leaf_ref_vlans:
-                spine_delete_score.setdefault(spine_ip, 0)
-                if leaf_ref_host[leaf_ip] is True:
-                    spine_delete_score[spine_ip] += 1
-            if leaf_ip in delete_config:
-                vlan_list = list(leaf_ref_vlans[leaf_ip])
-                delete_config[spine_ip] = {}
+        spine_list = []
+        for leaf_ip in leaf_ref_vlans:
+            vlan_list = leaf_ref_vlans[leaf_ip]
+            for spine_ip, spine_ports, leaf_ports in \
+                    self.topology.get_leaf_uplinks(leaf_ip):
+                delete_config.setdefault(spine_ip, {})
                 delete_config[spine_ip].setdefault('port_vlan', [])
                 delete_config[spine_ip]['port_vlan'].\
-                    append((topology['spine_ports'], vlan_list))
+                    append((spine_ports, vlan_list))
                 delete_config[spine_ip]['vlan_del'] = []
+                spine_list.append(spine_ip)
                 if len(delete_config[leaf_ip]['vlan_del']) != 0:
                     delete_config[leaf_ip]['port_vlan'].\
-                        append((topology['leaf_ports'], vlan_list))
-        # Check does spine need to delete vlan.
-        for spine_ip in spine_delete_score:
-            if spine_delete_score[spine_ip] == 0 \
-                    and spine_ip in delete_config:
+                        append((leaf_ports, vlan_list))
+        # Check does spine need to delete vlan: no leaf connected to
+        # the spine has any other host in the same network.
+        for spine_ip in set(spine_list):
+            spine_leaves = self.topology.get_spine_leaves(spine_ip)
+            if not any(self._leaf_keeps_vlan(leaf_ip, host_id, vlan_id)
+                       for leaf_ip in spine_leaves):
                 delete_config[spine_ip]['vlan_del'] = [vlan_id]
         LOG.info(_("Delete configuration : %s"), delete_config)
         return delete_config
@@ -392,56 +611,162 @@ class HPDriver(driver_api.MechanismDriver):
         delete_config = self.collect_delete_config(network_id,
                                                    host_id,
                                                    vlan_id)
-        for dev_ip in delete_config:
-            rpc_client = self._get_client(dev_ip)
-            port_vlan_tuple_list = delete_config[dev_ip]['port_vlan']
-            vlan_del_list = delete_config[dev_ip]['vlan_del']
-            if rpc_client is not None:
-                if rpc_client.port_trunk_bulk(port_vlan_tuple_list) is True:
-                    if rpc_client.delete_vlan_bulk(vlan_del_list) is True:
-                        LOG.info(_("Delete vlan config %s success for %s."),
-                                 port_vlan_tuple_list, dev_ip)
-                    else:
-                        LOG.warn(_("Failed to delete vlan %s for %s."),
-                                 vlan_del_list, dev_ip)
-                else:
-                    LOG.warn(_("Failed to port trunk %s for %s"),
-                             port_vlan_tuple_list, dev_ip)
+        seqs = self._enqueue_config(delete_config)
+        LOG.info(_("Delete vlan config of network %s queued as "
+                   "operations %s."), network_id, seqs)
+        return seqs
+
+    def get_device_op_status(self):
+        """ Return {device_ip: {state: number of queued operations}}. """
+        return self.device_queue.get_status()
+
+    def get_device_health(self):
+        """ Return {device_ip: circuit breaker state and counters}. """
+        return circuit_breaker.get_stats()
+
+    def get_connection_stats(self):
+        """ Return {'host:port': handshake and byte counters} of the
+            persistent device connections.
+        """
+        return connection_pool.get_stats()
+
+    def get_sync_drift(self):
+        """ Return {device_ip: drift} found by the last synchronization
+            of each device.
+        """
+        return self.sync_helper.get_drift()
+
+    def get_device_op_stats(self):
+        """ Return the number of pushes and queued operations merged
+            into them.
+        """
+        return self.device_queue.get_stats()
 
     def delete_port_precommit(self, context):
         pass
 
+    @staticmethod
+    def _is_vm_port(port):
+        """ Only virtual machine and DHCP server's port are processed. """
+        device_owner = port['device_owner']
+        return (device_owner.startswith('compute') or
+                device_owner == n_const.DEVICE_OWNER_DHCP)
+
+    @staticmethod
+    def _get_vlan_id(segments):
+        if segments[0]['network_type'] == 'vlan':
+            return int(segments[0]['segmentation_id'])
+        return None
+
+    def _collect_bulk_ports(self, contexts, host_id=None):
+        """ Return the vm rows for db.*_vms_bulk() and the segments
+            of their networks.
+        """
+        vms = []
+        net_segments = {}
+        for context in contexts:
+            port = context.current
+            if not self._is_vm_port(port):
+                LOG.info(_("Ignore port owner %s in bulk operation."),
+                         port['device_owner'])
+                continue
+            vms.append({'device_id': port['device_id'],
+                        'host_id': host_id or context.host,
+                        'port_id': port['id'],
+                        'network_id': port['network_id'],
+                        'tenant_id': port['tenant_id']})
+            net_segments[port['network_id']] = \
+                context.network.network_segments
+        return vms, net_segments
+
+    def _lock_vms(self, vms):
+        return self._lock_hosts(set(vm['host_id'] for vm in vms))
+
+    def create_ports_postcommit(self, contexts):
+        """Batched version of create_port_postcommit, which hands it the
+        ports collected within port_batch_window.
+        Ports in the same network and on the same host need only one
+        device computation and one device push.
+        :param contexts. A list of port contexts.
+        """
+        vms, net_segments = self._collect_bulk_ports(contexts)
+        if len(vms) == 0:
+            return
+        LOG.info(_("Create %d ports begin."), len(vms))
+        with self._lock_vms(vms), \
+                db.QueryCounter('create_ports_postcommit'):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                refs = db.create_vms_bulk(vms, session=session)
+            created = []
+            for (network_id, host_id), (before, after) in refs.items():
+                vlan_id = self._get_vlan_id(net_segments[network_id])
+                self.vlan_index.add_port(network_id, host_id, vlan_id,
+                                         count=after - before)
+                if before == 0 and vlan_id is not None:
+                    created.append((network_id, host_id, vlan_id))
+            for network_id, host_id, vlan_id in created:
+                self._create_vlan_network(network_id, host_id, vlan_id)
+        LOG.info(_("Create ports end."))
+
+    def delete_ports_postcommit(self, contexts):
+        """Batched version of delete_port_postcommit.
+        :param contexts. A list of port contexts.
+        """
+        vms, net_segments = self._collect_bulk_ports(contexts)
+        if len(vms) == 0:
+            return
+        LOG.info(_("Delete %d ports begin."), len(vms))
+        with self._lock_vms(vms), \
+                db.QueryCounter('delete_ports_postcommit'):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                refs = db.delete_vms_bulk(vms, session=session)
+            for (network_id, host_id), (before, after) in refs.items():
+                vlan_id = self._get_vlan_id(net_segments[network_id])
+                if after == 0 and vlan_id is not None:
+                    self.delete_vlan_config(network_id, host_id, vlan_id)
+                self.vlan_index.remove_port(network_id, host_id,
+                                            count=before - after)
+        LOG.info(_("Delete ports end."))
+
     def delete_port(self, host_id, ports, segments):
-        with self.sync_lock:
-            network_id = ports['network_id']
-            device_id = ports['device_id']
-            port_id = ports['id']
-            tenant_id = ports['tenant_id']
-            if not db.is_vm_created(device_id, host_id,
-                                    port_id, network_id, tenant_id):
-                LOG.info(_("No such vm in database, ignore it"))
-                return
+        with self._lock_hosts([host_id]):
+            session = db.get_session()
+            with session.begin(subtransactions=True):
+                vm_count = db.delete_vm(ports['device_id'], host_id,
+                                        ports['id'], ports['network_id'],
+                                        ports['tenant_id'], session=session)
+            self._port_deleted(vm_count, host_id, ports, segments)
+
+    def _port_deleted(self, vm_count, host_id, ports, segments):
+        """Update devices and the VLAN index after a port is removed.
+        :param vm_count. The result of db.delete_vm().
+        """
+        network_id = ports['network_id']
+        if vm_count is None:
+            LOG.info(_("No such vm in database, ignore it"))
+            return
 
-            # Delete configuration in device
-            # only if it is the last vm of host in this network
-            vm_count = db.get_vm_count(network_id, host_id)
-            if vm_count == 1:
-                LOG.info(_("Delete physical port configuration: "
-                           "All VMs of host %s in network %s is deleted. "),
-                         host_id, network_id)
-                segment_type = segments[0]['network_type']
-                segment_id = segments[0]['segmentation_id']
-                if segment_type == 'vlan':
-                    vlan_id = int(segment_id)
-                    self.delete_vlan_config(network_id, host_id, vlan_id)
-                else:
-                    LOG.info(_("Not supported network type %s."),
-                             str(segment_type))
+        # Delete configuration in device
+        # only if it is the last vm of host in this network
+        if vm_count == 0:
+            LOG.info(_("Delete physical port configuration: "
+                       "All VMs of host %s in network %s is deleted. "),
+                     host_id, network_id)
+            segment_type = segments[0]['network_type']
+            segment_id = segments[0]['segmentation_id']
+            if segment_type == 'vlan':
+                vlan_id = int(segment_id)
+                self.delete_vlan_config(network_id, host_id, vlan_id)
             else:
-                LOG.info(_("The network %s still have %d vms, "
-                           "ignore this operation."),
-                         network_id, vm_count)
-            db.delete_vm(device_id, host_id, port_id, network_id, tenant_id)
+                LOG.info(_("Not supported network type %s."),
+                         str(segment_type))
+        else:
+            LOG.info(_("The network %s still have %d vms, "
+                       "ignore this operation."),
+                     network_id, vm_count)
+        self.vlan_index.remove_port(network_id, host_id)
 
     def delete_port_postcommit(self, context):
         """Delete real configuration from our physical devices."""
@@ -456,7 +781,13 @@ class HPDriver(driver_api.MechanismDriver):
                      device_owner)
             return
 
+        if self.port_batch_window > 0:
+            self.delete_batcher.submit((port['network_id'], context.host),
+                                       context)
+            LOG.info(_("Delete port post-commit end."))
+            return
         segments = context.network.network_segments
-        self.delete_port(context.host, port, segments)
+        with db.QueryCounter('delete_port_postcommit'):
+            self.delete_port(context.host, port, segments)
 
         LOG.info(_("Delete port post-commit end."))
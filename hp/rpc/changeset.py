@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from neutron.plugins.ml2.drivers.hp.common import tools
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+
+LINK_TYPE_TRUNK = 2
+# The default VLAN can not be removed from a device.
+DEFAULT_VLAN = 1
+
+
+class DeviceChangeSet(object):
+    """ Changes to make on one device, sent in one go.
+        The RPC backends apply them in this order:
+            1. create VLANs,
+            2. change link type of ports,
+            3. set the permitted VLANs of trunk ports,
+            4. remove VLANs,
+        so that a VLAN exists before a port permits it, and is removed
+        only after the ports stop permitting it.
+    """
+    def __init__(self):
+        self.vlan_create = vlan_bitmap.VlanBitmap()
+        # Replace the VLANs of the device with vlan_create.
+        self.overlap = False
+        self.link_type = {}
+        self.trunk_permit = {}
+        self.vlan_remove = vlan_bitmap.VlanBitmap()
+
+    def create_vlans(self, vlans, overlap=False):
+        vlans = vlan_bitmap.VlanBitmap(vlans)
+        self.vlan_create |= vlans
+        self.vlan_remove -= vlans
+        self.overlap = self.overlap or overlap
+
+    def set_link_type(self, ports, link_type=LINK_TYPE_TRUNK):
+        for port in ports:
+            self.link_type[port] = link_type
+
+    def permit_vlans(self, ports, vlans):
+        """ Make ports trunk ports permitting exactly vlans. """
+        vlans = vlan_bitmap.VlanBitmap(vlans)
+        self.set_link_type(ports)
+        for port in ports:
+            self.trunk_permit[port] = vlans
+
+    def remove_vlans(self, vlans):
+        vlans = vlan_bitmap.VlanBitmap(vlans)
+        self.vlan_remove |= vlans
+        self.vlan_create -= vlans
+
+    def merge(self, other):
+        """ Add the changes of other, which are newer than ours. """
+        self.create_vlans(other.vlan_create, other.overlap)
+        self.link_type.update(other.link_type)
+        self.trunk_permit.update(other.trunk_permit)
+        self.remove_vlans(other.vlan_remove)
+        return self
+
+    def is_empty(self):
+        return not (self.vlan_create or self.link_type or
+                    self.trunk_permit or self.vlan_remove)
+
+    def get_trunk_groups(self):
+        """ Return [(ports, VlanBitmap), ...], ports permitting the same
+            VLANs are grouped together.
+        """
+        groups = {}
+        for port in sorted(self.trunk_permit):
+            vlans = self.trunk_permit[port]
+            groups.setdefault(vlans, []).append(port)
+        return [(ports, vlans) for vlans, ports in groups.items()]
+
+    def delta(self, vlans, trunks):
+        """ Compare the change set with the state read from the device.
+        :param vlans. VlanBitmap of the VLANs on the device.
+        :param trunks. A dict of trunk port -> VlanBitmap of the VLANs it
+                       permits. Ports which are not trunks are absent.
+        :return (changes, drift). changes is what remains to do, drift
+                is {'missing_vlans': VlanBitmap, 'extra_vlans': VlanBitmap,
+                'trunk_ports': [port, ...]} of the entries differing from
+                the change set. Extra VLANs are only drift, and removed,
+                if the change set replaces the VLANs of the device.
+        """
+        changes = DeviceChangeSet()
+        missing = self.vlan_create - vlans
+        changes.create_vlans(missing)
+        extra = vlan_bitmap.VlanBitmap()
+        if self.overlap:
+            extra = vlans - self.vlan_create
+            extra.discard(DEFAULT_VLAN)
+            changes.remove_vlans(extra)
+        changes.remove_vlans(self.vlan_remove & vlans)
+        trunk_ports = []
+        for port, permit in sorted(self.trunk_permit.items()):
+            current = trunks.get(str(port))
+            if current is None:
+                changes.set_link_type([port], self.link_type.get(
+                    port, LINK_TYPE_TRUNK))
+            elif current == permit:
+                continue
+            changes.trunk_permit[port] = permit
+            trunk_ports.append(port)
+        for port, link_type in self.link_type.items():
+            if port in self.trunk_permit:
+                continue
+            # Only trunk ports can be told from the state read.
+            if link_type != LINK_TYPE_TRUNK or str(port) not in trunks:
+                changes.set_link_type([port], link_type)
+        return changes, {'missing_vlans': missing,
+                         'extra_vlans': extra,
+                         'trunk_ports': trunk_ports}
+
+    def to_dict(self):
+        """ Return a JSON serializable form of the change set. """
+        return {'vlan_create': tools.get_vlan_rangestr(self.vlan_create),
+                'overlap': self.overlap,
+                'link_type': dict(self.link_type),
+                'trunk_permit': dict((port, tools.get_vlan_rangestr(vlans))
+                                     for port, vlans in
+                                     self.trunk_permit.items()),
+                'vlan_remove': tools.get_vlan_rangestr(self.vlan_remove)}
+
+    @classmethod
+    def from_dict(cls, values):
+        changes = cls()
+        changes.vlan_create = tools.parse_vlan_str(values['vlan_create'])
+        changes.overlap = values['overlap']
+        changes.link_type = dict(values['link_type'])
+        changes.trunk_permit = dict(
+            (port, tools.parse_vlan_str(vlans))
+            for port, vlans in values['trunk_permit'].items())
+        changes.vlan_remove = tools.parse_vlan_str(values['vlan_remove'])
+        return changes
+
+    @classmethod
+    def from_config(cls, dev_config, overlap=False):
+        """ Build the change set of one device in a configuration dict
+            collected by the driver or SyncHelper, i.e. with the keys
+            'vlan_create', 'port_vlan' and 'vlan_del'.
+        """
+        changes = cls()
+        if dev_config.get('vlan_create'):
+            changes.create_vlans(dev_config['vlan_create'], overlap)
+        for ports, vlans in dev_config.get('port_vlan', []):
+            if ports is not None:
+                changes.permit_vlans(ports, vlans)
+        if dev_config.get('vlan_del'):
+            changes.remove_vlans(dev_config['vlan_del'])
+        return changes
+
+    def __repr__(self):
+        return ("DeviceChangeSet(create=%s, link_type=%s, permit=%s, "
+                "remove=%s)" % (self.vlan_create, self.link_type,
+                                self.get_trunk_groups(), self.vlan_remove))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import time
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30
+PROBE_TIMEOUT = 1
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_defaults = {'failure_threshold': DEFAULT_FAILURE_THRESHOLD,
+             'reset_timeout': DEFAULT_RESET_TIMEOUT}
+
+
+class CircuitBreaker(object):
+    """ Health of one device.
+        closed: requests are sent. failure_threshold consecutive
+                connection failures open the breaker.
+        open: requests fail at once, without waiting for a timeout.
+              After reset_timeout seconds the next request first probes
+              the device with a plain TCP connect.
+        half-open: the probe succeeded and one trial request is sent,
+                   others still fail at once. Its success closes the
+                   breaker and its failure opens it again. A trial
+                   which never reports is given up after reset_timeout.
+        Only connection failures count, a device answering with an HTTP
+        error is alive.
+    """
+    def __init__(self, host, port,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.stats = {'opened': 0,
+                      'rejected': 0,
+                      'probes': 0}
+
+    def _probe(self):
+        try:
+            socket.create_connection((self.host, self.port),
+                                     PROBE_TIMEOUT).close()
+            return True
+        except socket.error:
+            return False
+
+    def _open(self):
+        """ The caller must hold self.lock. """
+        if self.state != OPEN:
+            LOG.warn(_("Device %s is unreachable, fail its requests "
+                       "for %d seconds."), self.host, self.reset_timeout)
+            self.stats['opened'] += 1
+        self.state = OPEN
+        self.opened_at = time.time()
+
+    def is_open(self):
+        """ Would a request be rejected now? """
+        with self.lock:
+            return (self.state != CLOSED and
+                    time.time() - self.opened_at < self.reset_timeout)
+
+    def allow(self):
+        """ May a request be sent now? """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout:
+                self.stats['rejected'] += 1
+                return False
+            self.state = HALF_OPEN
+            self.opened_at = time.time()
+            self.stats['probes'] += 1
+        if self._probe():
+            LOG.info(_("Device %s answers a probe, send a trial request."),
+                     self.host)
+            return True
+        with self.lock:
+            self._open()
+            self.stats['rejected'] += 1
+        return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                LOG.info(_("Device %s is reachable again."), self.host)
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self._open()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['state'] = self.state
+            stats['failures'] = self.failures
+            return stats
+
+
+def configure(failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+              reset_timeout=DEFAULT_RESET_TIMEOUT):
+    """ Set the parameters of the breakers created from now on. """
+    with _breakers_lock:
+        _defaults['failure_threshold'] = failure_threshold
+        _defaults['reset_timeout'] = reset_timeout
+
+
+def get_breaker(host, port):
+    """ Return the breaker of a device, it is created on first use and
+        then shared by all the clients and connections of the device.
+        port is the one probed.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, port, **_defaults)
+            _breakers[host] = breaker
+        return breaker
+
+
+def is_open(host):
+    """ Are the requests to host rejected now? """
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+    return breaker is not None and breaker.is_open()
+
+
+def get_stats():
+    """ Return {host: stats} of all breakers. """
+    with _breakers_lock:
+        breakers = _breakers.values()
+    return dict((breaker.host, breaker.get_stats()) for breaker in breakers)
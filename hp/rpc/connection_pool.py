@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+# H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import httplib
+import socket
+import ssl
+import threading
+import time
+import zlib
+from oslo_log import log as logging
+from neutron.plugins.ml2.drivers.hp.rpc import circuit_breaker
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_TIMEOUT = 3
+READ_CHUNK_SIZE = 16384
+# zlib window bits of the gzip format, and of raw deflate data which
+# some servers send for "deflate" instead of the zlib format.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+RAW_DEFLATE_WBITS = -zlib.MAX_WBITS
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class RequestError(Exception):
+    """ A request could not be completed. status and body are set when
+        the device answered with a non 2xx HTTP status.
+    """
+    def __init__(self, message, status=None, body=None):
+        super(RequestError, self).__init__(message)
+        self.status = status
+        self.body = body
+
+
+class _StaleConnection(httplib.HTTPException):
+    """ The device closed the connection before any byte of the
+        response, e.g. after its idle timeout.
+    """
+    pass
+
+
+def _is_stale(err):
+    if isinstance(err, httplib.BadStatusLine):
+        return True
+    # socket.timeout is a socket.error too, but the device may still be
+    # processing the request.
+    return (isinstance(err, socket.error) and
+            not isinstance(err, socket.timeout) and
+            err.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class ConnectionPool(object):
+    """ Persistent HTTP/1.1 connections to one device.
+        At most max_size requests are in flight, each on its own
+        connection. A connection is put back after its response is read
+        and is reused by the next request, so the TCP and TLS handshake
+        is paid once. Connections idle for longer than idle_timeout are
+        closed. A reused connection which the device has closed
+        meanwhile, found by a reset or an empty status line before any
+        byte of the response, is replaced by a new one and the request
+        is sent once more. Other failures, timeouts included, are not
+        retried as the device may have processed the request.
+        Connection failures are reported to the circuit breaker of the
+        device, and while it is open requests fail at once. gzip and
+        deflate responses are decompressed while they are read.
+    """
+    def __init__(self, host, port, schema='https', ssl_context=None,
+                 max_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.schema = schema.lower()
+        self.ssl_context = ssl_context
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.breaker = circuit_breaker.get_breaker(host, port)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        # (last used time, connection), the most recently used is last.
+        self.idle = []
+        self.stats = {'handshakes': 0,
+                      'handshakes_saved': 0,
+                      'reconnects': 0,
+                      'evicted': 0,
+                      'bytes_sent': 0,
+                      'bytes_received': 0,
+                      'bytes_decoded': 0}
+
+    def _new_conn(self):
+        with self.lock:
+            self.stats['handshakes'] += 1
+        if self.schema == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.timeout,
+                                           context=self.ssl_context)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+        return conn
+
+    def _evict(self, now):
+        """ Close idle connections older than idle_timeout.
+            The caller must hold self.lock.
+        """
+        while self.idle and now - self.idle[0][0] > self.idle_timeout:
+            last_used, conn = self.idle.pop(0)
+            conn.close()
+            self.stats['evicted'] += 1
+
+    def _get_conn(self):
+        """ Return (connection, is_reused). """
+        with self.lock:
+            self._evict(time.time())
+            if self.idle:
+                last_used, conn = self.idle.pop()
+                self.stats['handshakes_saved'] += 1
+                return conn, True
+        return self._new_conn(), False
+
+    def _put_conn(self, conn):
+        with self.lock:
+            self.idle.append((time.time(), conn))
+
+    @staticmethod
+    def _read(resp):
+        """ Return (body, number of bytes received).
+            A compressed body is decompressed chunk by chunk as it
+            arrives.
+        """
+        encoding = (resp.getheader('content-encoding') or '').lower()
+        if encoding == 'gzip':
+            decoder = zlib.decompressobj(GZIP_WBITS)
+        elif encoding == 'deflate':
+            decoder = None
+        else:
+            data = resp.read()
+            return data, len(data)
+        received = 0
+        chunks = []
+        while True:
+            chunk = resp.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if decoder is None:
+                # zlib format if it has a valid header, else raw deflate.
+                try:
+                    decoder = zlib.decompressobj()
+                    chunks.append(decoder.decompress(chunk))
+                except zlib.error:
+                    decoder = zlib.decompressobj(RAW_DEFLATE_WBITS)
+                    chunks = [decoder.decompress(chunk)]
+            else:
+                chunks.append(decoder.decompress(chunk))
+            received += len(chunk)
+        if decoder is not None:
+            chunks.append(decoder.flush())
+        return ''.join(chunks), received
+
+    def _send(self, conn, method, path, body, headers):
+        if conn.sock is None:
+            conn.connect()
+            # Requests are small and wait for their response, do not let
+            # Nagle's algorithm hold them back on a kept alive connection.
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+        except (socket.error, httplib.HTTPException), err:
+            if _is_stale(err):
+                raise _StaleConnection(str(err))
+            raise
+        try:
+            data, received = self._read(resp)
+        except zlib.error, err:
+            raise httplib.HTTPException("Invalid %s body: %s" %
+                                        (resp.getheader('content-encoding'),
+                                         err))
+        with self.lock:
+            self.stats['bytes_sent'] += len(body or '')
+            self.stats['bytes_received'] += received
+            self.stats['bytes_decoded'] += len(data)
+        return resp.status, data, resp.will_close
+
+    def request(self, method, path, body=None, headers=None):
+        """ Send a request and return the response body.
+        :raise RequestError. On connection failure or non 2xx status,
+                             or if the circuit breaker is open.
+        """
+        if not self.breaker.allow():
+            raise RequestError("%s:%s is unreachable, request is not sent."
+                               % (self.host, self.port))
+        try:
+            data = self._request(method, path, body, headers or {})
+        except RequestError, err:
+            if err.status is None:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return data
+
+    def _request(self, method, path, body, headers):
+        self.slots.acquire()
+        try:
+            conn, is_reused = self._get_conn()
+            try:
+                status, data, will_close = self._send(conn, method, path,
+                                                      body, headers)
+            except _StaleConnection, err:
+                conn.close()
+                if not is_reused:
+                    raise RequestError("%s:%s %s" % (self.host, self.port,
+                                                     err))
+                LOG.info(_("Connection to %s:%s is broken, reconnect."),
+                         self.host, self.port)
+                with self.lock:
+                    self.stats['reconnects'] += 1
+                    self.stats['handshakes_saved'] -= 1
+                conn = self._new_conn()
+                try:
+                    status, data, will_close = self._send(conn, method, path,
+                                                          body, headers)
+                except (socket.error, ssl.SSLError,
+                        httplib.HTTPException), err:
+                    conn.close()
+                    raise RequestError("%s:%s %s" % (self.host, self.port,
+                                                     err))
+            except (socket.error, ssl.SSLError, httplib.HTTPException), err:
+                conn.close()
+                raise RequestError("%s:%s %s" % (self.host, self.port, err))
+            if will_close:
+                conn.close()
+            else:
+                self._put_conn(conn)
+            if status < 200 or status >= 300:
+                raise RequestError("%s:%s HTTP %d" % (self.host, self.port,
+                                                      status),
+                                   status, data)
+            return data
+        finally:
+            self.slots.release()
+
+    def post(self, path, body, headers=None):
+        return self.request('POST', path, body, headers)
+
+    def close(self):
+        """ Close all idle connections. """
+        with self.lock:
+            for last_used, conn in self.idle:
+                conn.close()
+            self.idle = []
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle'] = len(self.idle)
+            return stats
+
+
+def get_pool(host, port, schema='https', ssl_context=None,
+             max_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+             timeout=DEFAULT_TIMEOUT):
+    """ Return the pool of a device, it is created on first use and then
+        shared by all clients of the device.
+    """
+    key = (schema.lower(), host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(host, port, schema, ssl_context,
+                                  max_size, idle_timeout, timeout)
+            _pools[key] = pool
+        return pool
+
+
+def gzip_encode(data, level=6):
+    """ Return data compressed in the gzip format. """
+    encoder = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+
+def get_stats():
+    """ Return {'host:port': stats} of all pools. """
+    with _pools_lock:
+        pools = _pools.values()
+    return dict(('%s:%s' % (pool.host, pool.port), pool.get_stats())
+                for pool in pools)
@@ -14,12 +14,17 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import urllib2
 import ssl
+import StringIO
+import time
 from string import Template
 from xml.etree import ElementTree
+from xml.sax import saxutils
 from oslo_log import log as logging
 from neutron.plugins.ml2.drivers.hp.common import tools
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+from neutron.plugins.ml2.drivers.hp.rpc import connection_pool
 
 
 LOG = logging.getLogger(__name__)
@@ -222,13 +227,29 @@ NC_LINKTYPE_INTERFACE = """<Interface>
 NC_LINKTYPE = """<Ifmgr>
                  <Interfaces>%s</Interfaces>
                </Ifmgr>"""
+NC_DEVICE_UPTIME = """<Device><Base><Uptime></Uptime></Base></Device>"""
 SOAP_HTTPS_PORT = 832
+SOAP_PATH = '/soap/netconf/'
+# The headers urllib2 used to send, kept for compatibility with devices.
+SOAP_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+INVALID_SESSION = 'Invalid session'
+DEFAULT_SESSION_LEASE = 60
+# Rows read by each get-bulk request of iter_bulk().
+DEFAULT_BULK_COUNT = 200
+NS_RPC = "{urn:ietf:params:xml:ns:netconf:base:1.0}"
+
+
+class BulkReadError(Exception):
+    """ A page of a get-bulk read failed. """
 
 
 class NetConfig(object):
     def __init__(self, oem='hp', ip='127.0.0.1',
-                 schema='https', user_name='', password=''):
-        url = '%s://%s:%d/soap/netconf/' % (schema, ip, SOAP_HTTPS_PORT)
+                 schema='https', user_name='', password='',
+                 pool_size=connection_pool.DEFAULT_POOL_SIZE,
+                 idle_timeout=connection_pool.DEFAULT_IDLE_TIMEOUT,
+                 session_lease=DEFAULT_SESSION_LEASE):
+        url = '%s://%s:%d%s' % (schema, ip, SOAP_HTTPS_PORT, SOAP_PATH)
         self.url = url
         self.oem = oem
         self.message_id = MESSAGE_ID
@@ -237,84 +258,133 @@ class NetConfig(object):
         self.user_name = user_name
         self.password = password
         self.auth_info = None
+        # auth_info is trusted without verification for session_lease
+        # seconds after it was last known to be valid.
+        self.session_lease = session_lease
+        self.session_valid_time = 0
+        # (head, tail) templates -> rendered (head, tail), for the
+        # auth_info in envelope_auth_info.
+        self.envelopes = {}
+        self.envelope_auth_info = None
         self.schema = schema
         if schema.lower() == 'https':
             self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
         else:
             self.ssl_context = None
-
-    def request(self, req_msg):
-        msg = Template(req_msg)
-        MSG = msg.substitute(OEM=self.oem, Language=self.language,
-                             messageid=self.message_id,
-                             AuthInfo=self.auth_info)
+        self.pool = connection_pool.get_pool(ip, SOAP_HTTPS_PORT, schema,
+                                             self.ssl_context,
+                                             max_size=pool_size,
+                                             idle_timeout=idle_timeout)
+
+    def _post(self, msg):
+        """ Send msg over a pooled connection and return the response.
+        :raise connection_pool.RequestError.
+        """
+        return self.pool.post(SOAP_PATH, msg, SOAP_HEADERS)
+
+    @staticmethod
+    def _is_invalid_session(buf):
+        if buf is None or INVALID_SESSION not in buf:
+            return False
+        root = ElementTree.fromstring(buf)
+        for element in root.iter("faultstring"):
+            if element.text == INVALID_SESSION:
+                return True
+        return False
+
+    def _render(self, template):
+        return Template(template).substitute(OEM=self.oem,
+                                             Language=self.language,
+                                             messageid=self.message_id,
+                                             AuthInfo=self.auth_info)
+
+    def _get_envelope(self, head, tail):
+        """ Return head and tail rendered for the current session.
+            They are rendered once per session and template.
+        """
+        if self.envelope_auth_info != self.auth_info:
+            self.envelopes = {}
+            self.envelope_auth_info = self.auth_info
+        envelope = self.envelopes.get((head, tail))
+        if envelope is None:
+            envelope = (self._render(head), self._render(tail))
+            self.envelopes[(head, tail)] = envelope
+        return envelope
+
+    def _request_once(self, head, body='', tail=''):
+        rendered_head, rendered_tail = self._get_envelope(head, tail)
         try:
-            req = urllib2.Request(self.url, MSG)
-            resp = urllib2.urlopen(req, context=self.ssl_context, timeout=3)
-            buf = resp.read()
-            return buf
-        except urllib2.URLError, err:
+            return self._post(''.join((rendered_head, body, rendered_tail)))
+        except connection_pool.RequestError, err:
+            if err.body is not None and INVALID_SESSION in err.body:
+                # The SOAP fault may come with an HTTP error status.
+                return err.body
             LOG.warn(_("Request failed: %s"), err)
+            self.session_valid_time = 0
             return
 
+    def request(self, head, body='', tail=''):
+        """ Send body wrapped in the head and tail envelope templates, in
+            the current session. The body is not a template. If the device
+            does not know the session any more, log in again and send it
+            once more.
+        """
+        buf = self._request_once(head, body, tail)
+        if self._is_invalid_session(buf):
+            LOG.info(_("Session of %s is invalid, log in again."), self.url)
+            self.auth_info = None
+            if self.get_session() is not True:
+                return
+            buf = self._request_once(head, body, tail)
+        if buf is not None and not self._is_invalid_session(buf):
+            self.session_valid_time = time.time()
+        return buf
+
     def close_session(self):
         if self.auth_info is not None:
-            close_template = Template(CLOSE)
-            close_msg = close_template.substitute(AuthInfo=self.auth_info,
-                                                  Language=self.language,
-                                                  messageid=self.message_id)
+            close_msg = self._render(CLOSE)
             try:
-                req = urllib2.Request(self.url, close_msg)
-                resp = urllib2.urlopen(req, context=self.ssl_context)
-                LOG.info("Session %s closed.", resp.read())
-            except urllib2.URLError, err:
+                LOG.info("Session %s closed.", self._post(close_msg))
+            except connection_pool.RequestError, err:
                 LOG.warn(_("Close session failed: %s"), err)
 
     def get_session(self):
         if self.auth_info is not None:
-            verify_msg = self.request(SESSION)
+            if time.time() - self.session_valid_time < self.session_lease:
+                return True
+            verify_msg = self._request_once(SESSION)
             if verify_msg is None:
                 LOG.warn(_("Failed to get session."))
                 return False
-            root = ElementTree.fromstring(verify_msg)
-            valid_session = True
-            for element in root.iter("faultstring"):
-                if element.text == 'Invalid session':
-                    valid_session = False
-                    break
-            if valid_session is True:
+            if not self._is_invalid_session(verify_msg):
                 LOG.info(_("Current authorization info is still in use."))
+                self.session_valid_time = time.time()
                 return True
         LOG.info(_("Get new session with %s"), self.url)
         hello_msg = HELLO % (self.oem, self.user_name, self.password)
-        req_hello = urllib2.Request(self.url, hello_msg)
         try:
-            resp_hello = urllib2.urlopen(req_hello,
-                                         context=self.ssl_context, timeout=3)
-        except urllib2.URLError, err:
-            if hasattr(err, "reason"):
-                LOG.warn(_('Failed to connect server %s, error:%s'),
-                         self.url, err.reason)
-            elif hasattr(err, "code"):
-                LOG.warn('Request failed, error:%s', err.code)
+            buf_hello = self._post(hello_msg)
+        except connection_pool.RequestError, err:
+            if err.status is not None:
+                LOG.warn('Request failed, error:%s', err.status)
             else:
-                LOG.warn("urllib2 error:%s", err)
+                LOG.warn(_('Failed to connect server %s, error:%s'),
+                         self.url, err)
             self.close_session()
             return False
 
-        buf_hello = resp_hello.read()
         root = ElementTree.fromstring(buf_hello)
         ns = NS_HELLO % self.oem
         for auth in root.iter(ns + "AuthInfo"):
             self.auth_info = auth.text
+            self.session_valid_time = time.time()
             break
         return True
 
     def get(self, body, *tags):
         if self.get_session() is not True:
             return
-        get_msg_tmp = GET_HEADER + body + GET_TAIL
-        buf_get = self.request(get_msg_tmp)
+        buf_get = self.request(GET_HEADER, body, GET_TAIL)
         if buf_get is None:
             return
         root = ElementTree.fromstring(buf_get)
@@ -329,8 +399,7 @@ class NetConfig(object):
     def get_bulk(self, body, *tags):
         if self.get_session() is not True:
             return
-        get_msg_tmp = GET_HEADER + body + GET_TAIL
-        buf_get = self.request(get_msg_tmp)
+        buf_get = self.request(GET_BULK_HEADER, body, GET_BULK_TAIL)
         if buf_get is None:
             return
         root = ElementTree.fromstring(buf_get)
@@ -345,8 +414,7 @@ class NetConfig(object):
     def get_next(self, body, *tags):
         if self.get_session() is not True:
             return
-        getall_msg_tmp = GET_BULK_HEADER + body + GET_BULK_TAIL
-        buf_get = self.request(getall_msg_tmp)
+        buf_get = self.request(GET_BULK_HEADER, body, GET_BULK_TAIL)
         if buf_get is None:
             return
         root = ElementTree.fromstring(buf_get)
@@ -358,11 +426,69 @@ class NetConfig(object):
                 break
         return dict_ret
 
+    @staticmethod
+    def _bulk_filter(table, row, columns, count, index):
+        """ Build the get-bulk filter of table, e.g.
+            <VLAN><VLANs base:count="200"><VLANID><ID>10</ID>
+            </VLANID></VLANs></VLAN> reads 200 rows after VLAN 10.
+        """
+        cells = []
+        for column in columns:
+            value = index.get(column, '') if index else ''
+            cells.append('<%s>%s</%s>' % (column, saxutils.escape(value),
+                                          column))
+        body = '<%s>%s</%s>' % (row, ''.join(cells), row)
+        body = '<%s base:count="%d">%s</%s>' % (table[-1], count, body,
+                                                 table[-1])
+        for tag in reversed(table[:-1]):
+            body = '<%s>%s</%s>' % (tag, body, tag)
+        return body
+
+    def _iter_rows(self, buf, row, columns):
+        """ Parse a get-bulk reply incrementally and yield its rows. """
+        row_tag = self.ns_data + row
+        for event, element in ElementTree.iterparse(StringIO.StringIO(buf)):
+            if element.tag == row_tag:
+                yield dict((column, element.findtext(self.ns_data + column))
+                           for column in columns)
+                element.clear()
+            elif element.tag in (NS_RPC + 'rpc-error', 'faultstring'):
+                raise BulkReadError(ElementTree.tostring(element))
+
+    def iter_bulk(self, table, row, index, columns,
+                  count=DEFAULT_BULK_COUNT):
+        """ Read a device table page by page with get-bulk.
+        :param table. Path of the table, e.g. ('VLAN', 'VLANs').
+        :param row. Tag of a row, e.g. 'VLANID'.
+        :param index. Index columns of the table, e.g. ('ID',).
+        :param columns. Columns to read, index columns included.
+        :param count. Rows per request.
+        :return A generator of {column: text}. Only one page is held
+                in memory at a time.
+        :raise BulkReadError. If a page can not be read.
+        """
+        last_row = None
+        while True:
+            if self.get_session() is not True:
+                raise BulkReadError("No session with %s." % self.url)
+            body = self._bulk_filter(table, row, columns, count, last_row)
+            buf = self.request(GET_BULK_HEADER, body, GET_BULK_TAIL)
+            if buf is None:
+                raise BulkReadError("Failed to read %s from %s." %
+                                    ('/'.join(table), self.url))
+            rows = 0
+            for values in self._iter_rows(buf, row, columns):
+                rows += 1
+                last_row = dict((column, values[column])
+                                for column in index)
+                yield values
+            if rows < count:
+                return
+
     def set(self, body):
         if self.get_session() is not True:
             return False
-        set_msg_tmp = EDIT_HEAD + body + EDIT_TAIL
-        result = self.request(set_msg_tmp)
+        result = self.request(EDIT_HEAD, body, EDIT_TAIL)
         if result is not None and "ok/" in result:
             LOG.info(_("Edit config %s success."), body)
             result = True
@@ -375,24 +501,68 @@ class NetConfig(object):
     def execute(self, cmd):
         if self.get_session() is not True:
             return
-        exec_msg_tmp = CLI_EXEC_HEAD + cmd + CLI_EXEC_TAIL
-        return self.request(exec_msg_tmp)
+        return self.request(CLI_EXEC_HEAD, cmd, CLI_EXEC_TAIL)
 
     def config(self, cmd):
         if self.get_session() is not True:
             return
-        self.get_session()
-        conf_msg_tmp = CLI_CONF_HEAD + cmd + CLI_CONF_TAIL
-        return self.request(conf_msg_tmp)
+        return self.request(CLI_CONF_HEAD, cmd, CLI_CONF_TAIL)
 
 
 class NetConfigClient(NetConfig):
-    def __init__(self, oem, ip, schema, user_name, password):
+    def __init__(self, oem, ip, schema, user_name, password,
+                 pool_size=connection_pool.DEFAULT_POOL_SIZE,
+                 idle_timeout=connection_pool.DEFAULT_IDLE_TIMEOUT,
+                 session_lease=DEFAULT_SESSION_LEASE):
         super(NetConfigClient, self).__init__(oem=oem,
                                               ip=ip,
                                               schema=schema,
                                               user_name=user_name,
-                                              password=password)
+                                              password=password,
+                                              pool_size=pool_size,
+                                              idle_timeout=idle_timeout,
+                                              session_lease=session_lease)
+
+    def get_uptime(self):
+        """ Return how many seconds the device has been up, or None. """
+        result = self.get(NC_DEVICE_UPTIME, 'Uptime')
+        if not result or result.get('Uptime') is None:
+            return None
+        return int(result['Uptime'])
+
+    def iter_vlans(self):
+        """ Yield the ids of the VLANs on the device. """
+        for values in self.iter_bulk(('VLAN', 'VLANs'), 'VLANID',
+                                     ('ID',), ('ID',)):
+            yield int(values['ID'])
+
+    def iter_trunk_interfaces(self):
+        """ Yield (ifindex, VlanBitmap of permitted VLANs) of the trunk
+            interfaces on the device.
+        """
+        for values in self.iter_bulk(('VLAN', 'TrunkInterfaces'),
+                                     'Interface', ('IfIndex',),
+                                     ('IfIndex', 'PermitVlanList')):
+            yield (values['IfIndex'],
+                   tools.parse_vlan_str(values['PermitVlanList']))
+
+    def get_state(self):
+        """ Read the VLANs and trunk ports of the device.
+        :return (VlanBitmap of VLANs, {ifindex: VlanBitmap of permitted
+                VLANs}), None if they can not be read.
+        """
+        try:
+            vlans = vlan_bitmap.VlanBitmap(self.iter_vlans())
+            trunks = dict(self.iter_trunk_interfaces())
+        except BulkReadError, err:
+            LOG.warn(_("Failed to read state of %s: %s"), self.url, err)
+            return None
+        return vlans, trunks
+
+    def iter_interfaces(self):
+        """ Yield {'IfIndex', 'Name', 'LinkType'} of the interfaces. """
+        return self.iter_bulk(('Ifmgr', 'Interfaces'), 'Interface',
+                              ('IfIndex',), ('IfIndex', 'Name', 'LinkType'))
 
     def port_link_type_bulk(self, port_list, link_type=2):
         port_link_xml = ""
@@ -443,7 +613,7 @@ class NetConfigClient(NetConfig):
         result = False
         if port is not None:
             self.port_link_type_bulk([port])
-            vlan_str = tools.get_vlan_commastr(vlan_list)
+            vlan_str = tools.get_vlan_rangestr(vlan_list)
             trunk_xml = NC_VLAN_TRUNK % \
                 (NC_TRUNK_INTERFACE % (port, vlan_str))
             result = self.set(trunk_xml)
@@ -451,16 +621,33 @@ class NetConfigClient(NetConfig):
 
     def port_trunk_bulk(self, port_vlan_tuple_list):
         LOG.info(_("Port vlan tuple %s "), port_vlan_tuple_list)
-        trunk_intf_xmls = ""
-        trunk_port_list = []
+        changes = changeset.DeviceChangeSet()
         for (port_list, vlan_list) in port_vlan_tuple_list:
-            vlans = tools.get_vlan_commastr(vlan_list)
-            trunk_port_list.extend(port_list)
-            for port in port_list:
-                trunk_intf_xmls += NC_TRUNK_INTERFACE % (port, vlans)
-        result = True
-        if len(trunk_port_list) > 0:
-            self.port_link_type_bulk(trunk_port_list)
-            trunk_xml = NC_VLAN_TRUNK % trunk_intf_xmls
-            result = self.set(trunk_xml)
-        return result
+            changes.permit_vlans(port_list, vlan_list)
+        return self.apply(changes)
+
+    def apply(self, changes):
+        """ Send a DeviceChangeSet as one edit-config. """
+        units = []
+        if changes.vlan_create:
+            operation = 'replace' if changes.overlap else 'merge'
+            units.append(NC_VLAN_GROUP % (operation, ''.join(
+                [NC_VLAN % vlan_id for vlan_id in changes.vlan_create])))
+        if changes.link_type:
+            units.append(NC_LINKTYPE % ''.join(
+                [NC_LINKTYPE_INTERFACE % (port, link_type)
+                 for port, link_type in sorted(changes.link_type.items())]))
+        if changes.trunk_permit:
+            trunk_intf_xmls = []
+            for ports, vlans in changes.get_trunk_groups():
+                vlan_str = tools.get_vlan_rangestr(vlans)
+                for port in ports:
+                    trunk_intf_xmls.append(NC_TRUNK_INTERFACE %
+                                           (port, vlan_str))
+            units.append(NC_VLAN_TRUNK % ''.join(trunk_intf_xmls))
+        if changes.vlan_remove:
+            units.append(NC_VLAN_GROUP % ('remove', ''.join(
+                [NC_VLAN % vlan_id for vlan_id in changes.vlan_remove])))
+        if len(units) == 0:
+            return True
+        return self.set(''.join(units))
@@ -15,30 +15,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import ssl
-import urllib2
 import base64
 import json
 import re
+import ssl
+import threading
 
 from oslo_log import log
+from neutron.plugins.ml2.drivers.hp.common import mythread
 from neutron.plugins.ml2.drivers.hp.common import tools
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+from neutron.plugins.ml2.drivers.hp.rpc import connection_pool
 
 LOG = log.getLogger(__name__)
 
+HTTPS_PORT = 443
+API_PATH = '/api/v1/'
+HTTP_UNAUTHORIZED = 401
+VLAN_TABLE = 'VLAN/VLANs'
+TRUNK_TABLE = 'VLAN/TrunkInterfaces'
+VLAN_INDEX = 'VLAN/VLANs?index=ID=%s'
+IF_INDEX = 'Ifmgr/Interfaces?index=IfIndex=%s'
+TRUNK_INDEX = 'VLAN/TrunkInterfaces?index=IfIndex=%s'
+
 
 class REST(object):
-    def __init__(self, ip, user, password):
+    """ RESTful session with one device.
+        The token is got on first use and then cached. A request rejected
+        with 401 logs in again and is sent once more. Requests go over the
+        persistent connections of the device, so neither the login nor
+        the TLS handshake is paid per request. One instance is shared by
+        concurrent callers. Request bodies of at least compress_threshold
+        bytes are sent gzip compressed, 0 never compresses.
+    """
+    def __init__(self, ip, user, password,
+                 pool_size=connection_pool.DEFAULT_POOL_SIZE,
+                 idle_timeout=connection_pool.DEFAULT_IDLE_TIMEOUT,
+                 compress_threshold=0):
         self.host = ip
         self.user = user
         self.password = password
         self.token = None
+        self.compress_threshold = compress_threshold
+        self.lock = threading.Lock()
+        self.stats = {'logins': 0,
+                      'requests': 0,
+                      'bytes_compressed': 0,
+                      'bytes_uncompressed': 0}
         self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        self.is_online = self.get_session()
+        self.pool = connection_pool.get_pool(ip, HTTPS_PORT, 'https',
+                                             self.ssl_context,
+                                             max_size=pool_size,
+                                             idle_timeout=idle_timeout)
 
     @property
     def online(self):
-        return self.is_online
+        return self.token is not None or self.get_session()
 
     def fillheader(self, headers):
         headers['Accept-Encoding'] = 'gzip,deflate'
@@ -47,22 +79,8 @@ class REST(object):
         headers['Connection'] = 'Keep-Alive'
         headers['User-Agent'] = 'Apache-HttpClient/4.1.1 (java 1.5)'
 
-    def request(self, url, body, headers, method):
-        req = urllib2.Request(url, data=body, headers=headers)
-        req.get_method = lambda: '%s' % method
-        try:
-            resp = urllib2.urlopen(req, context=self.ssl_context, timeout=3)
-        except urllib2.URLError, e:
-            if hasattr(e, "reason"):
-                LOG.error("%s %s failed, reason:%s" % (method, url, e.reason))
-            elif hasattr(e, "code"):
-                LOG.error("Server couldn't fulfill the request, error:%s" %
-                          e.code)
-            return None
-        buf = resp.read()
-        return buf
-
-    def get_session(self):
+    def _login(self):
+        """ The caller must hold self.lock. """
         headers = {}
         self.fillheader(headers)
         auth_str = "Basic %s" % base64.encodestring("%s:%s" %
@@ -70,78 +88,77 @@ class REST(object):
                                                      self.password))
         headers['Authorization'] = auth_str.strip()
         headers['Content-Length'] = 0
-        url = 'https://%s:443/api/v1//tokens HTTP/1.1' % self.host
-        buf = self.request(url, None, headers, 'POST')
-        if buf is None:
-            LOG.error(_("Get session failed for url %s"), url)
+        self.stats['logins'] += 1
+        try:
+            buf = self.pool.request('POST', API_PATH + 'tokens', None,
+                                    headers)
+        except connection_pool.RequestError, err:
+            LOG.error(_("Get session failed for %s: %s"), self.host, err)
+            self.token = None
             return False
-        token = json.loads(buf)
-        self.token = token['token-id'].encode()
+        self.token = json.loads(buf)['token-id'].encode()
         return True
 
-    def post(self, table, body_dict):
-        headers = {}
-        self.fillheader(headers)
-        headers['X-Auth-Token'] = self.token
+    def get_session(self):
+        with self.lock:
+            return self._login()
 
-        body = json.dumps(body_dict)
-        headers['Content-Length'] = len(body)
-        url = 'https://%s:443/api/v1/%s HTTP/1.1' % (self.host, table)
+    def _refresh_session(self, stale_token):
+        """ Log in again, unless another caller already replaced
+            stale_token meanwhile.
+        """
+        with self.lock:
+            if self.token is not None and self.token != stale_token:
+                return True
+            LOG.info(_("Token of %s is rejected, log in again."), self.host)
+            return self._login()
 
-        req = urllib2.Request(url, data=body, headers=headers)
-        method = 'POST'
-        req.get_method = lambda: '%s' % method
-        try:
-            resp = urllib2.urlopen(req, context=self.ssl_context, timeout=3)
-        except urllib2.URLError, e:
-            if hasattr(e, "reason"):
-                if e.reason == 'Unauthorized':
-                    self.get_session()
-                    headers['X-Auth-Token'] = self.token
-                    self.request(url, body, headers, 'POST')
-                    return
-                else:
-                    LOG.error("%s %s failed, reason:%s" %
-                              (method, url, e.reason))
-            elif hasattr(e, "code"):
-                LOG.error("Server couldn't fulfill the request, error:%s" %
-                          e.code)
-        return
+    def request(self, method, path, body=None):
+        """ Send a request with the cached token and return the response
+            body, or None on failure.
+        """
+        if not self.online:
+            return None
+        encoding = None
+        if (body is not None and self.compress_threshold > 0 and
+                len(body) >= self.compress_threshold):
+            compressed = connection_pool.gzip_encode(body)
+            with self.lock:
+                self.stats['bytes_uncompressed'] += len(body)
+                self.stats['bytes_compressed'] += len(compressed)
+            body = compressed
+            encoding = 'gzip'
+        for attempt in range(2):
+            token = self.token
+            headers = {}
+            self.fillheader(headers)
+            headers['X-Auth-Token'] = token
+            if body is not None:
+                headers['Content-Length'] = len(body)
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+            with self.lock:
+                self.stats['requests'] += 1
+            try:
+                return self.pool.request(method, path, body, headers)
+            except connection_pool.RequestError, err:
+                if (err.status != HTTP_UNAUTHORIZED or attempt > 0 or
+                        not self._refresh_session(token)):
+                    LOG.error(_("%s %s failed, reason:%s"), method, path,
+                              err)
+                    return None
 
-    def set(self, table_index, body, method):
-        headers = {}
-        self.fillheader(headers)
-        headers['X-Auth-Token'] = self.token
-        if body is not None:
-            headers['Content-Length'] = len(body)
+    def post(self, table, body_dict):
+        body = json.dumps(body_dict)
+        return self.request('POST', API_PATH + table, body) is not None
 
+    def set(self, table_index, body, method):
         index = table_index.find('index=') + 6
         table = table_index[index:]
         table = re.sub(r'=', '%3D', table)
         table = re.sub(r';', '%3B', table)
-        url = ('https://%s:443/api/v1/%s HTTP/1.1' %
-               (self.host, (table_index[:index] + table)))
-
-        req = urllib2.Request(url, data=body, headers=headers)
-        req.get_method = lambda: '%s' % method
-        try:
-            resp = urllib2.urlopen(req, context=self.ssl_context, timeout=3)
-        except urllib2.URLError, e:
-            if hasattr(e, "reason"):
-                if e.reason == 'Unauthorized':
-                    self.get_session()
-                    headers['X-Auth-Token'] = self.token
-                    return self.request(url, body, headers, method)
-                else:
-                    LOG.error("%s %s failed, reason:%s" %
-                              (method, url, e.reason))
-            elif hasattr(e, "code"):
-                LOG.error("Server couldn't fulfill the request, Error:%s" %
-                          e.code)
-            return None
-
-        buf = resp.read()
-        return buf
+        return self.request(method, API_PATH + table_index[:index] + table,
+                            body)
 
     def put(self, table_index, body_dict):
         body = json.dumps(body_dict)
@@ -160,59 +177,206 @@ class REST(object):
         buf = self.set(table_index, None, 'GET')
         return buf
 
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
 
 class RestfulCfg(object):
-    def __init__(self, ip_address, user_name, password):
+    """ Configure a device through its RESTful API.
+        Bulk operations read the VLAN table once to skip what is already
+        done, and send their PUTs and DELETEs in parallel over the pooled
+        connections of the device, at most pool_size at a time.
+    """
+    def __init__(self, ip_address, user_name, password,
+                 pool_size=connection_pool.DEFAULT_POOL_SIZE,
+                 idle_timeout=connection_pool.DEFAULT_IDLE_TIMEOUT,
+                 compress_threshold=0):
         self.ip_address = ip_address
         self.user_name = user_name
         self.password = password
+        # One session for all the operations on the device.
+        self.client = REST(ip_address, user_name, password,
+                           pool_size, idle_timeout, compress_threshold)
+        self.concurrency = max(1, pool_size)
+        self.workers = mythread.WorkerPool(self.concurrency)
+
+    def close(self):
+        """ Stop the worker threads, the client must not be used any
+            more.
+        """
+        self.workers.stop()
+
+    def get_uptime(self):
+        """ Return how many seconds the device has been up, or None. """
+        client = self.client
+        if client.online is not True:
+            return None
+        resp_j = client.get('Device/Base')
+        if resp_j is None:
+            return None
+        uptime = json.loads(resp_j).get('Uptime')
+        if uptime is None:
+            return None
+        return int(uptime)
+
+    def get_vlan_table(self, client=None):
+        """ Read the VLAN table with one GET.
+        :return A dict of vlan_id -> VLAN entry, None on failure.
+        """
+        if client is None:
+            client = self.client
+        resp_j = client.get(VLAN_TABLE)
+        if resp_j is None:
+            return None
+        try:
+            table = json.loads(resp_j)
+        except ValueError:
+            LOG.warn(_("Invalid VLAN table from %s"), self.ip_address)
+            return None
+        if isinstance(table, dict):
+            table = table.get('VLANs', [])
+        return dict((int(entry['ID']), entry) for entry in table
+                    if 'ID' in entry)
+
+    def get_trunk_table(self, client=None):
+        """ Read the trunk interfaces with one GET.
+        :return A dict of ifindex -> VlanBitmap of permitted VLANs, None
+                on failure.
+        """
+        if client is None:
+            client = self.client
+        resp_j = client.get(TRUNK_TABLE)
+        if resp_j is None:
+            return None
+        try:
+            table = json.loads(resp_j)
+        except ValueError:
+            LOG.warn(_("Invalid trunk table from %s"), self.ip_address)
+            return None
+        if isinstance(table, dict):
+            table = table.get('TrunkInterfaces', [])
+        return dict((str(entry['IfIndex']),
+                     tools.parse_vlan_str(entry.get('PermitVlanList')))
+                    for entry in table if 'IfIndex' in entry)
+
+    def get_state(self):
+        """ Read the VLANs and trunk ports of the device.
+        :return (VlanBitmap of VLANs, {ifindex: VlanBitmap of permitted
+                VLANs}), None if they can not be read.
+        """
+        if self.client.online is not True:
+            return None
+        vlan_table = self.get_vlan_table()
+        if vlan_table is None:
+            return None
+        trunks = self.get_trunk_table()
+        if trunks is None:
+            return None
+        return vlan_bitmap.VlanBitmap(vlan_table.keys()), trunks
+
+    def run_batch(self, ops, client=None):
+        """ Send the operations, at most self.concurrency at a time.
+        :param ops. A list of (method, table_index, body_dict or None).
+        :return A dict of (method, table_index) -> True if it succeeded.
+        """
+        if client is None:
+            client = self.client
+        results = dict(((method, table_index), False)
+                       for method, table_index, body_dict in ops)
+
+        def run_lane(lane_ops):
+            for method, table_index, body_dict in lane_ops:
+                body = None
+                if body_dict is not None:
+                    body = json.dumps(body_dict)
+                results[(method, table_index)] = \
+                    client.set(table_index, body, method) is not None
+        # Each lane sends its operations one after another on a pooled
+        # connection, the lanes run in parallel.
+        lanes = {}
+        for i, op in enumerate(ops):
+            lanes.setdefault(i % self.concurrency, []).append(op)
+        self.workers.run(dict((lane, (run_lane, (lane_ops,)))
+                              for lane, lane_ops in lanes.items()))
+        return results
+
+    def _check(self, results):
+        """ Log the failed operations of a batch.
+        :return True if all of them succeeded.
+        """
+        failed = sorted(key for key, result in results.items()
+                        if result is not True)
+        for method, table_index in failed:
+            LOG.warn(_("%s %s on %s failed."), method, table_index,
+                     self.ip_address)
+        return len(failed) == 0
+
+    @staticmethod
+    def _create_ops(vlan_list, vlan_table):
+        return [('PUT', VLAN_INDEX % vlan_id, {'ID': vlan_id})
+                for vlan_id in vlan_list
+                if vlan_table is None or vlan_id not in vlan_table]
+
+    @staticmethod
+    def _delete_ops(vlan_list, vlan_table):
+        return [('DELETE', VLAN_INDEX % vlan_id, None)
+                for vlan_id in vlan_list
+                if vlan_table is None or vlan_id in vlan_table]
+
+    @staticmethod
+    def _link_type_ops(if_index_list):
+        return [('PUT', IF_INDEX % if_index,
+                 {'IfIndex': if_index, 'LinkType': 2, 'PortLayer': 1})
+                for if_index in if_index_list]
+
+    @staticmethod
+    def _trunk_ops(port_list, vlan_list):
+        vlans = tools.get_vlan_rangestr(vlan_list)
+        return [('PUT', TRUNK_INDEX % port,
+                 {'IfIndex': port, 'PermitVlanList': vlans})
+                for port in port_list]
 
     def create_vlan_bulk(self, vlan_list, overlap=False):
         LOG.debug(_("Restful: create vlan bulk: vlan list %s, overlap %s"),
                   vlan_list, overlap)
-        client = REST(self.ip_address, self.user_name, self.password)
+        client = self.client
         if client.online is not True:
             LOG.warn(_("Failed to create vlan list %s"), vlan_list)
             return False
-        result = True
-        for vlan_id in vlan_list:
-            if self.create_vlan(vlan_id, client=client) is not True:
-                result = False
-                break
-        return result
+        vlan_table = self.get_vlan_table(client)
+        return self._check(self.run_batch(
+            self._create_ops(vlan_list, vlan_table), client))
 
     def create_vlan(self, vlan_id, client=None):
         if client is None:
-            client = REST(self.ip_address, self.user_name, self.password)
+            client = self.client
         if client.online is not True:
             LOG.warn(_("Failed to create vlan %s"), vlan_id)
             return False
         body_dict = {}
         body_dict['ID'] = vlan_id
-        return client.put('VLAN/VLANs?index=ID=%s' % vlan_id, body_dict)
+        return client.put(VLAN_INDEX % vlan_id, body_dict)
 
     def delete_vlan_bulk(self, vlan_list, client=None):
         if len(vlan_list) == 0:
             return True
         if client is None:
-            client = REST(self.ip_address, self.user_name, self.password)
+            client = self.client
         if client.online is not True:
             LOG.warn(_("Failed to delete vlan %s"), vlan_list)
             return False
-        result = True
-        for vlan_id in vlan_list:
-            if client.delete('VLAN/VLANs?index=ID=%s' % vlan_id) is not True:
-                result = False
-                break
-        return result
+        vlan_table = self.get_vlan_table(client)
+        return self._check(self.run_batch(
+            self._delete_ops(vlan_list, vlan_table), client))
 
     def delete_vlan(self, vlan_id, client=None):
         if client is None:
-            client = REST(self.ip_address, self.user_name, self.password)
+            client = self.client
         if client.online is not True:
             LOG.warn(_("Failed to delete vlan %d"), vlan_id)
             return False
-        resp_j = client.get('VLAN/VLANs?index=ID=%d' % vlan_id)
+        resp_j = client.get(VLAN_INDEX % vlan_id)
         if resp_j is None:
             return False
         resp = json.loads(resp_j)
@@ -220,45 +384,79 @@ class RestfulCfg(object):
         tagged_port_list = resp.get('TaggedPortList')
         if untagged_port_list or tagged_port_list:
             return True
-        return client.delete('VLAN/VLANs?index=ID=%s' % vlan_id)
+        return client.delete(VLAN_INDEX % vlan_id)
+
+    def delete_unused_vlans(self, vlan_list, client=None):
+        """ Delete the VLANs which no port uses, with one GET of the VLAN
+            table instead of one per VLAN as delete_vlan() does.
+        """
+        if client is None:
+            client = self.client
+        if client.online is not True:
+            LOG.warn(_("Failed to delete vlan %s"), vlan_list)
+            return False
+        vlan_table = self.get_vlan_table(client)
+        if vlan_table is None:
+            return False
+        unused = [vlan_id for vlan_id in vlan_list
+                  if vlan_id in vlan_table and
+                  not vlan_table[vlan_id].get('UntaggedPortList') and
+                  not vlan_table[vlan_id].get('TaggedPortList')]
+        return self._check(self.run_batch(
+            self._delete_ops(unused, vlan_table), client))
 
     def port_link_type(self, if_index_list, client=None):
         if client is None:
-            client = REST(self.ip_address, self.user_name, self.password)
+            client = self.client
         if client.online is not True:
             LOG.warn(_("Change port %s link type failed."), if_index_list)
             return False
-        for if_index in if_index_list:
-            body_dict = {}
-            body_dict['IfIndex'] = if_index
-            body_dict['LinkType'] = 2
-            body_dict['PortLayer'] = 1
-            return client.put('Ifmgr/Interfaces?index=IfIndex=%s' %
-                              if_index, body_dict)
+        return self._check(self.run_batch(
+            self._link_type_ops(if_index_list), client))
 
     def port_trunk_bulk(self, port_vlan_tuple_list, client=None):
         if client is None:
-            client = REST(self.ip_address, self.user_name, self.password)
+            client = self.client
         if client.online is not True:
             LOG.warn(_("Failed to set port trunk permit: %s."),
                      port_vlan_tuple_list)
             return False
+        link_type_ports = set()
+        trunk_ops = []
         for port_list, vlan_list in port_vlan_tuple_list:
             if port_list is not None:
-                if self.port_link_type(port_list, client=client) is False:
-                    return False
-                vlans = tools.get_vlan_commastr(vlan_list)
-                for port in port_list:
-                    LOG.debug(_('trunkInterface %s'), port)
-                    body_dict = {}
-                    body_dict['IfIndex'] = port
-                    body_dict['PermitVlanList'] = vlans
-                    result = client.put('VLAN/TrunkInterfaces?'
-                                        'index=IfIndex=%s' % port, body_dict)
-                    if result is False:
-                        return result
+                link_type_ports.update(port_list)
+                trunk_ops.extend(self._trunk_ops(port_list, vlan_list))
             else:
                 LOG.warn(_("Failed to get interface index list "
                            "from device %s with user %s password %s."),
                          self.ip_address, self.user_name, self.password)
-        return True
+        # A port is a trunk before its permitted VLANs are set.
+        if not self._check(self.run_batch(
+                self._link_type_ops(sorted(link_type_ports)), client)):
+            return False
+        return self._check(self.run_batch(trunk_ops, client))
+
+    def apply(self, changes):
+        """ Apply a DeviceChangeSet over one RESTful session.
+            The VLAN table is read once. VLANs are created and ports made
+            trunks in one batch, then the permitted VLANs are set, then
+            VLANs are removed.
+        """
+        client = self.client
+        if client.online is not True:
+            LOG.warn(_("Failed to apply %s."), changes)
+            return False
+        vlan_table = self.get_vlan_table(client)
+        ops = (self._create_ops(changes.vlan_create.to_list(), vlan_table) +
+               self._link_type_ops(sorted(changes.link_type)))
+        if not self._check(self.run_batch(ops, client)):
+            return False
+        ops = []
+        for ports, vlans in changes.get_trunk_groups():
+            ops.extend(self._trunk_ops(ports, vlans))
+        if not self._check(self.run_batch(ops, client)):
+            return False
+        return self._check(self.run_batch(
+            self._delete_ops(changes.vlan_remove.to_list(), vlan_table),
+            client))
@@ -15,105 +15,326 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+import time
+
 from oslo_log import log as logging
-from neutron.plugins.ml2.drivers.hp.common import tools
 from neutron.plugins.ml2.drivers.hp.common import db
 from neutron.plugins.ml2.drivers.hp.common import mythread
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+from neutron.plugins.ml2.drivers.hp.rpc import circuit_breaker
 
 
 LOG = logging.getLogger(__name__)
 
+# Journal entries are kept at least this long, in seconds.
+JOURNAL_MIN_AGE = 3600
+# A journal sequence number missing for this long, in seconds, is taken
+# as a rolled back insert rather than one not committed yet.
+JOURNAL_HOLE_TIMEOUT = 600
+
 
 class SyncHelper(object):
-    def __init__(self, leaf_topology, spine_topology,
-                 rpc_clients, timeout, overlap):
+    def __init__(self, topology, rpc_clients, timeout, overlap,
+                 vlan_index=None, workers=None, locks=None,
+                 differential=False):
         self.timer = mythread.Timer(timeout)
         self.timer_lock = self.timer.get_lock()
         self.overlap = overlap
-        self.leaf_topology = leaf_topology
-        self.spine_topology = spine_topology
+        self.topology = topology
         self.rpc_clients = rpc_clients
+        self.vlan_index = vlan_index
+        if workers is None:
+            workers = mythread.WorkerPool(1)
+        self.workers = workers
+        if locks is None:
+            locks = mythread.KeyedLock()
+        self.locks = locks
+        self.journal_age = max(JOURNAL_MIN_AGE, 2 * int(timeout))
+        # The last journal entry which has been synchronized.
+        # None means a full synchronization is needed.
+        self.checkpoint = None
+        # Sequence numbers up to the checkpoint which were not committed
+        # when they were read -> the time they were first found missing.
+        # They are read again by the next synchronizations.
+        self.journal_holes = {}
+        self.dev_uptime = {}
+        # Devices which failed to synchronize last time, or whose queued
+        # operations failed. The device queue adds to it from its own
+        # threads, so it is guarded by failed_lock.
+        self.failed_lock = threading.Lock()
+        self.failed_devices = set()
+        self.differential = differential
+        # device IP -> drift found by its last differential sync.
+        self.drift = {}
+        # The DeviceQueue of the driver, pushes are serialized with its
+        # operations when it is set.
+        self.device_queue = None
 
     def start(self):
         self.timer.start(self.do_sync)
 
-    def collect_leaf_config(self):
+    def check_vlan_index(self, host_vlan):
+        """ Reload the driver's VLAN index if it drifts from database.
+        :return The host VLAN map to compute configuration from. Once the
+                index agrees with database, its cached VlanBitmaps are
+                returned instead of host_vlan.
+        """
+        if self.vlan_index is None:
+            return host_vlan
+        diffs = self.vlan_index.diff(host_vlan)
+        if len(diffs) > 0:
+            LOG.warn(_("VLAN index is inconsistent with database: %s"),
+                     diffs)
+            self.vlan_index.load(db.get_network_host_counts())
+        return self.vlan_index.get_host_bitmaps()
+
+    def collect_leaf_config(self, host_vlan=None):
+        """ Return the configuration of leaves and the VlanBitmap
+            each leaf carries.
+        """
         leaf_config = {}
-        host_vlan = db.get_host_vlan()
-        leaf_generator = tools.topology_generator(self.leaf_topology)
+        if host_vlan is None:
+            host_vlan = db.get_host_vlan()
         leaf_ref_vlans = {}
-        for leaf_ip, topology in leaf_generator:
-            host_connect = topology['host']
-            if host_connect in host_vlan:
-                leaf_ref_vlans.setdefault(leaf_ip, set([]))
-                vlan_list = host_vlan[host_connect]
-                leaf_ref_vlans[leaf_ip] |= set(vlan_list)
-                leaf_config.setdefault(leaf_ip, {})
-                leaf_config[leaf_ip].setdefault('port_vlan', [])
-                leaf_config[leaf_ip]['port_vlan'].\
-                    append((topology['ports'], vlan_list))
+        for host_connect, vlan_list in host_vlan.items():
+            if isinstance(vlan_list, vlan_bitmap.VlanBitmap):
+                host_vlans = vlan_list
+            else:
+                host_vlans = vlan_bitmap.VlanBitmap(vlan_list)
+            for leaf_ip, ports in self.topology.get_host_leaves(host_connect):
+                if leaf_ip not in leaf_ref_vlans:
+                    leaf_ref_vlans[leaf_ip] = vlan_bitmap.VlanBitmap()
+                    leaf_config[leaf_ip] = {'port_vlan': []}
+                leaf_ref_vlans[leaf_ip] |= host_vlans
+                leaf_config[leaf_ip]['port_vlan'].append((ports, host_vlans))
         for leaf_ip in leaf_ref_vlans:
-            leaf_config[leaf_ip].setdefault('vlan_create', [])
-            leaf_config[leaf_ip]['vlan_create'] = \
-                list(leaf_ref_vlans[leaf_ip])
+            leaf_config[leaf_ip]['vlan_create'] = leaf_ref_vlans[leaf_ip]
         return leaf_config, leaf_ref_vlans
 
     def collect_spine_config(self, leaf_config, leaf_ref_vlans):
-        LOG.info(_("Sync spine configuration, spine topo %s, "
-                   "leaf configured list %s"),
-                 self.spine_topology, leaf_config)
+        LOG.info(_("Sync spine configuration, leaf configured list %s"),
+                 leaf_config)
         dev_config = leaf_config
-        spine_generator = tools.topology_generator(self.spine_topology)
         spine_ref_vlans = {}
-        for spine_ip, topology in spine_generator:
-            leaf_ip = topology['leaf_ip']
-            if leaf_ip in dev_config:
-                vlan_list = list(leaf_ref_vlans[leaf_ip])
-                spine_ref_vlans.setdefault(spine_ip, set([]))
-                spine_ref_vlans[spine_ip] |= leaf_ref_vlans[leaf_ip]
+        for leaf_ip in leaf_ref_vlans:
+            leaf_vlans = leaf_ref_vlans[leaf_ip]
+            for spine_ip, spine_ports, leaf_ports in \
+                    self.topology.get_leaf_uplinks(leaf_ip):
+                if spine_ip not in spine_ref_vlans:
+                    spine_ref_vlans[spine_ip] = vlan_bitmap.VlanBitmap()
+                spine_ref_vlans[spine_ip] |= leaf_vlans
                 dev_config.setdefault(spine_ip, {})
                 dev_config[spine_ip].setdefault('vlan_create', [])
                 dev_config[spine_ip].setdefault('port_vlan', [])
                 dev_config[spine_ip]['port_vlan'].\
-                    append((topology['spine_ports'], vlan_list))
+                    append((spine_ports, leaf_vlans))
                 dev_config[leaf_ip]['port_vlan'].\
-                    append((topology['leaf_ports'], vlan_list))
+                    append((leaf_ports, leaf_vlans))
 
         for spine_ip in spine_ref_vlans:
-            if spine_ip in dev_config:
-                dev_config[spine_ip]['vlan_create'] = \
-                    list(spine_ref_vlans[spine_ip])
+            dev_config[spine_ip]['vlan_create'] = spine_ref_vlans[spine_ip]
         return dev_config
 
+    def find_rebooted_devices(self):
+        """ Return the devices whose uptime goes backwards.
+            Uptimes are read in the worker slots of the devices, as the
+            clients are shared with the pushes.
+        """
+        rebooted = set()
+        tasks = dict((dev_ip, (rpc_client.get_uptime, ()))
+                     for dev_ip, rpc_client in self.rpc_clients.items()
+                     if not circuit_breaker.is_open(dev_ip))
+        for dev_ip, uptime in self.workers.run(tasks).items():
+            if uptime is None:
+                continue
+            last_uptime = self.dev_uptime.get(dev_ip)
+            if last_uptime is not None and uptime < last_uptime:
+                LOG.info(_("Device %s is rebooted."), dev_ip)
+                rebooted.add(dev_ip)
+            self.dev_uptime[dev_ip] = uptime
+        return rebooted
+
+    def _lock_devices(self):
+        """ Hold the locks of all the devices, so that no port event is
+            half done while a snapshot is taken.
+        """
+        return self.locks.hold(('device', dev_ip)
+                               for dev_ip in self.topology.devices)
+
+    def _find_journal_holes(self, seqs, last_seq):
+        """ Find the sequence numbers missing from a journal read.
+        An auto-increment sequence number is allocated at insert time but
+        its row is visible only at commit time, so a transaction of
+        another worker may commit a row below last_seq after it was read.
+        :param seqs: sequence numbers read up to last_seq. When it is the
+                     first synchronization, those of the recent entries.
+        :param last_seq: the new checkpoint.
+        :return The holes to read again, as self.journal_holes.
+        """
+        now = time.time()
+        seen = set(seqs)
+        holes = dict((seq, since) for seq, since
+                     in self.journal_holes.iteritems()
+                     if seq not in seen and
+                     now - since < JOURNAL_HOLE_TIMEOUT)
+        if self.checkpoint is not None:
+            first = self.checkpoint + 1
+        elif len(seen) > 0:
+            first = min(seen)
+        else:
+            first = last_seq + 1
+        for seq in xrange(first, last_seq + 1):
+            if seq not in seen:
+                holes.setdefault(seq, now)
+        if len(holes) > 0:
+            LOG.debug(_("Journal entries %s are not committed yet."),
+                      sorted(holes))
+        return holes
+
     def do_sync(self):
         """When our physical device is reboot,
            it will be used to smooth configuration to device.
+           Only the devices touched by the journal entries since the last
+           synchronization are configured, unless it is the first
+           synchronization or the device is rebooted.
+           Port events wait only while the snapshot of the journal and
+           the host VLANs is taken, not while the devices are pushed.
         """
         LOG.info(_("Synchronizing is start."))
+        rebooted = self.find_rebooted_devices()
         with self.timer_lock:
-            host_vlan = db.get_host_vlan()
-            if len(host_vlan) == 0:
-                LOG.info(_("No objects need sync."))
-                return
-
-            leaf_config, leaf_ref_vlans = self.collect_leaf_config()
-            dev_config = self.collect_spine_config(leaf_config, leaf_ref_vlans)
-            LOG.info(_("Sync device config %s"), dev_config)
-            for dev_ip in dev_config:
-                rpc_client = self.rpc_clients.get(dev_ip, None)
-                if rpc_client is not None:
-                    vlan_list = dev_config[dev_ip]['vlan_create']
-                    port_vlan_tuple_list = dev_config[dev_ip]['port_vlan']
-                    result = rpc_client.create_vlan_bulk(vlan_list,
-                                                         overlap=self.overlap)
-                    if result is True:
-                        rpc_client.port_trunk_bulk(port_vlan_tuple_list)
-                        LOG.info(_("Sync config %s to %s successful"),
-                                 port_vlan_tuple_list, dev_ip)
-                    else:
-                        LOG.warn(_("Failed to sync %s to %s"),
-                                 port_vlan_tuple_list, dev_ip)
+            with self._lock_devices():
+                # The journal is read before the host VLANs, so that the
+                # entries read are committed and in the snapshot too.
+                last_seq = db.get_last_journal_seq()
+                if self.checkpoint is None:
+                    entries = None
+                    seqs = db.get_recent_journal_seqs(JOURNAL_HOLE_TIMEOUT,
+                                                      last_seq)
+                else:
+                    entries = (db.get_journal_entries(self.checkpoint,
+                                                      last_seq) +
+                               db.get_journal_entries_by_seq(
+                                   self.journal_holes.keys()))
+                    seqs = [entry.seq for entry in entries]
+                op_seq = db.get_last_device_op_seq()
+                host_vlan = self.check_vlan_index(db.get_host_vlan())
+            holes = self._find_journal_holes(seqs, last_seq)
+            # Devices failing from now on are left to the next run.
+            with self.failed_lock:
+                failed, self.failed_devices = self.failed_devices, set()
+            if entries is None:
+                sync_devices = None
+            else:
+                hosts = set(entry.host_id for entry in entries)
+                sync_devices = self.topology.get_host_devices(hosts)
+                sync_devices |= rebooted | failed
+                LOG.info(_("%d journal entries since %d, devices to sync "
+                           "%s."), len(entries), self.checkpoint,
+                         sync_devices)
+            try:
+                self.sync_config(host_vlan, sync_devices, op_seq)
+            except Exception:
+                # The journal entries are read again by the next run.
+                with self.failed_lock:
+                    self.failed_devices |= failed
+                raise
+            self.checkpoint = last_seq
+            self.journal_holes = holes
+            db.purge_journal(self.journal_age)
+            db.purge_device_ops(self.journal_age)
         LOG.info(_("Synchronizing is end."))
 
+    def sync_devices(self, devices):
+        """ Synchronize the given devices right now. """
+        LOG.info(_("Synchronizing devices %s."), devices)
+        with self.timer_lock:
+            with self._lock_devices():
+                op_seq = db.get_last_device_op_seq()
+                host_vlan = self.check_vlan_index(db.get_host_vlan())
+            self.sync_config(host_vlan, set(devices), op_seq)
+
+    def sync_config(self, host_vlan, sync_devices=None, op_seq=None):
+        """ Push desired configuration to devices.
+        :param host_vlan. host_id -> VLAN list or VlanBitmap.
+        :param sync_devices. A set of device IPs to push to,
+                             None means all the devices.
+        :param op_seq. The newest queued operation when host_vlan was
+                       read. A device to which a newer operation has
+                       been pushed is left to the next synchronization.
+        :return A dict of device IP -> True if the device is synchronized.
+        """
+        if len(host_vlan) == 0 or sync_devices == set():
+            LOG.info(_("No objects need sync."))
+            return {}
+
+        leaf_config, leaf_ref_vlans = self.collect_leaf_config(host_vlan)
+        dev_config = self.collect_spine_config(leaf_config, leaf_ref_vlans)
+        LOG.info(_("Sync device config %s"), dev_config)
+        tasks = {}
+        dev_changes = {}
+        for dev_ip in dev_config:
+            if sync_devices is not None and dev_ip not in sync_devices:
+                continue
+            rpc_client = self.rpc_clients.get(dev_ip, None)
+            if circuit_breaker.is_open(dev_ip):
+                # Retried by the next synchronization, without waiting
+                # for a timeout now.
+                LOG.warn(_("Device %s is unreachable, skip it."), dev_ip)
+                self.mark_failed(dev_ip)
+            elif rpc_client is not None:
+                changes = changeset.DeviceChangeSet.from_config(
+                    dev_config[dev_ip], overlap=self.overlap)
+                dev_changes[dev_ip] = changes
+                tasks[dev_ip] = (self._push_serialized,
+                                 (dev_ip, rpc_client, changes, op_seq))
+        # Devices are pushed in parallel by the worker pool.
+        results = self.workers.run(tasks)
+        for dev_ip, result in results.items():
+            if result is True:
+                LOG.info(_("Sync config to %s successful"), dev_ip)
+            else:
+                self.mark_failed(dev_ip)
+                LOG.warn(_("Failed to sync %s to %s"),
+                         dev_changes[dev_ip], dev_ip)
+        return results
+
+    def _push_serialized(self, dev_ip, rpc_client, changes, op_seq):
+        if self.device_queue is None or op_seq is None:
+            return self.push_config(dev_ip, rpc_client, changes)
+        return self.device_queue.run_exclusive(dev_ip, op_seq,
+                                               self.push_config, dev_ip,
+                                               rpc_client, changes)
+
+    def push_config(self, dev_ip, rpc_client, changes):
+        """ Push a DeviceChangeSet to a device. With differential
+            synchronization only what differs from the state read from
+            the device is pushed, the whole change set if the state can
+            not be read.
+        :return True if the device is synchronized.
+        """
+        state = None
+        if self.differential and hasattr(rpc_client, 'get_state'):
+            state = rpc_client.get_state()
+        if state is None:
+            return rpc_client.apply(changes)
+        delta, drift = changes.delta(*state)
+        self.drift[dev_ip] = drift
+        if delta.is_empty():
+            LOG.info(_("Device %s is in sync."), dev_ip)
+            return True
+        LOG.warn(_("Device %s drifts: %s, push %s"), dev_ip, drift, delta)
+        return rpc_client.apply(delta)
+
+    def get_drift(self):
+        return dict(self.drift)
+
+    def mark_failed(self, dev_ip):
+        """ Synchronize dev_ip at the next synchronization. """
+        with self.failed_lock:
+            self.failed_devices.add(dev_ip)
+
     def get_lock(self):
         return self.timer_lock
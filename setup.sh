@@ -15,10 +15,16 @@ DEST_DIR="${BASE_DIR}/neutron/plugins/ml2/drivers/"
 echo "Starting setup HP ml2 driver." 
 
 echo "Create table for HP driver. "
-create_table_nets='use neutron; CREATE TABLE hp_related_nets(tenant_id varchar(255) default null, id varchar(36) not null primary key, network_id varchar(36) default null, segmentation_id int(11) default NULL, segmentation_type varchar(12) default NULL);'
-create_table_vms='use neutron; CREATE TABLE hp_related_vms(tenant_id varchar(255) default null, id varchar(36) not null primary key, device_id varchar(255) default NULL, host_id varchar(255) default null, port_id varchar(36) default null, network_id varchar(36) default null);'
+create_table_nets='use neutron; CREATE TABLE hp_related_nets(tenant_id varchar(255) default null, id varchar(36) not null primary key, network_id varchar(36) default null, segmentation_id int(11) default NULL, segmentation_type varchar(12) default NULL, KEY ix_hp_related_nets_network_id_segmentation_type (network_id, segmentation_type));'
+create_table_vms='use neutron; CREATE TABLE hp_related_vms(tenant_id varchar(255) default null, id varchar(36) not null primary key, device_id varchar(255) default NULL, host_id varchar(255) default null, port_id varchar(36) default null, network_id varchar(36) default null, UNIQUE KEY uniq_hp_related_vms0device_id0port_id0network_id0host_id (device_id, port_id, network_id, host_id), KEY ix_hp_related_vms_network_id_host_id (network_id, host_id));'
 mysql -u${sql_root} -p${sql_password} -e "${create_table_nets}"
+create_table_refs='use neutron; CREATE TABLE hp_related_host_refs(network_id varchar(36) not null, host_id varchar(255) not null, ref_count int(11) not null default 0, primary key (network_id, host_id));'
 mysql -u${sql_root} -p${sql_password} -e "${create_table_vms}"
+create_table_journal='use neutron; CREATE TABLE hp_vlan_journal(seq int(11) not null auto_increment primary key, network_id varchar(36) default null, host_id varchar(255) default null, segmentation_id int(11) default null, action varchar(12) default null, created_at datetime default null);'
+mysql -u${sql_root} -p${sql_password} -e "${create_table_refs}"
+mysql -u${sql_root} -p${sql_password} -e "${create_table_journal}"
+create_table_ops='use neutron; CREATE TABLE hp_device_ops(seq int(11) not null auto_increment primary key, device_ip varchar(255) not null, changes text not null, state varchar(12) not null, attempts int(11) not null, last_error varchar(255) default null, owner varchar(255) default null, lease_until datetime default null, created_at datetime default null, updated_at datetime default null, KEY ix_hp_device_ops_device_ip_state (device_ip, state));'
+mysql -u${sql_root} -p${sql_password} -e "${create_table_ops}"
 
 echo "Copy HP driver source code to ${DEST_DIR}"
 cp -ar hp ${DEST_DIR}
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+from neutron.plugins.ml2.drivers.hp.rpc import netconf
+
+
+class DeviceChangeSetTestCase(base.BaseTestCase):
+    """Test cases for the per-device change set."""
+    def test_from_config(self):
+        changes = changeset.DeviceChangeSet.from_config(
+            {'vlan_create': [10, 11],
+             'port_vlan': [(['1', '2'], [10, 11]), (['3'], [11])],
+             'vlan_del': []})
+        self.assertEqual([10, 11], list(changes.vlan_create))
+        self.assertEqual({'1': 2, '2': 2, '3': 2}, changes.link_type)
+        self.assertEqual([(['1', '2'], [10, 11]), (['3'], [11])],
+                         sorted((ports, list(vlans)) for ports, vlans in
+                                changes.get_trunk_groups()))
+
+    def test_merge_later_changes_win(self):
+        first = changeset.DeviceChangeSet()
+        first.create_vlans([10, 20])
+        first.permit_vlans(['1'], [10, 20])
+        second = changeset.DeviceChangeSet()
+        second.permit_vlans(['1'], [10])
+        second.remove_vlans([20])
+        first.merge(second)
+        self.assertEqual([10], list(first.vlan_create))
+        self.assertEqual([20], list(first.vlan_remove))
+        self.assertEqual([10], list(first.trunk_permit['1']))
+
+    def test_dict_round_trip(self):
+        changes = changeset.DeviceChangeSet()
+        changes.create_vlans([10, 11, 12], overlap=True)
+        changes.permit_vlans(['5'], [10, 12])
+        changes.remove_vlans([30])
+        copy = changeset.DeviceChangeSet.from_dict(changes.to_dict())
+        self.assertEqual(changes.to_dict(), copy.to_dict())
+        self.assertTrue(copy.overlap)
+
+    def test_netconf_apply_sends_one_edit(self):
+        with mock.patch.object(netconf.connection_pool, 'get_pool'):
+            client = netconf.NetConfigClient('hp', '10.0.0.1', 'http',
+                                             'user', 'pass')
+        changes = changeset.DeviceChangeSet()
+        changes.create_vlans([10])
+        changes.permit_vlans(['7'], [10])
+        changes.remove_vlans([20])
+        with mock.patch.object(client, 'set', return_value=True) as set_:
+            self.assertTrue(client.apply(changes))
+        self.assertEqual(1, set_.call_count)
+        body = set_.call_args[0][0]
+        create = body.index("operation='merge'")
+        link = body.index('<LinkType>2</LinkType>')
+        permit = body.index('<PermitVlanList>10</PermitVlanList>')
+        remove = body.index("operation='remove'")
+        self.assertTrue(create < link < permit < remove)
+
+    def _desired(self, overlap=False):
+        return changeset.DeviceChangeSet.from_config(
+            {'vlan_create': [10, 11, 12],
+             'port_vlan': [(['1', '2'], [10, 11]), (['3'], [12])]},
+            overlap=overlap)
+
+    def test_delta_in_sync(self):
+        trunks = {'1': vlan_bitmap.VlanBitmap([10, 11]),
+                  '2': vlan_bitmap.VlanBitmap([10, 11]),
+                  '3': vlan_bitmap.VlanBitmap([12])}
+        delta, drift = self._desired().delta(
+            vlan_bitmap.VlanBitmap([1, 10, 11, 12, 99]), trunks)
+        self.assertTrue(delta.is_empty())
+        self.assertEqual([], drift['trunk_ports'])
+        self.assertFalse(drift['missing_vlans'])
+        self.assertFalse(drift['extra_vlans'])
+
+    def test_delta_pushes_only_drift(self):
+        trunks = {'1': vlan_bitmap.VlanBitmap([10, 11]),
+                  '2': vlan_bitmap.VlanBitmap([10])}
+        delta, drift = self._desired().delta(
+            vlan_bitmap.VlanBitmap([1, 10, 11]), trunks)
+        self.assertEqual([12], list(delta.vlan_create))
+        # Port 2 is a trunk permitting too few VLANs, port 3 no trunk.
+        self.assertEqual({'3': 2}, delta.link_type)
+        self.assertEqual(['2', '3'], sorted(delta.trunk_permit))
+        self.assertEqual([10, 11], list(delta.trunk_permit['2']))
+        self.assertEqual(['2', '3'], drift['trunk_ports'])
+        self.assertEqual([12], list(drift['missing_vlans']))
+
+    def test_delta_removes_extra_vlans_on_overlap(self):
+        trunks = {'1': vlan_bitmap.VlanBitmap([10, 11]),
+                  '2': vlan_bitmap.VlanBitmap([10, 11]),
+                  '3': vlan_bitmap.VlanBitmap([12])}
+        vlans = vlan_bitmap.VlanBitmap([1, 10, 11, 12, 99])
+        delta, drift = self._desired(overlap=True).delta(vlans, trunks)
+        self.assertEqual([99], list(delta.vlan_remove))
+        self.assertEqual([99], list(drift['extra_vlans']))
+        self.assertFalse(delta.overlap)
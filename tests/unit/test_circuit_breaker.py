@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.rpc import circuit_breaker
+
+
+class CircuitBreakerTestCase(base.BaseTestCase):
+    """Test cases for the per-device circuit breaker."""
+    def setUp(self):
+        super(CircuitBreakerTestCase, self).setUp()
+        patcher = mock.patch.object(circuit_breaker.time, 'time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.return_value = 1000
+        self.breaker = circuit_breaker.CircuitBreaker('1.1.1.1', 443,
+                                                      failure_threshold=2,
+                                                      reset_timeout=30)
+        self.breaker._probe = mock.Mock(return_value=True)
+
+    def test_open_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker._probe.called)
+        self.assertEqual(1, self.breaker.get_stats()['rejected'])
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(circuit_breaker.CLOSED, self.breaker.state)
+
+    def test_trial_request_after_probe(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.time.return_value = 1031
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(circuit_breaker.HALF_OPEN, self.breaker.state)
+        # Only the trial request is sent until it reports.
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(circuit_breaker.CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker._probe.return_value = False
+        self.time.return_value = 1031
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(circuit_breaker.OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_failed_trial_opens_again(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.time.return_value = 1031
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(circuit_breaker.OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.get_stats()['opened'])
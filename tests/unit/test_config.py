@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import config
+
+
+def _leaf(ip, hosts, oem='hp'):
+    return {'ip': ip, 'oem': oem,
+            'connections': [{'host': host, 'ports': ports}
+                            for host, ports in hosts]}
+
+
+def _spine(ip, leaves, oem='hp'):
+    return {'ip': ip, 'oem': oem,
+            'connections': [{'leaf_ip': leaf_ip,
+                             'spine_ports': spine_ports,
+                             'leaf_ports': leaf_ports}
+                            for leaf_ip, spine_ports, leaf_ports in leaves]}
+
+
+class TopologyTestCase(base.BaseTestCase):
+    """Test cases for the lookup maps of a leaf/spine topology."""
+    def setUp(self):
+        super(TopologyTestCase, self).setUp()
+        # host1 is dual homed to both leaves, each leaf has two spines.
+        self.topology = config.Topology(
+            [_leaf('1.1.1.1', [('host1', ['g1/0/1']),
+                               ('host2', ['g1/0/2', 'g1/0/3'])]),
+             _leaf('1.1.1.2', [('host1', ['g1/0/1'])], oem='h3c')],
+            [_spine('2.2.2.1', [('1.1.1.1', ['g1/0/9'], ['g1/0/49']),
+                                ('1.1.1.2', ['g1/0/10'], ['g1/0/49'])]),
+             _spine('2.2.2.2', [('1.1.1.1', ['g1/0/9'], ['g1/0/50'])])])
+
+    def test_devices(self):
+        self.assertEqual(['1.1.1.1', '1.1.1.2'],
+                         sorted(self.topology.leaves))
+        self.assertEqual(['2.2.2.1', '2.2.2.2'],
+                         sorted(self.topology.spines))
+        self.assertEqual(['1.1.1.1', '1.1.1.2', '2.2.2.1', '2.2.2.2'],
+                         sorted(self.topology.devices))
+
+    def test_host_leaves(self):
+        self.assertEqual([('1.1.1.1', ('g1/0/1',)),
+                          ('1.1.1.2', ('g1/0/1',))],
+                         sorted(self.topology.get_host_leaves('host1')))
+        self.assertEqual((('1.1.1.1', ('g1/0/2', 'g1/0/3')),),
+                         self.topology.get_host_leaves('host2'))
+        self.assertEqual((), self.topology.get_host_leaves('host3'))
+
+    def test_leaf_hosts(self):
+        self.assertEqual([('host1', ('g1/0/1',)),
+                          ('host2', ('g1/0/2', 'g1/0/3'))],
+                         sorted(self.topology.get_leaf_hosts('1.1.1.1')))
+        self.assertEqual((), self.topology.get_leaf_hosts('2.2.2.1'))
+        self.assertEqual((), self.topology.get_leaf_hosts('9.9.9.9'))
+
+    def test_leaf_uplinks(self):
+        self.assertEqual([('2.2.2.1', ('g1/0/9',), ('g1/0/49',)),
+                          ('2.2.2.2', ('g1/0/9',), ('g1/0/50',))],
+                         sorted(self.topology.get_leaf_uplinks('1.1.1.1')))
+        self.assertEqual((('2.2.2.1', ('g1/0/10',), ('g1/0/49',)),),
+                         self.topology.get_leaf_uplinks('1.1.1.2'))
+        self.assertEqual((), self.topology.get_leaf_uplinks('9.9.9.9'))
+
+    def test_spine_leaves(self):
+        self.assertEqual(['1.1.1.1', '1.1.1.2'],
+                         sorted(self.topology.get_spine_leaves('2.2.2.1')))
+        self.assertEqual(('1.1.1.1',),
+                         self.topology.get_spine_leaves('2.2.2.2'))
+        self.assertEqual((), self.topology.get_spine_leaves('1.1.1.1'))
+
+    def test_oem(self):
+        self.assertEqual('hp', self.topology.get_oem('1.1.1.1'))
+        self.assertEqual('h3c', self.topology.get_oem('1.1.1.2'))
+        self.assertIsNone(self.topology.get_oem('9.9.9.9'))
+
+    def test_host_devices(self):
+        self.assertEqual(set(['1.1.1.1', '1.1.1.2', '2.2.2.1', '2.2.2.2']),
+                         self.topology.get_host_devices(['host1']))
+        self.assertEqual(set(['1.1.1.1', '2.2.2.1', '2.2.2.2']),
+                         self.topology.get_host_devices(['host2',
+                                                         'host3']))
+        self.assertEqual(set(), self.topology.get_host_devices(['host3']))
+
+    def test_empty_topology(self):
+        topology = config.Topology([], [])
+        self.assertEqual([], topology.devices)
+        self.assertEqual((), topology.get_host_leaves('host1'))
+        self.assertEqual(set(), topology.get_host_devices(['host1']))
+
+
+class TopologyDiffTestCase(base.BaseTestCase):
+    """Test cases for comparing two topologies."""
+    def setUp(self):
+        super(TopologyDiffTestCase, self).setUp()
+        self.leaves = [_leaf('1.1.1.1', [('host1', ['g1/0/1'])]),
+                       _leaf('1.1.1.2', [('host2', ['g1/0/1'])])]
+        self.spines = [_spine('2.2.2.1',
+                              [('1.1.1.1', ['g1/0/9'], ['g1/0/49']),
+                               ('1.1.1.2', ['g1/0/10'], ['g1/0/49'])])]
+        self.topology = config.Topology(self.leaves, self.spines)
+
+    def test_same_topology(self):
+        other = config.Topology(
+            [_leaf('1.1.1.2', [('host2', ['g1/0/1'])]),
+             _leaf('1.1.1.1', [('host1', ['g1/0/1'])])],
+            self.spines)
+        self.assertEqual(set(), self.topology.diff(other))
+
+    def test_added_and_removed_devices(self):
+        other = config.Topology(
+            [self.leaves[0], _leaf('1.1.1.3', [('host3', ['g1/0/1'])])],
+            [_spine('2.2.2.1', [('1.1.1.1', ['g1/0/9'], ['g1/0/49'])])])
+        # The spine loses its link to the removed leaf.
+        self.assertEqual(set(['1.1.1.2', '1.1.1.3', '2.2.2.1']),
+                         self.topology.diff(other))
+        self.assertEqual(self.topology.diff(other),
+                         other.diff(self.topology))
+
+    def test_oem_changed(self):
+        other = config.Topology(
+            [_leaf('1.1.1.1', [('host1', ['g1/0/1'])], oem='h3c'),
+             self.leaves[1]],
+            self.spines)
+        self.assertEqual(set(['1.1.1.1']), self.topology.diff(other))
+
+    def test_ports_changed(self):
+        other = config.Topology(
+            [_leaf('1.1.1.1', [('host1', ['g1/0/2'])]), self.leaves[1]],
+            [_spine('2.2.2.1',
+                    [('1.1.1.1', ['g1/0/9'], ['g1/0/49']),
+                     ('1.1.1.2', ['g1/0/11'], ['g1/0/49'])])])
+        self.assertEqual(set(['1.1.1.1', '1.1.1.2', '2.2.2.1']),
+                         self.topology.diff(other))
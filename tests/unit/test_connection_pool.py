@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import httplib
+import socket
+import zlib
+
+import mock
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.rpc import connection_pool
+
+
+class ConnectionPoolTestCase(base.BaseTestCase):
+    """Test cases for the persistent device connection pool."""
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        patcher = mock.patch.object(connection_pool.httplib,
+                                    'HTTPConnection')
+        self.conn_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conn_cls.side_effect = self._new_conn
+        self.conns = []
+        self.pool = connection_pool.ConnectionPool('10.0.0.1', 832,
+                                                   schema='http')
+
+    def _new_conn(self, *args, **kwargs):
+        conn = mock.Mock()
+        resp = conn.getresponse.return_value
+        resp.status = 200
+        resp.read.return_value = '<ok/>'
+        resp.will_close = False
+        resp.getheader.return_value = None
+        self.conns.append(conn)
+        return conn
+
+    def test_connection_is_reused(self):
+        for i in range(3):
+            self.assertEqual('<ok/>', self.pool.post('/soap', 'msg'))
+        self.assertEqual(1, len(self.conns))
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['handshakes'])
+        self.assertEqual(2, stats['handshakes_saved'])
+
+    def test_idle_connection_is_evicted(self):
+        self.pool.idle_timeout = 0
+        self.pool.post('/soap', 'msg')
+        with mock.patch.object(connection_pool.time, 'time',
+                               return_value=10 ** 10):
+            self.pool.post('/soap', 'msg')
+        self.assertEqual(2, len(self.conns))
+        self.assertTrue(self.conns[0].close.called)
+        self.assertEqual(1, self.pool.get_stats()['evicted'])
+
+    def test_broken_connection_is_replaced(self):
+        self.pool.post('/soap', 'msg')
+        self.conns[0].request.side_effect = socket.error(
+            errno.ECONNRESET, 'Connection reset by peer')
+        self.assertEqual('<ok/>', self.pool.post('/soap', 'msg'))
+        self.conns[1].getresponse.side_effect = httplib.BadStatusLine('')
+        self.assertEqual('<ok/>', self.pool.post('/soap', 'msg'))
+        self.assertEqual(3, len(self.conns))
+        self.assertEqual(2, self.pool.get_stats()['reconnects'])
+
+    def test_new_connection_is_not_retried(self):
+        self.conn_cls.side_effect = None
+        conn = self.conn_cls.return_value
+        conn.request.side_effect = socket.error(errno.EPIPE, 'Broken pipe')
+        self.assertRaises(connection_pool.RequestError,
+                          self.pool.post, '/soap', 'msg')
+        self.assertEqual(1, conn.request.call_count)
+
+    def test_timeout_is_not_retried(self):
+        self.pool.post('/soap', 'msg')
+        self.conns[0].getresponse.side_effect = socket.timeout('timed out')
+        self.assertRaises(connection_pool.RequestError,
+                          self.pool.post, '/soap', 'msg')
+        self.assertEqual(1, len(self.conns))
+        self.assertTrue(self.conns[0].close.called)
+        self.assertEqual(0, self.pool.get_stats()['reconnects'])
+
+    def test_failure_after_response_is_not_retried(self):
+        self.pool.post('/soap', 'msg')
+        resp = self.conns[0].getresponse.return_value
+        resp.read.side_effect = socket.error(errno.ECONNRESET,
+                                             'Connection reset by peer')
+        self.assertRaises(connection_pool.RequestError,
+                          self.pool.post, '/soap', 'msg')
+        self.assertEqual(1, len(self.conns))
+        self.assertEqual(0, self.pool.get_stats()['reconnects'])
+
+    def test_http_error(self):
+        self._new_conn()
+        self.conns = []
+        self.conn_cls.side_effect = None
+        conn = self.conn_cls.return_value
+        conn.getresponse.return_value.status = 500
+        conn.getresponse.return_value.read.return_value = 'fault'
+        conn.getresponse.return_value.will_close = True
+        err = self.assertRaises(connection_pool.RequestError,
+                                self.pool.post, '/soap', 'msg')
+        self.assertEqual(500, err.status)
+        self.assertEqual('fault', err.body)
+        self.assertTrue(conn.close.called)
+
+    def _compressed_resp(self, encoding, data):
+        conn = self._new_conn()
+        self.conns = []
+        self.conn_cls.side_effect = None
+        self.conn_cls.return_value = conn
+        resp = conn.getresponse.return_value
+        resp.getheader.return_value = encoding
+        chunks = [data[i:i + 10] for i in range(0, len(data), 10)] + ['']
+        resp.read.side_effect = chunks
+
+    def test_gzip_response_is_decoded(self):
+        body = '{"VLANs": [%s]}' % ', '.join(['{"ID": %d}' % i
+                                             for i in range(100)])
+        wire = connection_pool.gzip_encode(body)
+        self._compressed_resp('gzip', wire)
+        self.assertEqual(body, self.pool.post('/api', 'x' * 5))
+        stats = self.pool.get_stats()
+        self.assertEqual(5, stats['bytes_sent'])
+        self.assertEqual(len(wire), stats['bytes_received'])
+        self.assertEqual(len(body), stats['bytes_decoded'])
+
+    def test_deflate_response_is_decoded(self):
+        body = 'fault ' * 50
+        self._compressed_resp('deflate', zlib.compress(body))
+        self.assertEqual(body, self.pool.post('/api', 'msg'))
+        # Raw deflate data without the zlib header.
+        self.pool.close()
+        self._compressed_resp('deflate', zlib.compress(body)[2:-4])
+        self.assertEqual(body, self.pool.post('/api', 'msg'))
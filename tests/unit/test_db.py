@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+import mock
+from oslo_utils import timeutils
+from sqlalchemy import orm
+
+from neutron.tests.unit import testlib_api
+
+from neutron.plugins.ml2.drivers.hp.common import db
+
+
+def _vm(port_id, host_id, network_id='net1'):
+    return {'device_id': 'vm%d' % port_id, 'host_id': host_id,
+            'port_id': 'port%d' % port_id, 'network_id': network_id,
+            'tenant_id': 'tenant1'}
+
+
+class VmBulkTestCase(testlib_api.SqlTestCase):
+    """Test cases for the bulk insert and delete of VMs."""
+    def test_create_vms_bulk(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        refs = db.create_vms_bulk([_vm(1, 'host1'), _vm(2, 'host1'),
+                                   _vm(3, 'host1'), _vm(3, 'host1'),
+                                   _vm(4, 'host2'), _vm(5, 'host1', 'net2')])
+        self.assertEqual({('net1', 'host1'): (1, 3),
+                          ('net1', 'host2'): (0, 1),
+                          ('net2', 'host1'): (0, 1)}, refs)
+        self.assertEqual(3, db.get_vm_count('net1', 'host1'))
+        self.assertEqual({}, db.create_vms_bulk([_vm(2, 'host1')]))
+
+    def _miss_known_vms(self):
+        session = db.get_session()
+        query = session.query
+
+        def first_query_misses(*args):
+            # The VMs already known are not seen, as if another server
+            # inserted them after the check.
+            session.query = query
+            missed = mock.Mock()
+            missed.filter.return_value = []
+            return missed
+
+        session.query = first_query_misses
+        return session
+
+    def test_create_vms_bulk_duplicated_meanwhile(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        session = self._miss_known_vms()
+        with mock.patch.object(db, 'create_vm',
+                               wraps=db.create_vm) as create_vm:
+            refs = db.create_vms_bulk([_vm(1, 'host1'), _vm(2, 'host1'),
+                                       _vm(3, 'host2')], session=session)
+        # The batch failed on the duplicate and was inserted one by one.
+        self.assertEqual(3, create_vm.call_count)
+        self.assertEqual({('net1', 'host1'): (1, 2),
+                          ('net1', 'host2'): (0, 1)}, refs)
+        self.assertEqual(2, db.get_vm_count('net1', 'host1'))
+        self.assertEqual(1, db.get_vm_count('net1', 'host2'))
+
+    def test_create_vms_bulk_counter_raced_meanwhile(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        session = self._miss_known_vms()
+        create_vm = db.create_vm
+
+        def other_vm_follows(device_id, host_id, *args, **kwargs):
+            # Another VM joins the network on the host right after ours,
+            # the counter of ours still says it was the first one.
+            count = create_vm(device_id, host_id, *args, **kwargs)
+            if host_id == 'host2':
+                create_vm('vm9', 'host2', 'port9', 'net1', 'tenant1',
+                          session=session)
+            return count
+
+        with mock.patch.object(db, 'create_vm',
+                               side_effect=other_vm_follows):
+            refs = db.create_vms_bulk([_vm(1, 'host1'), _vm(3, 'host2')],
+                                      session=session)
+        self.assertEqual({('net1', 'host2'): (0, 1)}, refs)
+        self.assertEqual(2, db.get_vm_count('net1', 'host2'))
+
+    def test_delete_vms_bulk(self):
+        db.create_vms_bulk([_vm(1, 'host1'), _vm(2, 'host1'),
+                            _vm(3, 'host2')])
+        unknown = _vm(1, 'host1')
+        unknown['tenant_id'] = 'tenant2'
+        refs = db.delete_vms_bulk([_vm(1, 'host1'), _vm(3, 'host2'),
+                                   _vm(4, 'host2'), unknown])
+        self.assertEqual({('net1', 'host1'): (2, 1),
+                          ('net1', 'host2'): (1, 0)}, refs)
+        self.assertEqual(1, db.get_vm_count('net1', 'host1'))
+        self.assertEqual(0, db.get_vm_count('net1', 'host2'))
+        self.assertEqual({}, db.delete_vms_bulk([_vm(3, 'host2')]))
+
+
+class HostVlanTestCase(testlib_api.SqlTestCase):
+    """Test cases for the host to VLAN map."""
+    def _sorted(self, host_vlan):
+        return dict((host_id, sorted(vlans))
+                    for host_id, vlans in host_vlan.items())
+
+    def test_host_vlan(self):
+        self.assertEqual({}, db.get_host_vlan())
+        db.create_network('tenant1', 'net1', 100, db.VLAN_SEGMENTATION)
+        db.create_network('tenant1', 'net2', 200, db.VLAN_SEGMENTATION)
+        db.create_network('tenant2', 'net3', 300, db.VLAN_SEGMENTATION)
+        db.create_network('tenant2', 'net4', 1000, 'vxlan')
+        for vm_id, host_id, network_id, tenant_id in (
+                ('vm1', 'host1', 'net1', 'tenant1'),
+                ('vm2', 'host1', 'net1', 'tenant1'),
+                ('vm3', 'host1', 'net2', 'tenant1'),
+                ('vm4', 'host2', 'net1', 'tenant1'),
+                ('vm5', 'host2', 'net3', 'tenant2'),
+                ('vm6', 'host3', 'net4', 'tenant2'),
+                ('vm7', 'host3', 'net5', 'tenant2')):
+            db.create_vm(vm_id, host_id, 'port-' + vm_id, network_id,
+                         tenant_id)
+        # Each VLAN is listed once per host, VMs of non-VLAN and of
+        # unknown networks are ignored.
+        self.assertEqual({'host1': [100, 200], 'host2': [100, 300]},
+                         self._sorted(db.get_host_vlan()))
+        db.delete_vm('vm1', 'host1', 'port-vm1', 'net1', 'tenant1')
+        db.delete_vm('vm3', 'host1', 'port-vm3', 'net2', 'tenant1')
+        db.delete_vm('vm5', 'host2', 'port-vm5', 'net3', 'tenant2')
+        self.assertEqual({'host1': [100], 'host2': [100]},
+                         self._sorted(db.get_host_vlan()))
+
+
+class HostRefTestCase(testlib_api.SqlTestCase):
+    """Test cases for the VM counters of networks on hosts."""
+    def setUp(self):
+        super(HostRefTestCase, self).setUp()
+        db.create_network('tenant1', 'net1', 100, db.VLAN_SEGMENTATION)
+
+    def test_counter(self):
+        self.assertEqual(1, db.create_vm('vm1', 'host1', 'port1', 'net1',
+                                         'tenant1'))
+        self.assertEqual(2, db.create_vm('vm2', 'host1', 'port2', 'net1',
+                                         'tenant1'))
+        self.assertEqual(0, db.create_vm('vm2', 'host1', 'port2', 'net1',
+                                         'tenant1'))
+        self.assertEqual(1, db.delete_vm('vm1', 'host1', 'port1', 'net1',
+                                         'tenant1'))
+        self.assertEqual(0, db.delete_vm('vm2', 'host1', 'port2', 'net1',
+                                         'tenant1'))
+        self.assertIsNone(db.delete_vm('vm2', 'host1', 'port2', 'net1',
+                                       'tenant1'))
+        self.assertEqual(0, db.get_vm_count('net1', 'host1'))
+
+    def test_counter_inserted_meanwhile(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        seq = db.get_last_journal_seq()
+        update = orm.Query.update
+        missed = []
+
+        def first_update_misses(qry, *args, **kwargs):
+            # As if another server inserted the counter after the
+            # update found no row.
+            if len(missed) == 0:
+                missed.append(qry)
+                return 0
+            return update(qry, *args, **kwargs)
+
+        with mock.patch.object(orm.Query, 'update', first_update_misses):
+            count = db.create_vm('vm2', 'host1', 'port2', 'net1',
+                                 'tenant1')
+        self.assertEqual(1, len(missed))
+        self.assertEqual(2, count)
+        self.assertEqual(2, db.get_vm_count('net1', 'host1'))
+        # The VLAN is journaled once, by the first insert.
+        self.assertEqual(seq, db.get_last_journal_seq())
+
+
+class JournalTestCase(testlib_api.SqlTestCase):
+    """Test cases for the journal of VLAN membership changes."""
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        db.create_network('tenant1', 'net1', 100, db.VLAN_SEGMENTATION)
+
+    def _entries(self, after_seq=0, up_to_seq=None):
+        return [(entry.network_id, entry.host_id, entry.segmentation_id,
+                 entry.action)
+                for entry in db.get_journal_entries(after_seq, up_to_seq)]
+
+    def test_first_and_last_vm_are_journaled(self):
+        self.assertEqual(0, db.get_last_journal_seq())
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        seq = db.get_last_journal_seq()
+        db.create_vm('vm2', 'host1', 'port2', 'net1', 'tenant1')
+        db.create_vm('vm3', 'host2', 'port3', 'net1', 'tenant1')
+        db.delete_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        db.delete_vm('vm2', 'host1', 'port2', 'net1', 'tenant1')
+        self.assertEqual([('net1', 'host1', 100, db.VLAN_ADD),
+                          ('net1', 'host2', 100, db.VLAN_ADD),
+                          ('net1', 'host1', 100, db.VLAN_REMOVE)],
+                         self._entries())
+        self.assertEqual([('net1', 'host2', 100, db.VLAN_ADD)],
+                         self._entries(seq, seq + 1))
+        self.assertEqual(seq + 2, db.get_last_journal_seq())
+
+    def test_purge_journal(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        self.assertEqual(0, db.purge_journal(60))
+        later = timeutils.utcnow() + datetime.timedelta(seconds=61)
+        with mock.patch.object(db.timeutils, 'utcnow',
+                               return_value=later):
+            self.assertEqual(1, db.purge_journal(60))
+        self.assertEqual([], self._entries())
+
+    def test_journal_entries_by_seq(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        db.create_vm('vm2', 'host2', 'port2', 'net1', 'tenant1')
+        seq = db.get_last_journal_seq()
+        self.assertEqual(['host2'],
+                         [entry.host_id for entry
+                          in db.get_journal_entries_by_seq([seq, seq + 1])])
+        self.assertEqual([], db.get_journal_entries_by_seq([]))
+
+    def test_recent_journal_seqs(self):
+        db.create_vm('vm1', 'host1', 'port1', 'net1', 'tenant1')
+        db.create_vm('vm2', 'host2', 'port2', 'net1', 'tenant1')
+        seq = db.get_last_journal_seq()
+        self.assertEqual([seq - 1, seq], db.get_recent_journal_seqs(60, seq))
+        self.assertEqual([seq - 1], db.get_recent_journal_seqs(60, seq - 1))
+        later = timeutils.utcnow() + datetime.timedelta(seconds=61)
+        with mock.patch.object(db.timeutils, 'utcnow',
+                               return_value=later):
+            self.assertEqual([], db.get_recent_journal_seqs(60, seq))
+
+
+class DeviceOpTestCase(testlib_api.SqlTestCase):
+    """Test cases for the claims on queued device operations."""
+    def setUp(self):
+        super(DeviceOpTestCase, self).setUp()
+        self.seqs = db.enqueue_device_ops([('1.1.1.1', {'a': 1}),
+                                           ('1.1.1.2', {'b': 2}),
+                                           ('1.1.1.1', {'c': 3})])
+
+    def test_claim_pending_operations(self):
+        ops = db.claim_device_ops('1.1.1.1', 'host1:1', 60)
+        self.assertEqual([self.seqs[0], self.seqs[2]],
+                         [op.seq for op in ops])
+        self.assertEqual([{'a': 1}, {'c': 3}],
+                         [op.get_changes() for op in ops])
+        # The owner renews its claim, another worker is refused.
+        self.assertEqual(2, len(db.claim_device_ops('1.1.1.1',
+                                                    'host1:1', 60)))
+        self.assertIsNone(db.claim_device_ops('1.1.1.1', 'host2:1', 60))
+        self.assertEqual(1, len(db.claim_device_ops('1.1.1.2',
+                                                    'host2:1', 60)))
+        self.assertEqual([], db.claim_device_ops('1.1.1.3', 'host2:1',
+                                                 60))
+
+    def test_expired_claim_is_taken_over(self):
+        db.claim_device_ops('1.1.1.1', 'host1:1', 60)
+        later = timeutils.utcnow() + datetime.timedelta(seconds=61)
+        with mock.patch.object(db.timeutils, 'utcnow',
+                               return_value=later):
+            ops = db.claim_device_ops('1.1.1.1', 'host2:1', 60)
+        self.assertEqual(2, len(ops))
+        # The late owner can not update the operations any more.
+        self.assertEqual(0, db.update_device_ops(
+            [op.seq for op in ops], db.OP_DONE, 1, owner='host1:1'))
+
+    def test_update_releases_claim(self):
+        ops = db.claim_device_ops('1.1.1.1', 'host1:1', 60)
+        seqs = [op.seq for op in ops]
+        self.assertEqual(2, db.update_device_ops(
+            seqs, db.OP_PENDING, 1, 'Failed to apply.', 'host1:1'))
+        ops = db.claim_device_ops('1.1.1.1', 'host2:1', 60)
+        self.assertEqual([1, 1], [op.attempts for op in ops])
+        self.assertEqual(2, db.update_device_ops(seqs, db.OP_DONE, 2,
+                                                 owner='host2:1'))
+        self.assertEqual([], db.claim_device_ops('1.1.1.1', 'host1:1',
+                                                 60))
+        self.assertEqual({'1.1.1.1': {db.OP_DONE: 2},
+                          '1.1.1.2': {db.OP_PENDING: 1}},
+                         db.get_device_op_stats())
+
+    def test_operations_pushed_after(self):
+        self.assertEqual(self.seqs[2], db.get_last_device_op_seq())
+        ops = db.claim_device_ops('1.1.1.1', 'host1:1', 60)
+        self.assertEqual(0, db.count_device_ops_pushed_after(
+            '1.1.1.1', self.seqs[0]))
+        db.update_device_ops([self.seqs[2]], db.OP_DONE, 1)
+        self.assertEqual(1, db.count_device_ops_pushed_after(
+            '1.1.1.1', self.seqs[0]))
+        self.assertEqual(0, db.count_device_ops_pushed_after(
+            '1.1.1.1', self.seqs[2]))
+        self.assertEqual(1, db.release_device_ops(
+            [op.seq for op in ops], 'host1:1'))
+        self.assertEqual(1, len(db.claim_device_ops('1.1.1.1',
+                                                    'host2:1', 60)))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import mythread
+from neutron.plugins.ml2.drivers.hp import device_queue
+from neutron.plugins.ml2.drivers.hp.rpc import changeset
+
+
+class FakeOp(object):
+    def __init__(self, seq, changes, attempts=0):
+        self.seq = seq
+        self.changes = changes
+        self.attempts = attempts
+
+    def get_changes(self):
+        return self.changes.to_dict()
+
+
+class DeviceQueueTestCase(base.BaseTestCase):
+    """Test cases for the durable device operation queue."""
+    def setUp(self):
+        super(DeviceQueueTestCase, self).setUp()
+        patcher = mock.patch.object(device_queue, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+        self.on_failure = mock.Mock()
+        self.queue = device_queue.DeviceQueue({'1.1.1.1': self.client},
+                                              mythread.WorkerPool(1),
+                                              retries=2,
+                                              on_failure=self.on_failure)
+        self.queue.is_running = True
+        self.queue._get_owner = mock.Mock(return_value='host:1')
+        self.db.update_device_ops.side_effect = (
+            lambda seqs, *args: len(seqs))
+
+    def _changes(self, vlan_id):
+        changes = changeset.DeviceChangeSet()
+        changes.create_vlans([vlan_id])
+        return changes
+
+    @mock.patch.object(device_queue.DeviceQueue, '_wake')
+    def test_enqueue_skips_empty_change_sets(self, wake):
+        self.db.enqueue_device_ops.return_value = [7]
+        seqs = self.queue.enqueue({'1.1.1.1': self._changes(10),
+                                   '1.1.1.2': changeset.DeviceChangeSet()})
+        self.assertEqual([7], seqs)
+        self.db.enqueue_device_ops.assert_called_once_with(
+            [('1.1.1.1', self._changes(10).to_dict())])
+        wake.assert_called_once_with('1.1.1.1')
+
+    def test_pending_operations_are_merged(self):
+        remove = changeset.DeviceChangeSet()
+        remove.remove_vlans([10])
+        remove.permit_vlans(['g1/0/1'], [20])
+        self.db.claim_device_ops.return_value = [
+            FakeOp(1, self._changes(10)), FakeOp(2, self._changes(20)),
+            FakeOp(3, remove)]
+        self.client.apply.return_value = True
+        self.assertTrue(self.queue._drain('1.1.1.1'))
+        changes = self.client.apply.call_args[0][0]
+        self.assertEqual(1, self.client.apply.call_count)
+        self.assertEqual([20], changes.vlan_create.to_list())
+        self.assertEqual([10], changes.vlan_remove.to_list())
+        self.assertEqual([20], changes.trunk_permit['g1/0/1'].to_list())
+        self.db.claim_device_ops.assert_called_once_with(
+            '1.1.1.1', 'host:1', device_queue.DEFAULT_LEASE)
+        self.db.update_device_ops.assert_called_once_with(
+            [1, 2, 3], self.db.OP_DONE, 1, None, 'host:1')
+        self.assertEqual(3, self.queue.get_stats()['max_events_per_push'])
+
+    def test_failed_push_is_retried(self):
+        self.db.claim_device_ops.return_value = [
+            FakeOp(1, self._changes(10)), FakeOp(2, self._changes(20))]
+        self.client.apply.return_value = False
+        self.assertFalse(self.queue._drain('1.1.1.1'))
+        self.db.update_device_ops.assert_called_once_with(
+            [1, 2], self.db.OP_PENDING, 1, mock.ANY, 'host:1')
+        self.assertFalse(self.on_failure.called)
+
+    def test_give_up_after_retries(self):
+        self.db.claim_device_ops.return_value = [
+            FakeOp(1, self._changes(10), attempts=1),
+            FakeOp(2, self._changes(20))]
+        self.client.apply.return_value = False
+        self.assertTrue(self.queue._drain('1.1.1.1'))
+        self.db.update_device_ops.assert_called_once_with(
+            [1, 2], self.db.OP_FAILED, 2, mock.ANY, 'host:1')
+        self.on_failure.assert_called_once_with('1.1.1.1')
+
+    def test_operations_claimed_by_another_worker_wait(self):
+        self.db.claim_device_ops.return_value = None
+        self.assertFalse(self.queue._drain('1.1.1.1'))
+        self.assertFalse(self.client.apply.called)
+        self.assertFalse(self.db.update_device_ops.called)
+
+    def test_run_exclusive(self):
+        self.db.claim_device_ops.return_value = [FakeOp(8, None)]
+        self.db.count_device_ops_pushed_after.return_value = 0
+        push = mock.Mock(return_value=True)
+        self.assertTrue(self.queue.run_exclusive('1.1.1.1', 7, push, 'a'))
+        push.assert_called_once_with('a')
+        self.db.count_device_ops_pushed_after.assert_called_once_with(
+            '1.1.1.1', 7)
+        # The newer operation is left to the queue.
+        self.db.release_device_ops.assert_called_once_with([8], 'host:1')
+
+    def test_run_exclusive_after_newer_push(self):
+        self.db.claim_device_ops.return_value = []
+        self.db.count_device_ops_pushed_after.return_value = 1
+        push = mock.Mock()
+        self.assertFalse(self.queue.run_exclusive('1.1.1.1', 7, push))
+        self.assertFalse(push.called)
+
+    def test_run_exclusive_while_claimed_by_another_worker(self):
+        self.db.claim_device_ops.return_value = None
+        push = mock.Mock()
+        self.assertFalse(self.queue.run_exclusive('1.1.1.1', 7, push))
+        self.assertFalse(push.called)
+        self.assertFalse(self.db.release_device_ops.called)
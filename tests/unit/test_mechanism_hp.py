@@ -15,7 +15,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import signal
 import sys
+import threading
 import mock
 from neutron.tests.unit import testlib_api
 from neutron.extensions import portbindings
@@ -26,6 +28,14 @@ with mock.patch.dict(sys.modules,
     from neutron.plugins.ml2.drivers.hp import mechanism_hp
 
 
+def _stop_driver(driver):
+    driver.sync_helper.timer.stop()
+    if driver.topology_timer is not None:
+        driver.topology_timer.stop()
+    driver.device_queue.stop()
+    driver.device_workers.stop()
+
+
 class HPDriverTestCase(testlib_api.SqlTestCase):
     """Main test cases for HP Mechanism driver.
 
@@ -33,14 +43,21 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
     """
     def setUp(self):
         super(HPDriverTestCase, self).setUp()
-        self.mock = mock.MagicMock()
-        mechanism_hp.db = self.mock
+        patcher = mock.patch.object(mechanism_hp, 'db')
+        self.mock = patcher.start()
+        self.addCleanup(patcher.stop)
         self.driver = mechanism_hp.HPDriver(self.mock)
         self.driver.initialize()
+        # Each port is handled at once, unless a test batches them.
+        self.driver.port_batch_window = 0
+        self.addCleanup(self._stop_driver)
 
     def tearDown(self):
         super(HPDriverTestCase, self).tearDown()
 
+    def _stop_driver(self):
+        _stop_driver(self.driver)
+
     def _get_network_context(self, tenant_id, net_id, seg_id, shared):
         network = {'id': net_id,
                    'tenant_id': tenant_id,
@@ -81,9 +98,11 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
         segment_id = segments[0]['segmentation_id']
 
         expected_calls = [
-            mock.call.is_network_created(tenant_id, network_id),
+            mock.call.is_network_created(tenant_id, network_id,
+                                         session=mock.ANY),
             mock.call.create_network(tenant_id, network_id,
-                                     segment_id, segment_type),
+                                     segment_id, segment_type,
+                                     session=mock.ANY),
         ]
 
         mechanism_hp.db.assert_has_calls(expected_calls)
@@ -101,7 +120,8 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
 
         self.driver.delete_network_postcommit(network_context)
         expected_calls = [
-            mock.call.delete_network(tenant_id, network_id),
+            mock.call.delete_network(tenant_id, network_id,
+                                     session=mock.ANY),
         ]
 
         mechanism_hp.db.assert_has_calls(expected_calls)
@@ -120,8 +140,7 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
                                               network_id,
                                               vm_id,
                                               network_context)
-        mechanism_hp.db.is_vm_created.return_value = False
-        mechanism_hp.db.get_vm_count.return_value = 1
+        mechanism_hp.db.create_vm.return_value = 1
 
         port = port_context.current
         device_id = port['device_id']
@@ -131,15 +150,34 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
         self.driver.create_port_postcommit(port_context)
 
         expected_calls = [
-            mock.call.is_vm_created(device_id, host_id,
-                                    port_id, network_id, tenant_id),
             mock.call.create_vm(device_id, host_id, port_id,
-                                network_id, tenant_id),
-            mock.call.get_vm_count(network_id, host_id),
+                                network_id, tenant_id, session=mock.ANY),
         ]
 
         mechanism_hp.db.assert_has_calls(expected_calls)
 
+    def test_create_port_postcommit_existing_vm(self):
+        tenant_id = 'tennet1'
+        network_id = 'network1'
+        segmentation_id = 101
+        vm_id = 'vm1'
+
+        network_context = self._get_network_context(tenant_id,
+                                                    network_id,
+                                                    segmentation_id,
+                                                    False)
+        port_context = self._get_port_context(tenant_id,
+                                              network_id,
+                                              vm_id,
+                                              network_context)
+        mechanism_hp.db.create_vm.return_value = 0
+
+        self.driver.create_port_postcommit(port_context)
+
+        host_id = port_context.current['binding:host_id']
+        self.assertEqual(0, self.driver.vlan_index.get_port_count(network_id,
+                                                                  host_id))
+
     def test_delete_port_postcommit(self):
         tenant_id = 'tennet1'
         network_id = 'network1'
@@ -155,8 +193,7 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
                                               network_id,
                                               vm_id,
                                               network_context)
-        mechanism_hp.db.is_vm_created.return_value = True
-        mechanism_hp.db.get_vm_count.return_value = 1
+        mechanism_hp.db.delete_vm.return_value = 0
 
         self.driver.delete_port_postcommit(port_context)
 
@@ -164,14 +201,284 @@ class HPDriverTestCase(testlib_api.SqlTestCase):
         port_id = port_context.current['id']
         device_id = port_context.current['device_id']
         expected_calls = [
-            mock.call.is_vm_created(device_id, host_id,
-                                    port_id, network_id, tenant_id),
-            mock.call.get_vm_count(network_id, host_id),
+            mock.call.delete_vm(device_id, host_id, port_id,
+                                network_id, tenant_id, session=mock.ANY),
         ]
 
         mechanism_hp.db.assert_has_calls(expected_calls)
 
 
+class HPDriverDbTestCase(HPDriverTestCase):
+    """Test cases running the driver hooks on the real db module.
+
+    Only the db functions a test checks are patched, so a function the
+    driver calls but the db module lacks fails the test.
+    """
+    def setUp(self):
+        testlib_api.SqlTestCase.setUp(self)
+        self.driver = mechanism_hp.HPDriver(mock.MagicMock())
+        self.driver.initialize()
+        self.driver.port_batch_window = 0
+        self.addCleanup(self._stop_driver)
+
+    def _create_port(self, tenant_id='tenant1', network_id='network1',
+                     vm_id='vm1', seg_id=101):
+        network_context = self._get_network_context(tenant_id, network_id,
+                                                    seg_id, False)
+        self.driver.create_network_postcommit(network_context)
+        port_context = self._get_port_context(tenant_id, network_id,
+                                              vm_id, network_context)
+        self.driver.create_port_postcommit(port_context)
+        return port_context
+
+    def test_create_network_postcommit(self):
+        network_context = self._get_network_context('tenant1', 'network1',
+                                                    101, False)
+        with mock.patch.object(mechanism_hp.db, 'create_network',
+                               wraps=mechanism_hp.db.create_network) as create:
+            self.driver.create_network_postcommit(network_context)
+            self.driver.create_network_postcommit(network_context)
+        self.assertEqual(1, create.call_count)
+        self.assertTrue(mechanism_hp.db.is_network_created('tenant1',
+                                                           'network1'))
+
+    def test_delete_network_postcommit(self):
+        network_context = self._get_network_context('tenant1', 'network1',
+                                                    101, False)
+        self.driver.create_network_postcommit(network_context)
+        self.driver.delete_network_postcommit(network_context)
+        self.assertFalse(mechanism_hp.db.is_network_created('tenant1',
+                                                            'network1'))
+
+    def test_create_port_postcommit(self):
+        with mock.patch.object(mechanism_hp.db, 'create_vm',
+                               wraps=mechanism_hp.db.create_vm) as create:
+            self._create_port()
+        self.assertEqual(1, create.call_count)
+        self.assertEqual(1, mechanism_hp.db.get_vm_count('network1',
+                                                         'ubuntu1'))
+        self.assertEqual({'ubuntu1': [101]}, mechanism_hp.db.get_host_vlan())
+        self.assertEqual(1, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu1'))
+
+    def test_create_port_postcommit_existing_vm(self):
+        self._create_port()
+        self._create_port()
+        self.assertEqual(1, mechanism_hp.db.get_vm_count('network1',
+                                                         'ubuntu1'))
+        self.assertEqual(1, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu1'))
+
+    def test_delete_port_postcommit(self):
+        port_context = self._create_port()
+        self.driver.delete_port_postcommit(port_context)
+        self.assertEqual(0, mechanism_hp.db.get_vm_count('network1',
+                                                         'ubuntu1'))
+        self.assertEqual({}, mechanism_hp.db.get_host_vlan())
+
+    def _get_bulk_port_contexts(self):
+        network_context = self._get_network_context('tenant1', 'network1',
+                                                    101, False)
+        self.driver.create_network_postcommit(network_context)
+        contexts = []
+        for port_id, host_id in (('port1', 'ubuntu1'),
+                                 ('port2', 'ubuntu1'),
+                                 ('port3', 'ubuntu2')):
+            context = self._get_port_context('tenant1', 'network1',
+                                             'vm-' + port_id,
+                                             network_context)
+            context.current['id'] = port_id
+            context.current['binding:host_id'] = host_id
+            contexts.append(context)
+        return contexts
+
+    def test_create_ports_postcommit(self):
+        contexts = self._get_bulk_port_contexts()
+        with mock.patch.object(self.driver,
+                               '_create_vlan_network') as create:
+            self.driver.create_ports_postcommit(contexts)
+            self.driver.create_ports_postcommit(contexts[:2])
+        # One push for each network and host, none for known ports.
+        self.assertEqual(sorted([mock.call('network1', 'ubuntu1', 101),
+                                 mock.call('network1', 'ubuntu2', 101)]),
+                         sorted(create.call_args_list))
+        self.assertEqual(2, mechanism_hp.db.get_vm_count('network1',
+                                                         'ubuntu1'))
+        self.assertEqual(2, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu1'))
+        self.assertEqual(1, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu2'))
+
+    def test_delete_ports_postcommit(self):
+        contexts = self._get_bulk_port_contexts()
+        self.driver.create_ports_postcommit(contexts)
+        with mock.patch.object(self.driver,
+                               'delete_vlan_config') as delete:
+            self.driver.delete_ports_postcommit(contexts[1:])
+        # ubuntu1 keeps a port in network1.
+        delete.assert_called_once_with('network1', 'ubuntu2', 101)
+        self.assertEqual({'ubuntu1': [101]}, mechanism_hp.db.get_host_vlan())
+        self.assertEqual(1, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu1'))
+        self.assertEqual(0, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu2'))
+
+    def _run_concurrently(self, func, contexts):
+        threads = [threading.Thread(target=func, args=(context,))
+                   for context in contexts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    def test_port_postcommits_are_batched(self):
+        self.driver.port_batch_window = 0.1
+        self.driver.create_batcher.window = 0.1
+        self.driver.delete_batcher.window = 0.1
+        # Two ports of network1 on ubuntu1.
+        contexts = self._get_bulk_port_contexts()[:2]
+        db = mechanism_hp.db
+        with mock.patch.object(db, 'create_vms_bulk',
+                               wraps=db.create_vms_bulk) as bulk, \
+                mock.patch.object(db, 'create_vm') as create_vm, \
+                mock.patch.object(self.driver,
+                                  '_create_vlan_network') as create:
+            self._run_concurrently(self.driver.create_port_postcommit,
+                                   contexts)
+        # One insert and one push for the network on the host.
+        self.assertEqual(1, bulk.call_count)
+        self.assertEqual(2, len(bulk.call_args[0][0]))
+        self.assertFalse(create_vm.called)
+        create.assert_called_once_with('network1', 'ubuntu1', 101)
+        self.assertEqual(2, self.driver.vlan_index.get_port_count(
+            'network1', 'ubuntu1'))
+        with mock.patch.object(db, 'delete_vms_bulk',
+                               wraps=db.delete_vms_bulk) as bulk, \
+                mock.patch.object(self.driver,
+                                  'delete_vlan_config') as delete:
+            self._run_concurrently(self.driver.delete_port_postcommit,
+                                   contexts)
+        self.assertEqual(1, bulk.call_count)
+        delete.assert_called_once_with('network1', 'ubuntu1', 101)
+        self.assertEqual({}, db.get_host_vlan())
+
+def _leaf(ip, host, oem='hp'):
+    return {'ip': ip, 'oem': oem,
+            'connections': [{'host': host, 'ports': ['g1/0/1']}]}
+
+
+def _spine(ip, leaf_ips):
+    return {'ip': ip, 'oem': 'hp',
+            'connections': [{'leaf_ip': leaf_ip,
+                             'spine_ports': ['g1/0/9'],
+                             'leaf_ports': ['g1/0/49']}
+                            for leaf_ip in leaf_ips]}
+
+
+class HPDriverTopologyTestCase(testlib_api.SqlTestCase):
+    """Test cases for reloading the topology of a running driver."""
+    def setUp(self):
+        super(HPDriverTopologyTestCase, self).setUp()
+        patcher = mock.patch.object(mechanism_hp, 'db')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.driver = mechanism_hp.HPDriver(mock.MagicMock())
+        self.driver.initialize()
+        self.addCleanup(_stop_driver, self.driver)
+        self.driver._create_clients = mock.Mock(
+            side_effect=self._create_clients)
+        self.driver.sync_helper.sync_devices = mock.Mock()
+        self._set_topology(self.driver,
+                           [_leaf('1.1.1.1', 'host1'),
+                            _leaf('1.1.1.2', 'host2'),
+                            _leaf('1.1.1.4', 'host4')],
+                           [_spine('2.2.2.1', ['1.1.1.1'])])
+        self.driver.sync_helper.topology = self.driver.topology
+        self._create_clients()
+        self.clients = dict(self.driver.rpc_clients)
+        patcher = mock.patch.object(mechanism_hp.config, 'HPML2Config')
+        self.config = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_clients(self, devices=None):
+        if devices is None:
+            devices = self.driver.topology.devices
+        for dev_ip in devices:
+            if dev_ip in self.driver.topology.devices:
+                self.driver.rpc_clients.setdefault(dev_ip, mock.Mock())
+
+    def _set_topology(self, target, leaves, spines):
+        target.leaf_topology = leaves
+        target.spine_topology = spines
+        target.topology = mechanism_hp.config.Topology(leaves, spines)
+
+    def test_reload_changed_devices(self):
+        # 1.1.1.1 changes OEM, 1.1.1.2 is removed and 1.1.1.3 added.
+        self._set_topology(self.config,
+                           [_leaf('1.1.1.1', 'host1', oem='h3c'),
+                            _leaf('1.1.1.3', 'host3'),
+                            _leaf('1.1.1.4', 'host4')],
+                           [_spine('2.2.2.1', ['1.1.1.1'])])
+        self.driver.reload_topology()
+        self.assertIs(self.config.topology, self.driver.topology)
+        self.assertIs(self.config.topology,
+                      self.driver.sync_helper.topology)
+        rpc_clients = self.driver.rpc_clients
+        self.assertEqual(set(['1.1.1.1', '1.1.1.3', '1.1.1.4', '2.2.2.1']),
+                         set(rpc_clients))
+        # Clients of changed and removed devices are retired.
+        self.assertTrue(self.clients['1.1.1.1'].close_session.called)
+        self.assertTrue(self.clients['1.1.1.2'].close_session.called)
+        self.assertTrue(self.clients['1.1.1.1'].close.called)
+        self.assertTrue(self.clients['1.1.1.2'].close.called)
+        self.assertIsNot(self.clients['1.1.1.1'], rpc_clients['1.1.1.1'])
+        self.assertIs(self.clients['1.1.1.4'], rpc_clients['1.1.1.4'])
+        self.assertIs(self.clients['2.2.2.1'], rpc_clients['2.2.2.1'])
+        self.assertFalse(self.clients['1.1.1.4'].close_session.called)
+        self.assertFalse(self.clients['1.1.1.4'].close.called)
+        # The uplink spine of a changed leaf is synchronized too.
+        self.driver.sync_helper.sync_devices.assert_called_once_with(
+            set(['1.1.1.1', '1.1.1.3', '2.2.2.1']))
+
+    def test_reload_unchanged_topology(self):
+        topology = self.driver.topology
+        self._set_topology(self.config, self.driver.leaf_topology,
+                           self.driver.spine_topology)
+        self.driver.reload_topology()
+        self.assertIs(topology, self.driver.topology)
+        self.assertFalse(self.driver.sync_helper.sync_devices.called)
+        self.assertEqual(self.clients, self.driver.rpc_clients)
+
+    def test_reload_invalid_configuration(self):
+        topology = self.driver.topology
+        self.config.side_effect = mechanism_hp.cfg.Error('bad topology')
+        self.driver.reload_topology()
+        self.assertIs(topology, self.driver.topology)
+        self.assertFalse(self.driver.sync_helper.sync_devices.called)
+
+    def test_sighup_reloads_topology(self):
+        reloaded = threading.Event()
+        self.driver.reload_topology = mock.Mock(
+            side_effect=lambda: reloaded.set())
+        self.driver.prev_sighup_handler = mock.Mock()
+        self.driver._on_sighup(signal.SIGHUP, None)
+        self.assertTrue(reloaded.wait(5))
+        self.driver.prev_sighup_handler.assert_called_once_with(
+            signal.SIGHUP, None)
+
+    def test_check_topology_on_file_change(self):
+        self.driver.reload_topology = mock.Mock()
+        self.driver.config_mtimes = {'ml2_conf_hp.ini': 1}
+        with mock.patch.object(self.driver, '_get_config_mtimes',
+                               return_value={'ml2_conf_hp.ini': 1}):
+            self.driver.check_topology()
+        self.assertFalse(self.driver.reload_topology.called)
+        with mock.patch.object(self.driver, '_get_config_mtimes',
+                               return_value={'ml2_conf_hp.ini': 2}):
+            self.driver.check_topology()
+        self.assertTrue(self.driver.reload_topology.called)
+
+
 class FakeNetworkContext(object):
     """To generate network context for testing purposes only."""
 
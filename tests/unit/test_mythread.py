@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import mythread
+
+
+class WorkerPoolTestCase(base.BaseTestCase):
+    """Test cases for the bounded per-device worker pool."""
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+        self.pool = mythread.WorkerPool(4)
+        self.addCleanup(self.pool.stop)
+
+    def test_results_by_device(self):
+        def fail():
+            raise RuntimeError('device is down')
+        tasks = {'10.0.0.1': (lambda x: x * 2, (21,)),
+                 '10.0.0.2': (fail, ())}
+        self.assertEqual({'10.0.0.1': 42, '10.0.0.2': None},
+                         self.pool.run(tasks))
+
+    def test_devices_run_in_parallel(self):
+        barrier = threading.Event()
+        waiting = []
+
+        def wait(device):
+            waiting.append(device)
+            if len(waiting) == 4:
+                barrier.set()
+            return barrier.wait(5)
+        tasks = dict((ip, (wait, (ip,)))
+                     for ip in ['1.1.1.1', '1.1.1.2', '1.1.1.3', '1.1.1.4'])
+        start = time.time()
+        results = self.pool.run(tasks)
+        self.assertTrue(all(results.values()))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_per_device_limit(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        runs = [mythread.GreenThread(self.pool.run, {'1.1.1.1': (task, ()),
+                                                     '1.1.1.2': (task, ())})
+                for i in range(3)]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+        # Three runs of two devices, at most one task per device at once.
+        self.assertEqual(6, len(peak))
+        self.assertTrue(max(peak) <= 2)
+
+
+class KeyedLockTestCase(base.BaseTestCase):
+    """Test cases for the locks keyed by network, host and device."""
+    def setUp(self):
+        super(KeyedLockTestCase, self).setUp()
+        self.locks = mythread.KeyedLock()
+
+    def test_unrelated_keys_do_not_block(self):
+        with self.locks.hold([('device', '1.1.1.1')]):
+            done = threading.Event()
+
+            def other():
+                with self.locks.hold([('device', '1.1.1.2')]):
+                    done.set()
+            mythread.GreenThread(other).start()
+            self.assertTrue(done.wait(5))
+        self.assertEqual({}, self.locks.locks)
+
+    def test_no_deadlock_in_opposite_order(self):
+        keys = [('device', '1.1.1.%d' % i) for i in range(5)]
+        counter = []
+
+        def run(order):
+            for i in range(200):
+                with self.locks.hold(order):
+                    counter.append(i)
+        threads = [mythread.GreenThread(run, keys),
+                   mythread.GreenThread(run, list(reversed(keys)))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(400, len(counter))
+        self.assertEqual({}, self.locks.locks)
+
+
+class BatcherTestCase(base.BaseTestCase):
+    """Test cases for the batches of concurrently submitted items."""
+    def setUp(self):
+        super(BatcherTestCase, self).setUp()
+        self.flushed = []
+        self.batcher = mythread.Batcher(0.1, self.flushed.append)
+
+    def _submit_all(self, submits):
+        errors = []
+
+        def submit(key, item):
+            try:
+                self.batcher.submit(key, item)
+            except Exception, e:
+                errors.append(e)
+        threads = [mythread.GreenThread(submit, key, item)
+                   for key, item in submits]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return errors
+
+    def test_items_of_a_key_are_flushed_together(self):
+        errors = self._submit_all([('a', 1), ('a', 2), ('b', 3),
+                                   ('a', 4)])
+        self.assertEqual([], errors)
+        self.assertEqual([[1, 2, 4], [3]],
+                         sorted(sorted(items) for items in self.flushed))
+        self.assertEqual({}, self.batcher.pending)
+        # A later item starts a new batch.
+        self.batcher.submit('a', 5)
+        self.assertEqual([5], self.flushed[-1])
+
+    def test_flush_error_is_raised_by_every_caller(self):
+        def fail(items):
+            raise RuntimeError('database is down')
+        self.batcher.flush = fail
+        errors = self._submit_all([('a', 1), ('a', 2)])
+        self.assertEqual(2, len(errors))
+        self.assertTrue(all(isinstance(e, RuntimeError) for e in errors))
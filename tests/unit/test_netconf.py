@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.rpc import netconf
+
+HELLO_REPLY = """<env:Envelope
+ xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Header>
+    <auth:Authentication xmlns:auth="http://www.hp.com/netconf/base:1.0">
+      <auth:AuthInfo>%s</auth:AuthInfo>
+    </auth:Authentication>
+  </env:Header>
+</env:Envelope>"""
+OK_REPLY = """<env:Envelope
+ xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Body><rpc-reply><ok/></rpc-reply></env:Body>
+</env:Envelope>"""
+INVALID_REPLY = """<env:Envelope
+ xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Body><env:Fault>
+    <faultstring>Invalid session</faultstring>
+  </env:Fault></env:Body>
+</env:Envelope>"""
+
+
+class NetConfigSessionTestCase(base.BaseTestCase):
+    """Test cases for the NETCONF session lease."""
+    def setUp(self):
+        super(NetConfigSessionTestCase, self).setUp()
+        patcher = mock.patch.object(netconf.connection_pool, 'get_pool')
+        self.pool = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client = netconf.NetConfigClient('hp', '10.0.0.1', 'http',
+                                              'user', 'pass',
+                                              session_lease=60)
+        self.sent = []
+        self.replies = []
+        self.pool.post.side_effect = self._post
+
+    def _post(self, path, msg, headers):
+        self.sent.append(msg)
+        if '<hello' in msg:
+            return HELLO_REPLY % ('auth%d' % len(self.sent))
+        if self.replies:
+            return self.replies.pop(0)
+        return OK_REPLY
+
+    def test_session_not_verified_within_lease(self):
+        self.assertTrue(self.client.set('<VLAN/>'))
+        self.assertTrue(self.client.set('<VLAN/>'))
+        self.assertEqual(3, len(self.sent))
+        self.assertFalse(any('get-sessions' in msg for msg in self.sent))
+
+    def test_session_verified_after_lease(self):
+        self.client.set('<VLAN/>')
+        self.client.session_valid_time -= 61
+        self.client.set('<VLAN/>')
+        self.assertIn('get-sessions', self.sent[2])
+
+    def test_invalid_session_is_replayed(self):
+        self.client.set('<VLAN/>')
+        self.replies = [INVALID_REPLY]
+        self.assertTrue(self.client.set('<VLAN/>'))
+        self.assertIn('<hello', self.sent[3])
+        self.assertIn('auth4', self.sent[4])
+        self.assertEqual('auth4', self.client.auth_info)
+
+    def test_config_gets_session_once(self):
+        with mock.patch.object(self.client, 'get_session',
+                               return_value=True) as get_session:
+            self.client.config('vlan 10')
+        self.assertEqual(1, get_session.call_count)
+
+    def test_envelope_rendered_per_session(self):
+        self.client.set('<VLAN/>')
+        with mock.patch.object(self.client, '_render',
+                               wraps=self.client._render) as render:
+            self.client.set('<Name>$x</Name>')
+            self.assertFalse(render.called)
+            self.assertIn('auth1</auth:AuthInfo>', self.sent[-1])
+            self.assertIn('<Name>$x</Name>', self.sent[-1])
+            self.client.auth_info = 'auth9'
+            self.client.set('<VLAN/>')
+            self.assertEqual(2, render.call_count)
+            self.assertIn('auth9</auth:AuthInfo>', self.sent[-1])
+
+
+BULK_REPLY = """<env:Envelope
+ xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Body><rpc-reply xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
+    <data><top xmlns="http://www.hp.com/netconf/data:1.0">
+      <VLAN><TrunkInterfaces>%s</TrunkInterfaces></VLAN>
+    </top></data>
+  </rpc-reply></env:Body>
+</env:Envelope>"""
+TRUNK_ROW = """<Interface><IfIndex>%d</IfIndex>
+  <PermitVlanList>1,10-12</PermitVlanList></Interface>"""
+
+
+class NetConfigBulkTestCase(base.BaseTestCase):
+    """Test cases for the paginated get-bulk reader."""
+    def setUp(self):
+        super(NetConfigBulkTestCase, self).setUp()
+        patcher = mock.patch.object(netconf.connection_pool, 'get_pool')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = netconf.NetConfigClient('hp', '10.0.0.1', 'http',
+                                              'user', 'pass')
+        self.client.get_session = mock.Mock(return_value=True)
+        self.client.request = mock.Mock(side_effect=[
+            BULK_REPLY % ''.join(TRUNK_ROW % i for i in (1, 2)),
+            BULK_REPLY % (TRUNK_ROW % 3)])
+
+    def test_iter_bulk_continues_from_last_index(self):
+        rows = list(self.client.iter_bulk(('VLAN', 'TrunkInterfaces'),
+                                          'Interface', ('IfIndex',),
+                                          ('IfIndex', 'PermitVlanList'),
+                                          count=2))
+        self.assertEqual(['1', '2', '3'], [row['IfIndex'] for row in rows])
+        self.assertEqual(2, self.client.request.call_count)
+        first = self.client.request.call_args_list[0][0]
+        second = self.client.request.call_args_list[1][0]
+        self.assertEqual(netconf.GET_BULK_HEADER, first[0])
+        self.assertIn('<TrunkInterfaces base:count="2">', first[1])
+        self.assertIn('<IfIndex></IfIndex>', first[1])
+        self.assertIn('<IfIndex>2</IfIndex>', second[1])
+
+    def test_iter_trunk_interfaces(self):
+        trunks = list(self.client.iter_trunk_interfaces())
+        self.assertEqual(2, len(trunks))
+        self.assertEqual(('1', [1, 10, 11, 12]),
+                         (trunks[0][0], list(trunks[0][1])))
+        self.assertEqual(1, self.client.request.call_count)
+
+    def test_iter_bulk_raises_on_failure(self):
+        self.client.request = mock.Mock(return_value=None)
+        self.assertRaises(netconf.BulkReadError, list,
+                          self.client.iter_vlans())
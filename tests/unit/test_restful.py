@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import zlib
+
+import mock
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.rpc import connection_pool
+from neutron.plugins.ml2.drivers.hp.rpc import restful
+
+
+class RestfulTestCase(base.BaseTestCase):
+    """Test cases for the RESTful session of a device."""
+    def setUp(self):
+        super(RestfulTestCase, self).setUp()
+        patcher = mock.patch.object(restful.connection_pool, 'get_pool')
+        self.pool = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.tokens = []
+        self.valid_token = None
+        self.sent = []
+        self.broken = set()
+        self.vlan_table = [{'ID': 1}, {'ID': 10}]
+        self.pool.request.side_effect = self._request
+        self.cfg = restful.RestfulCfg('10.0.0.1', 'admin', 'admin')
+        self.addCleanup(self.cfg.close)
+
+    def _request(self, method, path, body, headers):
+        if path == restful.API_PATH + 'tokens':
+            self.valid_token = 'token-%d' % len(self.tokens)
+            self.tokens.append(self.valid_token)
+            return json.dumps({'token-id': self.valid_token})
+        if headers['X-Auth-Token'] != self.valid_token:
+            raise connection_pool.RequestError('unauthorized', 401, '')
+        self.sent.append((method, path))
+        if path == restful.API_PATH + restful.VLAN_TABLE:
+            return json.dumps({'VLANs': self.vlan_table})
+        if path == restful.API_PATH + restful.TRUNK_TABLE:
+            return json.dumps({'TrunkInterfaces': [
+                {'IfIndex': 5, 'PermitVlanList': '1,10-12'}]})
+        if path in self.broken:
+            raise connection_pool.RequestError('fault', 500, '')
+        return '{}'
+
+    def test_token_is_cached(self):
+        self.assertTrue(self.cfg.create_vlan(10))
+        self.assertTrue(self.cfg.create_vlan(20))
+        self.assertTrue(self.cfg.delete_vlan_bulk([10, 20]))
+        self.assertEqual(1, len(self.tokens))
+        stats = self.cfg.client.get_stats()
+        self.assertEqual(1, stats['logins'])
+        self.assertEqual(4, stats['requests'])
+
+    def test_login_again_on_401(self):
+        self.assertTrue(self.cfg.create_vlan(10))
+        self.valid_token = 'expired'
+        self.assertTrue(self.cfg.create_vlan(20))
+        self.assertEqual(2, len(self.tokens))
+        path = self.pool.request.call_args[0][1]
+        self.assertEqual(restful.API_PATH + 'VLAN/VLANs?index=ID%3D20', path)
+
+    def test_request_error(self):
+        self.pool.request.side_effect = connection_pool.RequestError('down')
+        self.assertFalse(self.cfg.create_vlan(10))
+        self.assertIsNone(self.cfg.client.token)
+
+    def test_create_only_missing_vlans(self):
+        self.assertTrue(self.cfg.create_vlan_bulk([1, 10, 20, 30]))
+        self.assertEqual(1, self.sent.count(
+            ('GET', restful.API_PATH + restful.VLAN_TABLE)))
+        puts = sorted(path for method, path in self.sent if method == 'PUT')
+        self.assertEqual([restful.API_PATH + 'VLAN/VLANs?index=ID%3D20',
+                          restful.API_PATH + 'VLAN/VLANs?index=ID%3D30'],
+                         puts)
+
+    def test_delete_only_present_vlans(self):
+        self.assertTrue(self.cfg.delete_vlan_bulk([10, 20]))
+        deletes = [path for method, path in self.sent if method == 'DELETE']
+        self.assertEqual([restful.API_PATH + 'VLAN/VLANs?index=ID%3D10'],
+                         deletes)
+
+    def test_delete_unused_vlans(self):
+        self.vlan_table = [{'ID': 10, 'TaggedPortList': '1,2'}, {'ID': 20}]
+        self.assertTrue(self.cfg.delete_unused_vlans([10, 20]))
+        deletes = [path for method, path in self.sent if method == 'DELETE']
+        self.assertEqual([restful.API_PATH + 'VLAN/VLANs?index=ID%3D20'],
+                         deletes)
+
+    def test_per_item_results(self):
+        self.broken.add(restful.API_PATH + 'VLAN/VLANs?index=ID%3D30')
+        ops = [('PUT', restful.VLAN_INDEX % vlan_id, {'ID': vlan_id})
+               for vlan_id in [20, 30, 40]]
+        self.assertEqual({('PUT', restful.VLAN_INDEX % 20): True,
+                          ('PUT', restful.VLAN_INDEX % 30): False,
+                          ('PUT', restful.VLAN_INDEX % 40): True},
+                         self.cfg.run_batch(ops))
+        self.assertFalse(self.cfg.create_vlan_bulk([20, 30, 40]))
+
+    def test_close_stops_workers(self):
+        self.cfg.create_vlan_bulk([20, 30, 40])
+        workers = list(self.cfg.workers.workers)
+        self.assertEqual(self.cfg.concurrency, len(workers))
+        self.cfg.close()
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.isAlive())
+
+    def test_ports_are_trunks_before_permit(self):
+        self.assertTrue(self.cfg.port_trunk_bulk([([5, 6], [10, 11])]))
+        methods = [path.split('?')[0] for method, path in self.sent
+                   if method == 'PUT']
+        self.assertEqual([restful.API_PATH + 'Ifmgr/Interfaces'] * 2 +
+                         [restful.API_PATH + 'VLAN/TrunkInterfaces'] * 2,
+                         methods)
+
+    def test_large_body_is_compressed(self):
+        self.cfg.client.compress_threshold = 100
+        self.assertTrue(self.cfg.port_trunk_bulk([([5], range(2, 400, 2))]))
+        body, headers = self.pool.request.call_args[0][2:]
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual(len(body), headers['Content-Length'])
+        self.assertIn('PermitVlanList',
+                      zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        stats = self.cfg.client.get_stats()
+        self.assertTrue(stats['bytes_compressed'] <
+                        stats['bytes_uncompressed'])
+
+    def test_get_state(self):
+        vlans, trunks = self.cfg.get_state()
+        self.assertEqual([1, 10], list(vlans))
+        self.assertEqual(['5'], trunks.keys())
+        self.assertEqual([1, 10, 11, 12], list(trunks['5']))
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import config
+from neutron.plugins.ml2.drivers.hp import sync_helper
+
+
+class FakeJournalEntry(object):
+    def __init__(self, host_id, seq):
+        self.host_id = host_id
+        self.seq = seq
+
+
+class SyncHelperTestCase(base.BaseTestCase):
+    """Test cases for the incremental synchronization."""
+    def setUp(self):
+        super(SyncHelperTestCase, self).setUp()
+        patcher = mock.patch.object(sync_helper, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.get_last_journal_seq.return_value = 10
+        self.db.get_last_device_op_seq.return_value = 7
+        self.db.get_host_vlan.return_value = {'host1': [100]}
+        self.db.get_journal_entries.return_value = []
+        self.db.get_journal_entries_by_seq.return_value = []
+        self.db.get_recent_journal_seqs.return_value = []
+        topology = config.Topology(
+            [{'ip': '1.1.1.1', 'oem': 'h3c',
+              'connections': [{'host': 'host1', 'ports': ['g1/0/1']}]},
+             {'ip': '1.1.1.2', 'oem': 'h3c',
+              'connections': [{'host': 'host2', 'ports': ['g1/0/1']}]}],
+            [{'ip': '2.2.2.1', 'oem': 'h3c',
+              'connections': [{'leaf_ip': '1.1.1.1',
+                               'spine_ports': ['g1/0/9'],
+                               'leaf_ports': ['g1/0/49']},
+                              {'leaf_ip': '1.1.1.2',
+                               'spine_ports': ['g1/0/10'],
+                               'leaf_ports': ['g1/0/49']}]}])
+        self.clients = dict((dev_ip, mock.Mock())
+                            for dev_ip in topology.devices)
+        for client in self.clients.values():
+            client.get_uptime.return_value = 1000
+        self.helper = sync_helper.SyncHelper(topology, self.clients, 60,
+                                             False)
+        self.helper.sync_config = mock.Mock()
+
+    def _synced_devices(self):
+        return self.helper.sync_config.call_args[0][1]
+
+    def test_first_sync_is_full(self):
+        self.helper.do_sync()
+        self.helper.sync_config.assert_called_once_with({'host1': [100]},
+                                                        None, 7)
+        self.assertEqual(10, self.helper.checkpoint)
+
+    def test_journal_since_checkpoint_syncs_delta_only(self):
+        self.helper.do_sync()
+        self.db.get_last_journal_seq.return_value = 12
+        self.db.get_journal_entries.return_value = [
+            FakeJournalEntry('host2', 12)]
+        self.helper.do_sync()
+        self.db.get_journal_entries.assert_called_with(10, 12)
+        self.assertEqual(set(['1.1.1.2', '2.2.2.1']),
+                         self._synced_devices())
+        self.assertEqual(12, self.helper.checkpoint)
+
+    def test_no_journal_entries_syncs_nothing(self):
+        self.helper.do_sync()
+        self.helper.do_sync()
+        self.assertEqual(set(), self._synced_devices())
+
+    def test_rebooted_and_failed_devices_are_rebuilt(self):
+        self.helper.do_sync()
+        self.clients['1.1.1.1'].get_uptime.return_value = 5
+        self.helper.mark_failed('1.1.1.2')
+        self.helper.do_sync()
+        self.assertEqual(set(['1.1.1.1', '1.1.1.2']),
+                         self._synced_devices())
+        # They are not synchronized again once they succeed.
+        self.helper.do_sync()
+        self.assertEqual(set(), self._synced_devices())
+
+    def test_device_failing_during_sync_is_kept(self):
+        self.helper.do_sync()
+        self.helper.mark_failed('1.1.1.2')
+        self.helper.sync_config.side_effect = (
+            lambda host_vlan, devices, op_seq:
+            self.helper.mark_failed('1.1.1.1'))
+        self.helper.do_sync()
+        self.assertEqual(set(['1.1.1.2']), self._synced_devices())
+        self.assertEqual(set(['1.1.1.1']), self.helper.failed_devices)
+
+
+    def test_late_journal_entry_is_read_again(self):
+        self.helper.do_sync()
+        # Entry 11 was allocated before entry 12 but is not committed yet.
+        self.db.get_last_journal_seq.return_value = 12
+        self.db.get_journal_entries.return_value = [
+            FakeJournalEntry('host2', 12)]
+        self.helper.do_sync()
+        self.assertEqual([11], self.helper.journal_holes.keys())
+        self.db.get_journal_entries.return_value = []
+        self.db.get_journal_entries_by_seq.return_value = [
+            FakeJournalEntry('host1', 11)]
+        self.helper.do_sync()
+        self.db.get_journal_entries_by_seq.assert_called_with([11])
+        self.assertEqual(set(['1.1.1.1', '2.2.2.1']),
+                         self._synced_devices())
+        self.assertEqual({}, self.helper.journal_holes)
+
+    def test_journal_hole_expires(self):
+        self.helper.do_sync()
+        self.db.get_last_journal_seq.return_value = 12
+        self.db.get_journal_entries.return_value = [
+            FakeJournalEntry('host2', 12)]
+        with mock.patch.object(sync_helper.time, 'time', return_value=100):
+            self.helper.do_sync()
+        self.db.get_journal_entries.return_value = []
+        with mock.patch.object(sync_helper.time, 'time',
+                               return_value=100 +
+                               sync_helper.JOURNAL_HOLE_TIMEOUT):
+            self.helper.do_sync()
+        self.assertEqual({}, self.helper.journal_holes)
+
+    def test_first_sync_finds_recent_holes(self):
+        self.db.get_recent_journal_seqs.return_value = [6, 7, 9]
+        self.helper.do_sync()
+        self.db.get_recent_journal_seqs.assert_called_once_with(
+            sync_helper.JOURNAL_HOLE_TIMEOUT, 10)
+        self.assertEqual([8, 10], sorted(self.helper.journal_holes))
+
+    def test_failed_push_keeps_checkpoint(self):
+        self.helper.do_sync()
+        self.db.get_last_journal_seq.return_value = 12
+        self.db.get_journal_entries.return_value = [
+            FakeJournalEntry('host2', 11), FakeJournalEntry('host2', 12)]
+        self.helper.mark_failed('1.1.1.1')
+        self.db.purge_journal.reset_mock()
+        self.helper.sync_config.side_effect = ValueError()
+        self.assertRaises(ValueError, self.helper.do_sync)
+        self.assertEqual(10, self.helper.checkpoint)
+        self.assertEqual(set(['1.1.1.1']), self.helper.failed_devices)
+        self.assertFalse(self.db.purge_journal.called)
+        # The entries are synchronized by the next run.
+        self.helper.sync_config.side_effect = None
+        self.helper.do_sync()
+        self.db.get_journal_entries.assert_called_with(10, 12)
+        self.assertEqual(set(['1.1.1.1', '1.1.1.2', '2.2.2.1']),
+                         self._synced_devices())
+        self.assertEqual(12, self.helper.checkpoint)
+
+
+class SyncConfigTestCase(base.BaseTestCase):
+    """Test cases for the pushes of a synchronization."""
+    def setUp(self):
+        super(SyncConfigTestCase, self).setUp()
+        topology = config.Topology(
+            [{'ip': '1.1.1.1', 'oem': 'h3c',
+              'connections': [{'host': 'host1', 'ports': ['g1/0/1']}]},
+             {'ip': '1.1.1.2', 'oem': 'h3c',
+              'connections': [{'host': 'host2', 'ports': ['g1/0/1']}]}],
+            [])
+        self.clients = dict((dev_ip, mock.Mock())
+                            for dev_ip in topology.devices)
+        self.helper = sync_helper.SyncHelper(topology, self.clients, 60,
+                                             False)
+        self.helper.device_queue = mock.Mock()
+        self.helper.device_queue.run_exclusive.side_effect = (
+            lambda dev_ip, op_seq, func, *args:
+            dev_ip != '1.1.1.2' and func(*args))
+
+    def test_push_is_serialized_with_queue(self):
+        self.clients['1.1.1.1'].apply.return_value = True
+        results = self.helper.sync_config({'host1': [100], 'host2': [200]},
+                                          None, 7)
+        self.helper.device_queue.run_exclusive.assert_has_calls([
+            mock.call('1.1.1.1', 7, self.helper.push_config, '1.1.1.1',
+                      self.clients['1.1.1.1'], mock.ANY),
+            mock.call('1.1.1.2', 7, self.helper.push_config, '1.1.1.2',
+                      self.clients['1.1.1.2'], mock.ANY)], any_order=True)
+        self.assertEqual({'1.1.1.1': True, '1.1.1.2': False}, results)
+        # 1.1.1.2 got newer operations, it is synchronized next time.
+        self.assertFalse(self.clients['1.1.1.2'].apply.called)
+        self.assertEqual(set(['1.1.1.2']), self.helper.failed_devices)
+
+    def test_uptime_is_read_in_device_slot(self):
+        for client in self.clients.values():
+            client.get_uptime.return_value = 100
+        with mock.patch.object(self.helper.workers, 'call',
+                               wraps=self.helper.workers.call) as call:
+            self.helper.find_rebooted_devices()
+        call.assert_has_calls([
+            mock.call(dev_ip, client.get_uptime)
+            for dev_ip, client in self.clients.items()], any_order=True)
+        self.assertEqual({'1.1.1.1': 100, '1.1.1.2': 100},
+                         self.helper.dev_uptime)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import tools
+
+
+class VlanStrTestCase(base.BaseTestCase):
+    """Test cases for encoding and decoding PermitVlanList strings."""
+    def test_get_vlan_rangestr(self):
+        vlans = [1000] + range(900, 9, -1) + [12]
+        self.assertEqual("10-900,1000", tools.get_vlan_rangestr(vlans))
+        self.assertEqual("1,3-4", tools.get_vlan_rangestr([4, 1, 3]))
+        self.assertEqual("", tools.get_vlan_rangestr([]))
+        self.assertEqual("", tools.get_vlan_rangestr(None))
+
+    def test_parse_vlan_str(self):
+        self.assertEqual([1, 10, 11, 12],
+                         list(tools.parse_vlan_str("1, 10-12")))
+        self.assertEqual([], list(tools.parse_vlan_str("")))
+
+    def test_round_trip(self):
+        vlans = [2, 3, 4, 7, 100, 101, 4094]
+        self.assertEqual(vlans, list(tools.parse_vlan_str(
+            tools.get_vlan_rangestr(vlans))))
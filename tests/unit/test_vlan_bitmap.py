@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import vlan_bitmap
+
+
+class VlanBitmapTestCase(base.BaseTestCase):
+    """Test cases for the integer backed VLAN bitmap."""
+    def test_iteration_is_sorted(self):
+        bitmap = vlan_bitmap.VlanBitmap([4094, 10, 1, 10])
+        self.assertEqual([1, 10, 4094], list(bitmap))
+        self.assertEqual(3, len(bitmap))
+        self.assertIn(4094, bitmap)
+        self.assertNotIn(2, bitmap)
+
+    def test_set_operations(self):
+        left = vlan_bitmap.VlanBitmap([1, 2, 3])
+        right = vlan_bitmap.VlanBitmap([3, 4])
+        self.assertEqual([1, 2, 3, 4], list(left | right))
+        self.assertEqual([3], list(left & right))
+        self.assertEqual([1, 2], list(left - right))
+        left |= right
+        self.assertEqual([1, 2, 3, 4], list(left))
+
+    def test_add_and_discard(self):
+        bitmap = vlan_bitmap.VlanBitmap()
+        self.assertFalse(bitmap)
+        bitmap.add(100)
+        bitmap.discard(101)
+        self.assertEqual([100], list(bitmap))
+        bitmap.discard(100)
+        self.assertFalse(bitmap)
+        self.assertRaises(ValueError, bitmap.add, 4096)
+
+    def test_ranges(self):
+        bitmap = vlan_bitmap.VlanBitmap([1, 2, 3, 5, 7, 8])
+        self.assertEqual([(1, 3), (5, 5), (7, 8)], bitmap.ranges())
+        self.assertEqual([(10, 900)],
+                         vlan_bitmap.VlanBitmap.from_range(10, 900).ranges())
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+#  H3C Technologies Co., Limited Copyright 2003-2015, All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from neutron.tests import base
+
+from neutron.plugins.ml2.drivers.hp.common import vlan_index
+
+
+class VlanIndexTestCase(base.BaseTestCase):
+    """Test cases for the in-memory host/network/VLAN index."""
+    def setUp(self):
+        super(VlanIndexTestCase, self).setUp()
+        self.index = vlan_index.VlanIndex()
+        self.index.load([('net1', 'host1', 101, 2),
+                         ('net2', 'host1', 102, 1),
+                         ('net1', 'host2', 101, 1)])
+
+    def test_load(self):
+        self.assertEqual([101, 102], self.index.get_vlanlist_byhost('host1'))
+        self.assertEqual(['host1', 'host2'],
+                         sorted(self.index.get_host_list('net1')))
+        self.assertEqual(2, self.index.get_port_count('net1', 'host1'))
+
+    def test_add_and_remove_port(self):
+        self.assertEqual(1, self.index.add_port('net3', 'host2', 103))
+        self.assertEqual([101, 103], self.index.get_vlanlist_byhost('host2'))
+        self.assertEqual(0, self.index.remove_port('net3', 'host2'))
+        self.assertEqual([101], self.index.get_vlanlist_byhost('host2'))
+        self.assertEqual([], self.index.get_host_list('net3'))
+
+    def test_remove_port_keeps_vlan_while_ports_left(self):
+        self.assertEqual(1, self.index.remove_port('net1', 'host1'))
+        self.assertEqual([101, 102], self.index.get_vlanlist_byhost('host1'))
+
+    def test_diff(self):
+        self.assertEqual({}, self.index.diff({'host1': [101, 102],
+                                              'host2': [101]}))
+        self.assertEqual({'host2': ([101], []), 'host3': ([], [105])},
+                         self.index.diff({'host1': [102, 101],
+                                          'host3': [105]}))